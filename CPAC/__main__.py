@@ -16,8 +16,11 @@ License for more details.
 You should have received a copy of the GNU Lesser General Public
 License along with C-PAC. If not, see <https://www.gnu.org/licenses/>."""
 import os
-import pkg_resources as p
 import click
+from CPAC.utils.lazy import lazy_module
+
+# only the subcommands that look up packaged resources import pkg_resources
+p = lazy_module('pkg_resources')
 
 # CLI tree
 #
@@ -10,7 +10,7 @@ from CPAC.func_preproc.utils import add_afni_prefix, nullify, chunk_ts, \
                                     split_ts_chunks, oned_text_concat, \
                                     notch_filter_motion
 from CPAC.generate_motion_statistics import motion_power_statistics
-from CPAC.utils.docs import grab_docstring_dct
+from CPAC.utils.docs import node_block_descriptor
 from CPAC.utils.interfaces.ants import AI  # niworkflows
 from CPAC.utils.interfaces.ants import PrintHeader, SetDirectionByMatrix
 from CPAC.utils.interfaces.function import Function
@@ -1141,7 +1141,7 @@ def get_motion_ref(wf, cfg, strat_pool, pipe_num, opt=None):
                 "desc-reorient_bold"],
      "outputs": ["motion-basefile"]}
     '''
-    option_vals = grab_docstring_dct(get_motion_ref).get('option_val')
+    option_vals = node_block_descriptor(get_motion_ref).option_val
     if opt not in option_vals:
         raise ValueError('\n\n[!] Error: The \'motion_correction_reference\' '
                          'parameter of the \'motion_correction\' workflow '
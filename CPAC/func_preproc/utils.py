@@ -1,7 +1,5 @@
 
 import numpy as np
-from scipy.signal import iirnotch, firwin, filtfilt, lfilter, freqz
-from matplotlib import pyplot as plt
 import nibabel as nb
 import subprocess
 import math
@@ -125,6 +123,10 @@ def notch_filter_motion(motion_params, filter_type, TR, fc_RR_min=None,
     # Adapted from DCAN Labs:
     #   https://github.com/DCAN-Labs/dcan_bold_processing/blob/master/
     #       ...matlab_code/filtered_movement_regressors.m
+    # imported here rather than at the top of the module, which every
+    # pipeline imports, because scipy.signal and pyplot are slow to import
+    from scipy.signal import iirnotch, firwin, lfilter, freqz
+    from matplotlib import pyplot as plt
 
     if "ms" in TR:
         TR = float(TR.replace("ms", ""))/1000
@@ -0,0 +1,300 @@
+# Copyright (C) 2022  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""In-process network centrality
+
+Degree centrality, eigenvector centrality and local functional
+connectivity density (lFCD) all derive from the voxel × voxel
+correlation matrix. Instead of running AFNI's ``3dDegreeCentrality``,
+``3dECM`` and ``3dLFCD`` separately (each recomputing that matrix),
+``calc_centrality`` streams row tiles of the correlation matrix once,
+under a memory budget, and accumulates every requested measure from
+each tile.
+"""
+import os
+import numpy as np
+import nibabel as nib
+from CPAC.network_centrality.utils import check_centrality_params, \
+                                          pvalue_to_r
+from CPAC.utils.sparse_graph import EDGE_BYTES, SparseGraph, \
+                                    SparsityEdges, ThresholdedEdges, \
+                                    correlation_tiles, \
+                                    normalize_timeseries, power_iteration, \
+                                    tile_rows
+
+NEIGHBORHOODS = {7: 1, 19: 2, 27: 3}
+
+
+def load_normalized_timeseries(in_file, template):
+    """Load in-mask timeseries scaled so that a dot product of two
+    columns is their Pearson correlation.
+
+    Parameters
+    ----------
+    in_file : str
+        4D functional image
+
+    template : str
+        3D mask in the space of ``in_file``
+
+    Returns
+    -------
+    img : nibabel.Nifti1Image
+
+    mask : numpy.ndarray
+        boolean mask of voxels with nonzero variance inside ``template``
+
+    timeseries : numpy.ndarray
+        timepoints × voxels float32 array
+    """
+    img = nib.load(in_file)
+    data = np.asanyarray(img.dataobj)
+    mask = np.asanyarray(nib.load(template).dataobj) != 0
+    mask &= (data != data[..., :1]).any(axis=3)
+    timeseries = data[mask].astype(np.float32).T
+    del data
+    return img, mask, normalize_timeseries(timeseries)
+
+
+def neighbor_indices(mask, neighborhood=27):
+    """In-mask neighbors of each in-mask voxel.
+
+    Parameters
+    ----------
+    mask : numpy.ndarray
+        3D boolean mask
+
+    neighborhood : int
+        7 (faces), 19 (faces + edges) or 27 (faces + edges + corners),
+        counting the voxel itself
+
+    Returns
+    -------
+    numpy.ndarray
+        voxels × neighbors array of in-mask indices, -1 where the
+        neighbor is outside the mask
+    """
+    max_distance = NEIGHBORHOODS[neighborhood]
+    index = np.full(np.array(mask.shape) + 2, -1, dtype=np.int64)
+    index[1:-1, 1:-1, 1:-1][mask] = np.arange(mask.sum())
+    coords = np.argwhere(mask) + 1
+    offsets = [offset for offset in np.ndindex(3, 3, 3) if
+               0 < np.abs(np.array(offset) - 1).sum() <= max_distance]
+    return np.stack([index[tuple((coords + np.array(offset) - 1).T)]
+                     for offset in offsets], axis=1)
+
+
+def grow_lfcd(seed, correlations, neighbors, threshold, visited):
+    """Grow the connected cluster of neighbors correlated with ``seed``
+    above ``threshold``.
+
+    Parameters
+    ----------
+    seed : int
+
+    correlations : numpy.ndarray
+        correlations of ``seed`` with every in-mask voxel
+
+    neighbors : numpy.ndarray
+        output of ``neighbor_indices``
+
+    threshold : float
+
+    visited : numpy.ndarray
+        all-False boolean scratch array, returned all-False
+
+    Returns
+    -------
+    numpy.ndarray
+        indices of the cluster, not including ``seed``
+    """
+    visited[seed] = True
+    touched = [np.array([seed])]
+    cluster = []
+    frontier = touched[0]
+    while frontier.size:
+        candidates = neighbors[frontier].ravel()
+        candidates = np.unique(candidates[candidates >= 0])
+        candidates = candidates[~visited[candidates]]
+        visited[candidates] = True
+        touched.append(candidates)
+        frontier = candidates[correlations[candidates] > threshold]
+        cluster.append(frontier)
+    visited[np.concatenate(touched)] = False
+    return np.concatenate(cluster)
+
+
+def _tiled_matvec(timeseries, rows, threshold, binarize):
+    """Matrix-vector product with the thresholded correlation matrix,
+    recomputing tiles, for when its edges do not fit in memory.
+    """
+    def matvec(vector):
+        product = np.empty_like(vector)
+        for start, stop, tile in correlation_tiles(timeseries, rows):
+            weights = (tile > threshold).astype(np.float32) if binarize \
+                else np.where(tile > threshold, tile, 0)
+            product[start:stop] = weights @ vector
+        return product
+    return matvec
+
+
+def _resolve_threshold(threshold_option, threshold, timepoints):
+    if threshold_option == 'Significance threshold':
+        return pvalue_to_r(threshold, timepoints)
+    return threshold
+
+
+def calc_centrality(in_file, template, measures, memory_gb=1.0,
+                    neighborhood=27):
+    """Compute degree centrality, eigenvector centrality and lFCD from
+    one streamed pass over the correlation matrix.
+
+    Parameters
+    ----------
+    in_file : str
+        4D functional image
+
+    template : str
+        3D mask in the space of ``in_file``
+
+    measures : dict
+        ``{method_option: (weight_options, threshold_option, threshold)}``
+        for each centrality measure to compute, using the same options as
+        the pipeline configuration
+
+    memory_gb : float
+        memory budget for correlation tiles and stored edges
+
+    neighborhood : int
+        lFCD neighborhood, 7, 19 or 27 voxels
+
+    Returns
+    -------
+    outfile_list : list of str
+        one image per measure and weight option, named like the AFNI
+        workflow's outputs (e.g. ``degree_centrality_Weighted.nii.gz``)
+    """
+    img, mask, timeseries = load_normalized_timeseries(in_file, template)
+    timepoints, n_voxels = timeseries.shape
+    budget = memory_gb * 1024 ** 3
+    rows = tile_rows(n_voxels, memory_gb / 2, timeseries.nbytes)
+    edge_budget = max(int((budget / 2) // EDGE_BYTES), 0)
+
+    settings = {}
+    for method_option, (weight_options, threshold_option, threshold
+                        ) in measures.items():
+        if not weight_options:
+            continue
+        method_option, threshold_option = check_centrality_params(
+            method_option, threshold_option, threshold)
+        settings[method_option] = (
+            weight_options, threshold_option,
+            _resolve_threshold(threshold_option, threshold, timepoints))
+
+    results = {}
+    sparsity_edges = {}
+    thresholded_edges = {}
+    for method_option in ['degree_centrality', 'eigenvector_centrality']:
+        if method_option not in settings:
+            continue
+        _, threshold_option, threshold = settings[method_option]
+        if threshold_option == 'Sparsity threshold':
+            k = max(int(np.ceil(threshold * n_voxels * (n_voxels - 1) / 2)),
+                    1)
+            sparsity_edges.setdefault(threshold, SparsityEdges(k))
+        elif method_option == 'degree_centrality':
+            results[('degree_centrality', 'Binarized')] = np.zeros(
+                n_voxels, dtype=np.float32)
+            results[('degree_centrality', 'Weighted')] = np.zeros(
+                n_voxels, dtype=np.float32)
+        else:
+            thresholded_edges[threshold] = ThresholdedEdges(
+                threshold, edge_budget)
+
+    lfcd = 'local_functional_connectivity_density' in settings
+    if lfcd:
+        _, _, lfcd_threshold = settings[
+            'local_functional_connectivity_density']
+        neighbors = neighbor_indices(mask, neighborhood)
+        visited = np.zeros(n_voxels, dtype=bool)
+        lfcd_binarized = np.zeros(n_voxels, dtype=np.float32)
+        lfcd_weighted = np.zeros(n_voxels, dtype=np.float32)
+
+    for start, stop, tile in correlation_tiles(timeseries, rows):
+        if ('degree_centrality', 'Binarized') in results:
+            above = tile > settings['degree_centrality'][2]
+            results[('degree_centrality', 'Binarized')][start:stop] = \
+                above.sum(axis=1)
+            results[('degree_centrality', 'Weighted')][start:stop] = \
+                np.where(above, tile, 0).sum(axis=1)
+        for threshold, edges in thresholded_edges.items():
+            edges.add(tile, tile > threshold)
+        for edges in sparsity_edges.values():
+            edges.add(start, tile)
+        if lfcd:
+            for seed in range(start, stop):
+                correlations = tile[seed - start]
+                cluster = grow_lfcd(seed, correlations, neighbors,
+                                    lfcd_threshold, visited)
+                lfcd_binarized[seed] = cluster.size
+                lfcd_weighted[seed] = correlations[cluster].sum()
+        del tile
+
+    if lfcd:
+        results[('local_functional_connectivity_density', 'Binarized')] = \
+            lfcd_binarized
+        results[('local_functional_connectivity_density', 'Weighted')] = \
+            lfcd_weighted
+
+    if 'degree_centrality' in settings and ('degree_centrality',
+                                            'Binarized') not in results:
+        graph = SparseGraph(sparsity_edges[
+            settings['degree_centrality'][2]].matrix(n_voxels))
+        results[('degree_centrality', 'Binarized')] = graph.degree()
+        results[('degree_centrality', 'Weighted')] = graph.degree(
+            weighted=True)
+
+    if 'eigenvector_centrality' in settings:
+        weight_options, threshold_option, threshold = settings[
+            'eigenvector_centrality']
+        if threshold_option == 'Sparsity threshold':
+            adjacency = sparsity_edges[threshold].matrix(n_voxels)
+        else:
+            adjacency = thresholded_edges[threshold].matrix(n_voxels)
+        for weight_option in weight_options:
+            binarize = weight_option == 'Binarized'
+            if adjacency is None:
+                results[('eigenvector_centrality', weight_option)] = \
+                    power_iteration(_tiled_matvec(timeseries, rows,
+                                                  threshold, binarize),
+                                    n_voxels)
+            else:
+                results[('eigenvector_centrality', weight_option)] = \
+                    SparseGraph(adjacency).eigenvector_centrality(
+                        weighted=not binarize)
+
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    outfile_list = []
+    for method_option, (weight_options, _, _) in settings.items():
+        for weight_option in weight_options:
+            volume = np.zeros(mask.shape, dtype=np.float32)
+            volume[mask] = results[(method_option, weight_option)]
+            out_file = os.path.join(os.getcwd(),
+                                    f'{method_option}_{weight_option}.nii.gz')
+            nib.Nifti1Image(volume, img.affine, header).to_filename(out_file)
+            outfile_list.append(out_file)
+    return outfile_list
@@ -5,6 +5,7 @@ import nipype.interfaces.utility as util
 from nipype import logging
 
 from CPAC.utils.interfaces.function import Function
+from CPAC.network_centrality.native import calc_centrality
 from CPAC.network_centrality.network_centrality import create_centrality_wf
 from CPAC.network_centrality.utils import merge_lists, check_centrality_params
 from CPAC.pipeline.schema import valid_options
@@ -70,6 +71,44 @@ def connect_centrality_workflow(workflow, c, resample_functional_to_template,
                      merge_node, out_list)
 
 
+def connect_native_centrality(workflow, c, resample_functional_to_template,
+                              template_node, template_out, merge_node,
+                              pipe_num):
+    '''Compute every configured centrality measure in one in-process
+    node that streams the correlation matrix once (see
+    ``CPAC.network_centrality.native.calc_centrality``).
+    '''
+    measures = {
+        option: (c.network_centrality[option]['weight_options'],
+                 c.network_centrality[option]['correlation_threshold_option'],
+                 c.network_centrality[option]['correlation_threshold'])
+        for option in valid_options['centrality']['method_options'] if
+        c.network_centrality[option]['weight_options']}
+    memory = c.network_centrality['memory_allocation']
+
+    centrality_node = pe.Node(Function(input_names=['in_file',
+                                                    'template',
+                                                    'measures',
+                                                    'memory_gb'],
+                                       output_names=['outfile_list'],
+                                       function=calc_centrality,
+                                       as_module=True),
+                              name=f'native_centrality_{pipe_num}',
+                              mem_gb=memory,
+                              mem_x=(1e-08, 'in_file'))
+    centrality_node.inputs.measures = measures
+    centrality_node.inputs.memory_gb = memory
+    centrality_node.interface.num_threads = c.pipeline_setup[
+        'system_config']['max_cores_per_participant']
+
+    workflow.connect(resample_functional_to_template, 'out_file',
+                     centrality_node, 'in_file')
+    workflow.connect(template_node, template_out,
+                     centrality_node, 'template')
+    workflow.connect(centrality_node, 'outfile_list',
+                     merge_node, 'deg_list')
+
+
 def network_centrality(wf, cfg, strat_pool, pipe_num, opt=None):
     '''Run Network Centrality.
 
@@ -129,11 +168,15 @@ def network_centrality(wf, cfg, strat_pool, pipe_num, opt=None):
                                   as_module=True),
                          name=f'centrality_merge_node_{pipe_num}')
 
-    [connect_centrality_workflow(wf, cfg, resample_functional_to_template,
-                                 node, out, merge_node,
-                                 option, pipe_num) for option in
-     valid_options['centrality']['method_options'] if
-     cfg.network_centrality[option]['weight_options']]
+    if cfg.network_centrality['in_process']:
+        connect_native_centrality(wf, cfg, resample_functional_to_template,
+                                  node, out, merge_node, pipe_num)
+    else:
+        [connect_centrality_workflow(wf, cfg, resample_functional_to_template,
+                                     node, out, merge_node,
+                                     option, pipe_num) for option in
+         valid_options['centrality']['method_options'] if
+         cfg.network_centrality[option]['weight_options']]
 
     outputs = {}
 
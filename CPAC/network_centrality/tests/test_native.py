@@ -0,0 +1,97 @@
+"""Tests for in-process network centrality"""
+import os
+import nibabel as nib
+import numpy as np
+import pytest
+from scipy import ndimage
+from CPAC.network_centrality.native import calc_centrality, \
+                                           neighbor_indices
+
+
+@pytest.fixture(name='inputs')
+def fixture_inputs(tmp_path):
+    '''Spatially smooth random timeseries and a mask'''
+    rng = np.random.default_rng(28)
+    data = ndimage.gaussian_filter(rng.standard_normal((7, 6, 5, 30)),
+                                   sigma=(1, 1, 1, 0)).astype(np.float32)
+    mask = np.ones(data.shape[:3], dtype=np.uint8)
+    mask[0, 0, :] = 0
+    in_file = str(tmp_path / 'func.nii.gz')
+    template = str(tmp_path / 'mask.nii.gz')
+    nib.Nifti1Image(data, np.eye(4)).to_filename(in_file)
+    nib.Nifti1Image(mask, np.eye(4)).to_filename(template)
+    masked = data[mask.astype(bool)]
+    corr = np.corrcoef(masked)
+    np.fill_diagonal(corr, -2)
+    return in_file, template, mask.astype(bool), corr
+
+
+def _load(outfile_list, name, mask):
+    path, = [path for path in outfile_list if
+             os.path.basename(path) == f'{name}.nii.gz']
+    return nib.load(path).get_fdata()[mask]
+
+
+@pytest.mark.parametrize('memory_gb', [1.0, 2e-6])
+def test_correlation_threshold(monkeypatch, tmp_path, inputs, memory_gb):
+    '''Test all three measures against dense computations, with one tile
+    and with many'''
+    in_file, template, mask, corr = inputs
+    monkeypatch.chdir(tmp_path)
+    outfile_list = calc_centrality(in_file, template, {
+        'degree_centrality': (['Binarized', 'Weighted'],
+                              'Correlation threshold', 0.3),
+        'eigenvector_centrality': (['Binarized', 'Weighted'],
+                                   'Correlation threshold', 0.3),
+        'local_functional_connectivity_density': (
+            ['Binarized', 'Weighted'], 'Correlation threshold', 0.3)},
+        memory_gb=memory_gb)
+    assert len(outfile_list) == 6
+
+    above = corr > 0.3
+    np.testing.assert_allclose(
+        _load(outfile_list, 'degree_centrality_Binarized', mask),
+        above.sum(axis=1))
+    np.testing.assert_allclose(
+        _load(outfile_list, 'degree_centrality_Weighted', mask),
+        np.where(above, corr, 0).sum(axis=1), rtol=1e-4)
+
+    for weight, adjacency in [('Binarized', above.astype(float)),
+                              ('Weighted', np.where(above, corr, 0))]:
+        _, vectors = np.linalg.eigh(adjacency)
+        expected = np.abs(vectors[:, -1])
+        np.testing.assert_allclose(
+            np.abs(_load(outfile_list, f'eigenvector_centrality_{weight}',
+                         mask)), expected, atol=1e-3)
+
+    # lFCD: connected component of the seed in the thresholded,
+    # spatially adjacent subgraph
+    neighbors = neighbor_indices(mask)
+    lfcd = _load(outfile_list,
+                 'local_functional_connectivity_density_Binarized', mask)
+    for seed in range(0, corr.shape[0], 17):
+        cluster, frontier = {seed}, [seed]
+        while frontier:
+            voxel = frontier.pop()
+            for neighbor in neighbors[voxel]:
+                if (neighbor >= 0 and neighbor not in cluster and
+                        corr[seed, neighbor] > 0.3):
+                    cluster.add(neighbor)
+                    frontier.append(neighbor)
+        assert lfcd[seed] == len(cluster) - 1
+
+
+def test_sparsity_threshold(monkeypatch, tmp_path, inputs):
+    '''Test that sparsity thresholding keeps the strongest edges'''
+    in_file, template, mask, corr = inputs
+    monkeypatch.chdir(tmp_path)
+    outfile_list = calc_centrality(in_file, template, {
+        'degree_centrality': (['Binarized'], 'Sparsity threshold', 0.01)},
+        memory_gb=2e-6)
+    n_voxels = corr.shape[0]
+    k = int(np.ceil(0.01 * n_voxels * (n_voxels - 1) / 2))
+    upper = corr[np.triu_indices(n_voxels, 1)]
+    cut = np.sort(upper)[-k]
+    np.testing.assert_allclose(
+        _load(outfile_list, 'degree_centrality_Binarized', mask),
+        (corr >= cut).sum(axis=1))
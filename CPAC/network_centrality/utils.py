@@ -39,6 +39,39 @@ def convert_pvalue_to_r(datafile, p_value, two_tailed=False):
     '''
 
     import nibabel as nb
+    from CPAC.network_centrality.utils import pvalue_to_r
+
+    # Load in data and number of time pts
+    t_pts = nb.load(datafile).shape[-1]
+
+    return pvalue_to_r(p_value, t_pts, two_tailed)
+
+
+def pvalue_to_r(p_value, t_pts, two_tailed=False):
+    '''
+    Method to calculate correlation threshold from p_value and the number
+    of timepoints
+
+    Parameters
+    ----------
+    p_value : float
+        significance threshold p-value
+    t_pts : int
+        number of timepoints
+    two_tailed : boolean (optional); default=False
+        flag to indicate whether to calculate the two-tailed t-test
+        threshold for the returned correlation value
+
+    Returns
+    -------
+    r_value : float
+        correlation threshold value
+
+    Examples
+    --------
+    >>> round(float(pvalue_to_r(0.001, 100)), 4)
+    0.3054
+    '''
     import numpy as np
     import scipy.stats
 
@@ -46,10 +79,6 @@ def convert_pvalue_to_r(datafile, p_value, two_tailed=False):
     if two_tailed:
         p_value = p_value / 2
 
-    # Load in data and number of time pts
-    img = nb.load(datafile).get_data()
-    t_pts = img.shape[-1]
-
     # N-2 degrees of freedom with Pearson correlation (two sample means)
     deg_freedom = t_pts-2
 
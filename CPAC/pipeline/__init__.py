@@ -17,10 +17,12 @@ License for more details.
 You should have received a copy of the GNU Lesser General Public
 License along with C-PAC. If not, see <https://www.gnu.org/licenses/>."""
 import os
-import pkg_resources as p
 
-ALL_PIPELINE_CONFIGS = os.listdir(
-    p.resource_filename("CPAC", os.path.join("resources", "configs")))
+# a path relative to this package rather than pkg_resources, which is slow
+# to import
+ALL_PIPELINE_CONFIGS = os.listdir(os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "resources", "configs"))
 ALL_PIPELINE_CONFIGS = [x.split('_')[2].replace('.yml', '') for
                         x in ALL_PIPELINE_CONFIGS if 'pipeline_config' in x]
 ALL_PIPELINE_CONFIGS.sort()
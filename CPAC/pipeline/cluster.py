@@ -0,0 +1,240 @@
+# Copyright (C) 2022  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Pack participants into cluster job-array tasks
+
+Each task runs one or more participants one after another. Participants
+are grouped by their estimated cores and memory, and packed into tasks
+by their estimated hours, so that short participants share a task's
+allocation and long ones get a time limit of their own. Tasks with the
+same core and memory requests are submitted together as one job array.
+
+A task's participants are listed in a JSON tasks file, which
+``run_cluster_task`` reads inside the scheduled task. ``LocalScheduler``
+runs a tasks file's tasks in processes on this machine, standing in for
+a cluster's scheduler in tests.
+"""
+import json
+import math
+import os
+import sys
+from copy import deepcopy
+from dataclasses import asdict, dataclass, field
+from typing import Callable, List, Optional, Sequence, Tuple
+import yaml
+from CPAC.pipeline.job_manager import Job, JobManager
+
+MEMORY_DIRECTIVES = {
+    'pbs': '#PBS -l mem=%(memory_gb)dgb',
+    'sge': '#$ -l h_vmem=%(memory_mb_per_core)dM',
+    'slurm': '#SBATCH --mem=%(memory_gb)dG'}
+"""batch-file directive requesting a job array's memory, per scheduler;
+SGE requests memory per slot"""
+
+
+@dataclass
+class ClusterTask:
+    """Participants to run one after another in one scheduler task"""
+    participants: List[int] = field(default_factory=list)
+    """indices of the participants in the participant list"""
+    hours: float = 0
+    """summed estimated hours of the participants"""
+    cores: int = 1
+    memory_gb: float = 0
+    """largest estimated memory of the participants"""
+
+    @property
+    def request(self) -> Tuple[int, int]:
+        """cores and whole GB of memory to request for this task"""
+        return self.cores, max(1, math.ceil(self.memory_gb))
+
+
+def pack_tasks(reservations: Sequence[Tuple[int, float]],
+               hours: Sequence[float], max_hours: float) -> List[ClusterTask]:
+    """Pack participants into tasks.
+
+    Participants are grouped by the cores and whole GB of memory they
+    reserve, and each group is packed first-fit decreasing by hours into
+    tasks of at most ``max_hours``. A participant longer than
+    ``max_hours`` gets a task of its own.
+
+    Parameters
+    ----------
+    reservations : sequence of tuple
+        ``(cores, memory_gb)`` of each participant
+
+    hours : sequence of float
+        estimated hours of each participant
+
+    max_hours : float
+        most summed hours of one task's participants
+
+    Returns
+    -------
+    list of ClusterTask
+        largest requests first
+
+    Examples
+    --------
+    >>> for task in pack_tasks([(1, 2), (1, 2), (1, 2), (2, 8)],
+    ...                        [3, 2, 1, 9], max_hours=4):
+    ...     print(task.participants, task.hours, task.request)
+    [3] 9 (2, 8)
+    [0, 2] 4 (1, 2)
+    [1] 2 (1, 2)
+    """
+    groups = {}
+    for participant, (cores, memory_gb) in enumerate(reservations):
+        groups.setdefault((cores, max(1, math.ceil(memory_gb))), []).append(
+            participant)
+    tasks = []
+    for request in sorted(groups, reverse=True):
+        group_tasks = []
+        for participant in sorted(groups[request],
+                                  key=lambda index: -hours[index]):
+            task = next((task for task in group_tasks if
+                         task.hours + hours[participant] <= max_hours), None)
+            if task is None:
+                task = ClusterTask(cores=request[0])
+                group_tasks.append(task)
+            task.participants.append(participant)
+            task.hours += hours[participant]
+            task.memory_gb = max(task.memory_gb,
+                                 reservations[participant][1])
+        tasks += group_tasks
+    return tasks
+
+
+def task_arrays(tasks: Sequence[ClusterTask]) -> List[List[ClusterTask]]:
+    """Group tasks with the same requests into job arrays
+
+    Examples
+    --------
+    >>> [[task.participants for task in array] for array in task_arrays([
+    ...     ClusterTask([0], 1, 1, 2), ClusterTask([1], 1, 2, 2),
+    ...     ClusterTask([2], 1, 1, 1.5)])]
+    [[[0], [2]], [[1]]]
+    """
+    arrays = {}
+    for task in tasks:
+        arrays.setdefault(task.request, []).append(task)
+    return list(arrays.values())
+
+
+def write_tasks(tasks_file: str, tasks: Sequence[ClusterTask],
+                config_file: str, subject_list_file: str,
+                p_name: Optional[str] = None) -> str:
+    """Write the tasks of a job array for ``run_cluster_task`` to read
+    and return the file's path"""
+    with open(tasks_file, 'w', encoding='utf-8') as task_file:
+        json.dump({'config_file': os.path.abspath(config_file),
+                   'subject_list_file': os.path.abspath(subject_list_file),
+                   'p_name': p_name,
+                   'tasks': [asdict(task) for task in tasks]}, task_file,
+                  indent=2)
+    return tasks_file
+
+
+def run_cluster_task(tasks_file: str, task_id: int,
+                     target: Optional[Callable] = None) -> int:
+    """Run a task's participants one after another, each within the
+    task's cores and memory.
+
+    Parameters
+    ----------
+    tasks_file : str
+        file written by ``write_tasks``
+
+    task_id : int
+        1-based index of the task, as the scheduler's array task ID
+
+    target : callable, optional
+        function to run each participant with, with the arguments of
+        ``CPAC.pipeline.cpac_pipeline.run_workflow``, which is the default
+
+    Returns
+    -------
+    int
+        1 if any participant failed, otherwise 0
+    """
+    # pylint: disable=import-outside-toplevel
+    from CPAC.utils.configuration import Configuration
+    if target is None:
+        from CPAC.pipeline.cpac_pipeline import run_workflow as target
+    with open(tasks_file, 'r', encoding='utf-8') as task_file:
+        tasks = json.load(task_file)
+    task = ClusterTask(**tasks['tasks'][int(task_id) - 1])
+    with open(tasks['config_file'], 'r', encoding='utf-8') as config_file:
+        c = Configuration(yaml.safe_load(config_file))
+    with open(tasks['subject_list_file'], 'r', encoding='utf-8'
+              ) as subject_list_file:
+        sublist = yaml.safe_load(subject_list_file)
+    c.pipeline_setup['system_config'].update({
+        'max_cores_per_participant': task.cores,
+        'maximum_memory_per_participant': task.memory_gb})
+    exitcode = 0
+    for participant in task.participants:
+        try:
+            # run_workflow updates nested configuration dicts in place
+            target(sublist[participant], deepcopy(c), True, None,
+                   tasks['p_name'], 'MultiProc')
+        except Exception as exception:  # pylint: disable=broad-except
+            print(f'Participant {participant + 1} of task {task_id} '
+                  f'failed: {exception}', file=sys.stderr)
+            exitcode = 1
+    return exitcode
+
+
+def _run_task_process(tasks_file, task_id, target=None):
+    sys.exit(run_cluster_task(tasks_file, task_id, target))
+
+
+class LocalScheduler:
+    """Process-backed stand-in for a cluster scheduler, which runs the
+    tasks of a tasks file in their own processes on this machine
+
+    Parameters
+    ----------
+    max_cores, max_memory_gb : float, optional
+        most cores and memory requested by running tasks at once
+
+    target : callable, optional
+        passed to ``run_cluster_task``
+    """
+    def __init__(self, max_cores: Optional[float] = None,
+                 max_memory_gb: Optional[float] = None,
+                 target: Optional[Callable] = None):
+        self.max_cores = max_cores
+        self.max_memory_gb = max_memory_gb
+        self.target = target
+
+    def submit(self, tasks_file: str) -> List[Job]:
+        """Run every task of a tasks file
+
+        Returns
+        -------
+        list of Job
+            each task's job, with its exit code
+        """
+        with open(tasks_file, 'r', encoding='utf-8') as task_file:
+            tasks = [ClusterTask(**task) for task in
+                     json.load(task_file)['tasks']]
+        return JobManager(max_cores=self.max_cores,
+                          max_memory_gb=self.max_memory_gb).run(
+            Job(f'task_{task_id}', _run_task_process,
+                (tasks_file, task_id, self.target), cores=task.cores,
+                memory_gb=task.request[1])
+            for task_id, task in enumerate(tasks, 1))
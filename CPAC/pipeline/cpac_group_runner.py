@@ -1089,7 +1089,7 @@ def run_feat(group_config_file, feat=True):
     import os
     import numpy as np
     import pandas as pd
-    from multiprocessing import Process
+    from CPAC.pipeline.job_manager import Job
     from CPAC.pipeline.cpac_ga_model_generator import create_dir
     from CPAC.utils.create_flame_model_files import create_flame_model_files
 
@@ -1216,20 +1216,20 @@ def run_feat(group_config_file, feat=True):
 
         if feat:
             from CPAC.group_analysis.group_analysis import run_feat_pipeline
-            procss.append(Process(target=run_feat_pipeline,
-                                  args=(c, models[id_tuple]['merged'],
-                                        models[id_tuple]['merged_mask'],
-                                        f_test, mat, con, grp, model_out_dir,
-                                        work_dir, log_dir, model_name, fts)))
+            procss.append(Job(model_name, run_feat_pipeline,
+                              args=(c, models[id_tuple]['merged'],
+                                    models[id_tuple]['merged_mask'],
+                                    f_test, mat, con, grp, model_out_dir,
+                                    work_dir, log_dir, model_name, fts)))
         else:
             from CPAC.randomise.randomise import prep_randomise_workflow
             model_out_dir = model_out_dir.replace('feat_results',
                                                   'randomise_results')
-            procss.append(Process(target=prep_randomise_workflow,
-                                  args=(c, models[id_tuple]['merged'],
-                                        models[id_tuple]['merged_mask'],
-                                        f_test, mat, con, grp, model_out_dir,
-                                        work_dir, log_dir, model_name, fts)))
+            procss.append(Job(model_name, prep_randomise_workflow,
+                              args=(c, models[id_tuple]['merged'],
+                                    models[id_tuple]['merged_mask'],
+                                    f_test, mat, con, grp, model_out_dir,
+                                    work_dir, log_dir, model_name, fts)))
 
     manage_processes(procss, out_dir, c["fsl_feat"]["num_models_at_once"])
 
@@ -2012,50 +2012,27 @@ def run_qpp(group_config_file):
 
 
 def manage_processes(procss, output_dir, num_parallel=1):
+    """Run group-level jobs in their own processes, ``num_parallel`` at
+    once, listing their PIDs in ``output_dir``/pid_group.txt
 
-    import os
+    Parameters
+    ----------
+    procss : list of CPAC.pipeline.job_manager.Job
 
-    # start kicking it off
-    pid = open(os.path.join(output_dir, 'pid_group.txt'), 'w')
+    output_dir : str
 
-    jobQueue = []
-    if len(procss) <= num_parallel:
-        """
-        Stream all the subjects as sublist is
-        less than or equal to the number of
-        subjects that need to run
-        """
-        for p in procss:
-            p.start()
-            print(p.pid, file=pid)
+    num_parallel : int
 
-    else:
-        """
-        Stream the subject workflows for preprocessing.
-        At Any time in the pipeline c.numSubjectsAtOnce
-        will run, unless the number remaining is less than
-        the value of the parameter stated above
-        """
-        idx = 0
-        while idx < len(procss):
-            if len(jobQueue) == 0 and idx == 0:
-                idc = idx
-                for p in procss[idc: idc + num_parallel]:
-                    p.start()
-                    print(p.pid, file=pid)
-                    jobQueue.append(p)
-                    idx += 1
-            else:
-                for job in jobQueue:
-                    if not job.is_alive():
-                        print('found dead job {0}'.format(job))
-                        loc = jobQueue.index(job)
-                        del jobQueue[loc]
-                        procss[idx].start()
-                        jobQueue.append(procss[idx])
-                        idx += 1
-
-    pid.close()
+    Returns
+    -------
+    list of CPAC.pipeline.job_manager.Job
+        ``procss``, with their exit codes
+    """
+    import os
+    from CPAC.pipeline.job_manager import JobManager
+
+    return JobManager(max_jobs=num_parallel, pid_file=os.path.join(
+        output_dir, 'pid_group.txt')).run(procss)
 
 
 def run(config_file):
@@ -14,6 +14,7 @@
 
 # You should have received a copy of the GNU Lesser General Public
 # License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+import glob
 import os
 import sys
 import time
@@ -192,7 +193,8 @@ from CPAC.sca.sca import (
 
 from CPAC.alff.alff import alff_falff, alff_falff_space_template
 from CPAC.reho.reho import reho, reho_space_template
-from CPAC.utils.serialization import save_workflow_json, WorkflowJSONMeta
+from CPAC.utils.serialization import cached_workflow, save_workflow_json, \
+    WorkflowJSONMeta
 
 from CPAC.vmhc.vmhc import (
     smooth_func_vmhc,
@@ -204,6 +206,8 @@ from CPAC.network_centrality.pipeline import (
     network_centrality
 )
 
+from CPAC.pipeline.memory_model import update_memory_model
+from CPAC.pipeline.plan import plan_workflow
 from CPAC.pipeline.random_state import set_up_random_state_logger
 from CPAC.pipeline.schema import valid_options
 from CPAC.utils.trimmer import the_trimmer
@@ -216,6 +220,7 @@ from CPAC.utils.monitoring import log_nodes_cb, log_nodes_initial, \
                                   LOGTAIL, set_up_logger, \
                                   WARNING_FREESURFER_OFF_WITH_DATA
 from CPAC.utils.monitoring.draw_gantt_chart import resource_report
+from CPAC.utils.monitoring.metrics import METRICS_FILENAME
 from CPAC.utils.utils import (
     check_config_resources,
     check_system_deps,
@@ -227,6 +232,34 @@ faulthandler.enable()
 # config.enable_debug_mode()
 
 
+class WorkflowRunError(RuntimeError):
+    """A participant's workflow was built but failed while running"""
+
+
+def _save_subject_info(log_dir, subject_id, subject_info):
+    """Dump subject info pickle file to subject log dir"""
+    subject_info_file = os.path.join(
+        log_dir, 'subject_info_%s.pkl' % subject_id
+    )
+    with open(subject_info_file, 'wb') as info:
+        pickle.dump(list(subject_info), info)
+
+
+def _packed_memory_budget(workflow, reserved_gb, maximum_gb):
+    """Memory budget (GB) of a participant packed by its estimated
+    memory: its reservation, raised to fit its workflow's largest node
+    estimate with the plugin's 1 GB overhead, up to ``maximum_gb``"""
+    largest = 0
+    # pylint: disable=protected-access
+    for node in workflow._get_all_nodes():
+        try:
+            estimate = node.mem_gb
+        except FileNotFoundError:
+            estimate = node._apply_mem_x(pe.UNDEFINED_SIZE)
+        largest = max(largest, estimate)
+    return min(max(reserved_gb, largest + 1), maximum_gb)
+
+
 def run_workflow(sub_dict, c, run, pipeline_timing_info=None, p_name=None,
                  plugin='MultiProc', plugin_args=None, test_config=False):
     '''
@@ -312,6 +345,28 @@ def run_workflow(sub_dict, c, run, pipeline_timing_info=None, p_name=None,
     plugin_args['raise_insufficient'] = c['pipeline_setup', 'system_config',
                                           'raise_insufficient']
     plugin_args['status_callback'] = log_nodes_cb
+    memory_model = c['pipeline_setup', 'system_config', 'observed_usage',
+                     'memory_model']
+    if memory_model['path']:
+        plugin_args['memory_model'] = memory_model
+    if c['pipeline_setup', 'system_config', 'critical_path_priority']:
+        plugin_args['critical_path'] = {'callback_logs': [
+            os.path.join(log_dir, 'callback.log'),
+            c['pipeline_setup', 'system_config', 'observed_usage',
+              'callback_log']]}
+    if c['pipeline_setup', 'system_config', 'live_memory', 'run']:
+        plugin_args['live_memory'] = c['pipeline_setup', 'system_config',
+                                       'live_memory']
+    if c['pipeline_setup', 'system_config', 'adaptive_threads']:
+        plugin_args['adaptive_threads'] = {'callback_logs': [
+            os.path.join(log_dir, 'callback.log'),
+            c['pipeline_setup', 'system_config', 'observed_usage',
+              'callback_log']]}
+    if c['pipeline_setup', 'system_config', 'scheduler_metrics', 'run']:
+        plugin_args['scheduler_metrics'] = {
+            'path': os.path.join(log_dir, METRICS_FILENAME),
+            'interval': c['pipeline_setup', 'system_config',
+                          'scheduler_metrics', 'interval']}
 
     # perhaps in future allow user to set threads maximum
     # this is for centrality mostly
@@ -441,9 +496,16 @@ def run_workflow(sub_dict, c, run, pipeline_timing_info=None, p_name=None,
         set_up_random_state_logger(log_dir)
 
     try:
-        workflow = build_workflow(
-            subject_id, sub_dict, c, p_name, num_ants_cores
-        )
+        if c['pipeline_setup', 'working_directory', 'cache_workflow']:
+            workflow = cached_workflow(
+                os.path.join(c.pipeline_setup['working_directory']['path'],
+                             'workflow_cache'),
+                c, sub_dict, lambda: build_workflow(
+                    subject_id, sub_dict, c, p_name, num_ants_cores))
+        else:
+            workflow = build_workflow(
+                subject_id, sub_dict, c, p_name, num_ants_cores
+            )
     except Exception as exception:
         logger.exception('Building workflow failed')
         raise exception
@@ -478,6 +540,17 @@ def run_workflow(sub_dict, c, run, pipeline_timing_info=None, p_name=None,
         logger.info('This has been a test of the pipeline configuration '
                     'file, the pipeline was built successfully, but was '
                     'not run')
+        plan = plan_workflow(
+            workflow, subject_id,
+            strategies=getattr(workflow, '_strategy_counts', None),
+            callback_logs=[os.path.join(log_dir, 'callback.log'),
+                           c['pipeline_setup', 'system_config',
+                             'observed_usage', 'callback_log']],
+            reference_output_dirs=glob.glob(os.path.join(
+                c.pipeline_setup['output_directory']['path'], p_name, '*')),
+            max_concurrent_nodes=num_cores_per_sub)
+        plan.save(os.path.join(log_dir, 'pipeline_plan.json'))
+        logger.info('%s', plan.report())
     else:
         working_dir = os.path.join(
             c.pipeline_setup['working_directory']['path'], workflow.name)
@@ -518,6 +591,18 @@ Please, make yourself aware of how it works and its assumptions:
                 s3_creds_path=input_creds_path,
             )
 
+        if not run:
+            return workflow
+
+        if plugin_args.get('maximum_memory_gb'):
+            budget = _packed_memory_budget(workflow, plugin_args['memory_gb'],
+                                           plugin_args['maximum_memory_gb'])
+            if budget > plugin_args['memory_gb']:
+                logger.info('Raising the memory budget of %s from %0.2f GB '
+                            'to %0.2f GB to fit its largest node',
+                            subject_id, plugin_args['memory_gb'], budget)
+                plugin_args['memory_gb'] = budget
+
         pipeline_start_datetime = strftime("%Y-%m-%d %H:%M:%S")
 
         try:
@@ -590,12 +675,7 @@ Please, make yourself aware of how it works and its assumptions:
 
             # Dump subject info pickle file to subject log dir
             subject_info['status'] = 'Completed'
-
-            subject_info_file = os.path.join(
-                log_dir, 'subject_info_%s.pkl' % subject_id
-            )
-            with open(subject_info_file, 'wb') as info:
-                pickle.dump(list(subject_info), info)
+            _save_subject_info(log_dir, subject_id, subject_info)
 
             # have this check in case the user runs cpac_runner from terminal and
             # the timing parameter list is not supplied as usual by the GUI
@@ -740,9 +820,11 @@ Please, make yourself aware of how it works and its assumptions:
                         'Unable to upload CPAC log files in: %s.\nError: %s')
                     logger.error(err_msg, log_dir, exc)
 
-        except Exception:
+        except Exception as exception:
             import traceback
             traceback.print_exc()
+            subject_info['status'] = 'Failed'
+            _save_subject_info(log_dir, subject_id, subject_info)
             execution_info = """
 
 Error of subject workflow {workflow}
@@ -756,6 +838,10 @@ CPAC run error:
     System time of start:      {run_start}
     {output_check}
 """
+            # let the caller (or the process's exit code) know that the
+            # workflow started and failed, rather than failed to start
+            raise WorkflowRunError(
+                f'{workflow.name} did not complete') from exception
 
         finally:
 
@@ -763,6 +849,12 @@ CPAC run error:
                 if os.path.exists(cb_log_filename):
                     resource_report(cb_log_filename,
                                     num_cores_per_sub, logger)
+                    if memory_model['path']:
+                        logger.info(
+                            'Added %d observations to memory model %s',
+                            update_memory_model(memory_model['path'],
+                                                [cb_log_filename]),
+                            memory_model['path'])
 
                 logger.info('%s', execution_info.format(
                     workflow=workflow.name,
@@ -804,6 +896,116 @@ CPAC run error:
                         )
 
 
+def run_cohort_workflows(sublist, c, p_name=None, plugin_args=None):
+    """Run every participant's workflow through one shared scheduler.
+
+    Instead of one process and one pool of ``max_cores_per_participant``
+    cores per participant, the prepared workflows' nodes are run by a
+    single plugin with the cores and memory of
+    ``num_participants_at_once`` participants, so nodes from any
+    participant fill whatever is free. Each participant gets a share of
+    one participant's cores and memory; it only uses more than its share
+    while no other participant has a node ready to run.
+
+    Parameters
+    ----------
+    sublist : list of dict
+        participant data configuration entries
+
+    c : Configuration
+
+    p_name : str, optional
+
+    plugin_args : dict, optional
+
+    Returns
+    -------
+    int
+        1 if any workflow failed to build or run, otherwise 0
+    """
+    from CPAC.utils.monitoring import failed_to_start
+    exitcode = 0
+    workflows = []
+    participants = []
+    for sub in sublist:
+        subject_id, pipeline_name, sub_log_dir = set_subject(sub, c, p_name)
+        try:
+            workflows.append(run_workflow(
+                sub, copy.deepcopy(c), False, p_name=p_name,
+                plugin_args=copy.deepcopy(plugin_args)))
+        except Exception as exception:  # pylint: disable=broad-except
+            exitcode = 1
+            failed_to_start(sub_log_dir, exception)
+            continue
+        participants.append((subject_id, sub_log_dir))
+    if not workflows:
+        return exitcode
+
+    system_config = c.pipeline_setup['system_config']
+    sub_mem_gb, num_cores_per_sub, _, _ = check_config_resources(c)
+    num_at_once = min(len(workflows),
+                      system_config['num_participants_at_once'])
+    plugin_args = dict(plugin_args or {})
+    plugin_args.update({
+        'memory_gb': sub_mem_gb * num_at_once,
+        'n_procs': num_cores_per_sub * num_at_once,
+        'raise_insufficient': system_config['raise_insufficient'],
+        'status_callback': log_nodes_cb,
+        'participant_share': {
+            'memory_gb': sub_mem_gb, 'n_procs': num_cores_per_sub,
+            'priority': system_config['shared_scheduler']['priority']}})
+    memory_model = system_config['observed_usage']['memory_model']
+    if memory_model['path']:
+        plugin_args['memory_model'] = memory_model
+
+    log_dir = os.path.join(c.pipeline_setup['log_directory']['path'],
+                           pipeline_name)
+    cb_log_filename = os.path.join(log_dir, 'callback.log')
+    if system_config['critical_path_priority']:
+        plugin_args['critical_path'] = {'callback_logs': [
+            cb_log_filename, system_config['observed_usage']['callback_log']]}
+    if system_config['live_memory']['run']:
+        plugin_args['live_memory'] = system_config['live_memory']
+    if system_config['adaptive_threads']:
+        plugin_args['adaptive_threads'] = {'callback_logs': [
+            cb_log_filename, system_config['observed_usage']['callback_log']]}
+    if system_config['scheduler_metrics']['run']:
+        plugin_args['scheduler_metrics'] = {
+            'path': os.path.join(log_dir, METRICS_FILENAME),
+            'interval': system_config['scheduler_metrics']['interval']}
+    os.makedirs(log_dir, exist_ok=True)
+    set_up_logger('callback', cb_log_filename, 'debug', log_dir, mock=True)
+    for workflow in workflows:
+        log_nodes_initial(workflow)
+    logger.info('Running %d participant workflows on one scheduler with %d '
+                'cores and %0.2f GB', len(workflows), plugin_args['n_procs'],
+                plugin_args['memory_gb'])
+    try:
+        pe.run_workflows(workflows, MultiProcPlugin(plugin_args))
+    except Exception:  # pylint: disable=broad-except
+        exitcode = 1
+        logger.exception('Shared-scheduler run did not complete cleanly')
+    finally:
+        if os.path.exists(cb_log_filename):
+            resource_report(cb_log_filename, plugin_args['n_procs'], logger)
+            if memory_model['path']:
+                logger.info('Added %d observations to memory model %s',
+                            update_memory_model(memory_model['path'],
+                                                [cb_log_filename]),
+                            memory_model['path'])
+        for workflow, (subject_id, sub_log_dir) in zip(workflows,
+                                                       participants):
+            logger.info('%s', check_outputs(
+                c.pipeline_setup['output_directory']['path'], sub_log_dir,
+                c.pipeline_setup['pipeline_name'], subject_id))
+            working_dir = os.path.join(workflow.base_dir, workflow.name)
+            if c.pipeline_setup['working_directory'][
+                    'remove_working_dir'] and os.path.exists(working_dir):
+                logger.info("Removing working dir: %s", working_dir)
+                shutil.rmtree(working_dir, ignore_errors=True)
+    return exitcode
+
+
 def initialize_nipype_wf(cfg, sub_data_dct, name=""):
 
     if name:
@@ -812,6 +1014,8 @@ def initialize_nipype_wf(cfg, sub_data_dct, name=""):
     workflow_name = f'cpac{name}_{sub_data_dct["subject_id"]}_{sub_data_dct["unique_id"]}'
     wf = pe.Workflow(name=workflow_name)
     wf.base_dir = cfg.pipeline_setup['working_directory']['path']
+    wf.merge_duplicates = cfg['pipeline_setup', 'system_config',
+                              'merge_duplicate_nodes']
     wf.config['execution'] = {
         'hash_method': 'timestamp',
         'crashdump_dir': os.path.abspath(cfg.pipeline_setup['log_directory'][
@@ -1391,8 +1595,8 @@ def build_workflow(subject_id, sub_dict, cfg, pipeline_name=None,
 
     # Extractions and Derivatives
     tse_atlases, sca_atlases = gather_extraction_maps(cfg)
-    cfg.timeseries_extraction['tse_atlases'] = tse_atlases
-    cfg.seed_based_correlation_analysis['sca_atlases'] = sca_atlases
+    cfg['timeseries_extraction', 'tse_atlases'] = tse_atlases
+    cfg['seed_based_correlation_analysis', 'sca_atlases'] = sca_atlases
 
     if not rpool.check_rpool('space-template_desc-Mean_timeseries') and \
                     'Avg' in tse_atlases:
@@ -1515,4 +1719,7 @@ def build_workflow(subject_id, sub_dict, cfg, pipeline_name=None,
     # Collect all pipeline variants and write to output directory
     rpool.gather_pipes(wf, cfg)
 
+    # for pipeline plans
+    wf._strategy_counts = rpool.strategy_counts()
+
     return wf
@@ -14,13 +14,16 @@ License for more details.
 
 You should have received a copy of the GNU Lesser General Public
 License along with C-PAC. If not, see <https://www.gnu.org/licenses/>."""
+import json
 import os
 import sys
 import warnings
-from multiprocessing import Process
+from concurrent.futures import as_completed, ProcessPoolExecutor
+from copy import deepcopy
 from time import strftime
 import yaml
 from voluptuous.error import Invalid
+from CPAC.pipeline.job_manager import Job, JobManager
 from CPAC.utils.configuration import check_pname, Configuration, set_subject
 from CPAC.utils.ga import track_run
 from CPAC.utils.monitoring import failed_to_start, log_nodes_cb
@@ -28,6 +31,11 @@ from CPAC.longitudinal_pipeline.longitudinal_workflow import \
     anat_longitudinal_wf
 from CPAC.utils.configuration.yaml_template import upgrade_pipeline_to_1_8
 
+DEFAULT_PARTICIPANT_HOURS = 8
+"""estimated hours of a participant without earlier observations"""
+PREBUILD_MEMORY_GB = 1
+"""estimated memory (GB) of building one participant's workflow"""
+
 
 # Run condor jobs
 def run_condor_jobs(c, config_file, subject_list_file, p_name):
@@ -35,6 +43,7 @@ def run_condor_jobs(c, config_file, subject_list_file, p_name):
     # Import packages
     import subprocess
     from time import strftime
+    from CPAC.pipeline.cluster import write_tasks
 
     try:
         sublist = yaml.safe_load(open(os.path.realpath(subject_list_file), 'r'))
@@ -43,6 +52,11 @@ def run_condor_jobs(c, config_file, subject_list_file, p_name):
 
     cluster_files_dir = os.path.join(os.getcwd(), 'cluster_files')
     subject_bash_file = os.path.join(cluster_files_dir, 'submit_%s.condor' % str(strftime("%Y_%m_%d_%H_%M_%S")))
+    tasks = cluster_tasks(sublist, c)
+    tasks_file = write_tasks(
+        os.path.join(cluster_files_dir,
+                     'tasks_%s.json' % str(strftime("%Y_%m_%d_%H_%M_%S"))),
+        tasks, config_file, subject_list_file, p_name)
     f = open(subject_bash_file, 'w')
 
     print("Executable = /usr/bin/python", file=f)
@@ -51,11 +65,14 @@ def run_condor_jobs(c, config_file, subject_list_file, p_name):
     print("getenv = True", file=f)
     print("log = %s" % os.path.join(cluster_files_dir, 'c-pac_%s.log' % str(strftime("%Y_%m_%d_%H_%M_%S"))), file=f)
 
-    for sidx in range(1,len(sublist)+1):
+    # Each task requests its own cores and memory
+    for sidx, task in enumerate(tasks, 1):
         print("error = %s" % os.path.join(cluster_files_dir, 'c-pac_%s.%s.err' % (str(strftime("%Y_%m_%d_%H_%M_%S")), str(sidx))), file=f)
         print("output = %s" % os.path.join(cluster_files_dir, 'c-pac_%s.%s.out' % (str(strftime("%Y_%m_%d_%H_%M_%S")), str(sidx))), file=f)
+        print("request_cpus = %d" % task.request[0], file=f)
+        print("request_memory = %d GB" % task.request[1], file=f)
 
-        print("arguments = \"-c 'import CPAC; CPAC.pipeline.cpac_pipeline.run( ''%s'',''%s'',''%s'',''%s'',''%s'',''%s'',''%s'')\'\"" % (str(config_file), subject_list_file, str(sidx), c.maskSpecificationFile, c.roiSpecificationFile, c.templateSpecificationFile, p_name), file=f)
+        print("arguments = \"-c 'import sys; from CPAC.pipeline.cluster import run_cluster_task; sys.exit(run_cluster_task(''%s'', %d))'\"" % (tasks_file, sidx), file=f)
         print("queue", file=f)
 
     f.close()
@@ -66,18 +83,25 @@ def run_condor_jobs(c, config_file, subject_list_file, p_name):
 
 # Create and run script for CPAC to run on cluster
 def run_cpac_on_cluster(config_file, subject_list_file,
-                        cluster_files_dir):
+                        cluster_files_dir, p_name=None):
     '''
-    Function to build a SLURM batch job submission script and
-    submit it to the scheduler via 'sbatch'
+    Function to build a batch job submission script for each job array
+    of participants' tasks and submit it to the scheduler, or to run
+    the tasks on this machine if the resource manager is 'local'
+
+    Returns
+    -------
+    exitcode : int
     '''
 
     # Import packages
     import subprocess
     import getpass
+    import math
     import re
     from time import strftime
-    from indi_schedulers import cluster_templates
+    from CPAC.pipeline.cluster import LocalScheduler, MEMORY_DIRECTIVES, \
+        task_arrays, write_tasks
 
     # Load in pipeline config
     try:
@@ -96,54 +120,51 @@ def run_cpac_on_cluster(config_file, subject_list_file,
     # Init variables
     timestamp = str(strftime("%Y_%m_%d_%H_%M_%S"))
     job_scheduler = pipeline_config.pipeline_setup['system_config']['on_grid']['resource_manager'].lower()
-
-    # For SLURM time limit constraints only, hh:mm:ss
-    hrs_limit = 8 * len(sublist)
-    time_limit = '%d:00:00' % hrs_limit
+    if p_name is None:
+        p_name = pipeline_config.pipeline_setup['pipeline_name']
 
     # Batch file variables
     shell = subprocess.getoutput('echo $SHELL')
     user_account = getpass.getuser()
-    num_subs = len(sublist)
-
-    # Run CPAC via python -c command
-    python_cpac_str = 'python -c "from CPAC.pipeline.cpac_pipeline import run; '\
-                      'run(\'%(config_file)s\', \'%(subject_list_file)s\', '\
-                      '%(env_arr_idx)s, \'%(pipeline_name)s\', '\
-                      'plugin=\'MultiProc\', plugin_args=%(plugin_args)s)"'
-
-    # Init plugin arguments
-    plugin_args = {
-        'n_procs': pipeline_config.pipeline_setup['system_config'][
-            'max_cores_per_participant'],
-        'memory_gb': pipeline_config.pipeline_setup['system_config'][
-            'maximum_memory_per_participant'],
-        'raise_insufficient': pipeline_config.pipeline_setup['system_config'][
-            'raise_insufficient'],
-        'status_callback': log_nodes_cb}
-
-    # Set up run command dictionary
-    run_cmd_dict = {'config_file': config_file,
-                    'subject_list_file': subject_list_file,
-                    'pipeline_name': pipeline_config.pipeline_setup[
-                        'pipeline_name'],
-                    'plugin_args': plugin_args}
+
+    # Run each task's participants via python -c command
+    python_cpac_str = 'python -c "import sys; '\
+                      'from CPAC.pipeline.cluster import run_cluster_task; '\
+                      'sys.exit(run_cluster_task(\'%(tasks_file)s\', '\
+                      '%(env_arr_idx)s))"'
+
+    # Divide participants into tasks, and tasks with the same requests
+    # into job arrays
+    tasks = cluster_tasks(sublist, pipeline_config)
+    arrays = task_arrays(tasks)
+
+    # Run the tasks on this machine in place of a scheduler
+    if job_scheduler == 'local':
+        system_config = pipeline_config.pipeline_setup['system_config']
+        scheduler = LocalScheduler(
+            max_cores=system_config['num_participants_at_once'] *
+            system_config['max_cores_per_participant'],
+            max_memory_gb=system_config['num_participants_at_once'] *
+            system_config['maximum_memory_per_participant'])
+        jobs = [job for array_idx, array in enumerate(arrays) for
+                job in scheduler.submit(write_tasks(
+                    os.path.join(cluster_files_dir, 'cpac_tasks_%s.%d.json'
+                                 % (timestamp, array_idx)), array,
+                    config_file, subject_list_file, p_name))]
+        return int(any(job.failed for job in jobs))
+    from indi_schedulers import cluster_templates
 
     # Set up config dictionary
     config_dict = {'timestamp': timestamp,
                    'shell': shell,
                    'job_name': 'CPAC_' + pipeline_config.pipeline_setup[
                        'pipeline_name'],
-                   'num_tasks': num_subs,
                    'queue': pipeline_config.pipeline_setup['system_config'][
                        'on_grid']['SGE']['queue'],
                    'par_env': pipeline_config.pipeline_setup['system_config'][
                        'on_grid']['SGE']['parallel_environment'],
-                   'cores_per_task': pipeline_config.pipeline_setup[
-                       'system_config']['max_cores_per_participant'],
                    'user': user_account,
-                   'work_dir': cluster_files_dir,
-                   'time_limit': time_limit}
+                   'work_dir': cluster_files_dir}
 
     # Get string template for job scheduler
     if job_scheduler == 'pbs':
@@ -162,33 +183,389 @@ def run_cpac_on_cluster(config_file, subject_list_file,
         confirm_str = '(?<=Submitted batch job )\d+'
         exec_cmd = 'sbatch'
 
-    # Populate rest of dictionary
-    config_dict['env_arr_idx'] = env_arr_idx
-    run_cmd_dict['env_arr_idx'] = env_arr_idx
-    config_dict['run_cmd'] = python_cpac_str % run_cmd_dict
-
-    # Populate string from config dict values
-    batch_file_contents = batch_file_contents % config_dict
-    # Write file
-    batch_filepath = os.path.join(cluster_files_dir, 'cpac_submit_%s.%s' \
-                                  % (timestamp, job_scheduler))
-    with open(batch_filepath, 'w') as f:
-        f.write(batch_file_contents)
-
-    # Get output response from job submission
-    out = subprocess.getoutput('%s %s' % (exec_cmd, batch_filepath))
-
-    # Check for successful qsub submission
-    if re.search(confirm_str, out) == None:
-        err_msg = 'Error submitting C-PAC pipeline run to %s queue' \
-                  % job_scheduler
-        raise Exception(err_msg)
-
-    # Get pid and send to pid file
-    pid = re.search(confirm_str, out).group(0)
+    # Request each packed array's memory after the template's shebang line
+    if pipeline_config['pipeline_setup', 'system_config', 'on_grid',
+                       'pack_tasks', 'run']:
+        shebang, _, directives = batch_file_contents.partition('\n')
+        batch_file_contents = '\n'.join([
+            shebang, MEMORY_DIRECTIVES[job_scheduler], directives])
+
+    # Submit each job array
+    pids = []
+    for array_idx, array in enumerate(arrays):
+        cores, memory_gb = array[0].request
+        tasks_file = write_tasks(
+            os.path.join(cluster_files_dir, 'cpac_tasks_%s.%d.json'
+                         % (timestamp, array_idx)), array, config_file,
+            subject_list_file, p_name)
+
+        # Populate rest of dictionary
+        config_dict.update({
+            'num_tasks': len(array),
+            'cores_per_task': cores,
+            'memory_gb': memory_gb,
+            'memory_mb_per_core': math.ceil(memory_gb * 1024 / cores),
+            # For SLURM time limit constraints only, hh:mm:ss
+            'time_limit': '%d:00:00' % math.ceil(max(
+                task.hours for task in array)),
+            'env_arr_idx': env_arr_idx,
+            'run_cmd': python_cpac_str % {'tasks_file': tasks_file,
+                                          'env_arr_idx': env_arr_idx}})
+
+        # Write file
+        batch_filepath = os.path.join(cluster_files_dir,
+                                      'cpac_submit_%s.%d.%s' % (
+                                          timestamp, array_idx,
+                                          job_scheduler))
+        with open(batch_filepath, 'w') as f:
+            f.write(batch_file_contents % config_dict)
+
+        # Get output response from job submission
+        out = subprocess.getoutput('%s %s' % (exec_cmd, batch_filepath))
+
+        # Check for successful qsub submission
+        if re.search(confirm_str, out) == None:
+            err_msg = 'Error submitting C-PAC pipeline run to %s queue' \
+                      % job_scheduler
+            raise Exception(err_msg)
+        pids.append(re.search(confirm_str, out).group(0))
+
+    # Send pids to pid file
     pid_file = os.path.join(cluster_files_dir, 'pid.txt')
     with open(pid_file, 'w') as f:
-        f.write(pid)
+        f.write('\n'.join(pids))
+    return 0
+
+
+def _prebuild_workflow(sub, c, p_name, plugin, plugin_args):
+    """Build and cache one participant's workflow without running it"""
+    from CPAC.pipeline.cpac_pipeline import run_workflow
+    # run_workflow updates nested Configuration dicts in place, and pool
+    # workers are reused across participants. With ``run=False`` it
+    # returns the built workflow, without the planning that
+    # ``test_config`` does
+    run_workflow(sub, deepcopy(c), False, p_name=p_name, plugin=plugin,
+                 plugin_args=deepcopy(plugin_args))
+
+
+def _prebuild_workers(num_workflows, c):
+    """Number of workflows to build at once: at most one per core and
+    one per ``PREBUILD_MEMORY_GB`` of ``num_participants_at_once``
+    participants' cores and memory"""
+    from CPAC.utils.utils import check_config_resources
+    sub_mem_gb, num_cores_per_sub, _, _ = check_config_resources(c)
+    participants = c['pipeline_setup', 'system_config',
+                     'num_participants_at_once']
+    return max(1, min(num_workflows,
+                      participants * int(num_cores_per_sub),
+                      int(participants * sub_mem_gb // PREBUILD_MEMORY_GB)))
+
+
+def prebuild_workflows(sublist, c, p_name, plugin=None, plugin_args=None):
+    """Build every participant's workflow in a process pool and store it
+    in the workflow build cache, so participant runs load their workflows
+    instead of building them.
+
+    Parameters
+    ----------
+    sublist : list of dict
+        participant data configuration entries
+
+    c : CPAC.utils.configuration.Configuration
+
+    p_name : str
+        pipeline name string
+
+    plugin : str, optional
+
+    plugin_args : dict, optional
+
+    Returns
+    -------
+    built : list of dict
+        entries of ``sublist`` whose workflows built
+
+    exitcode : int
+        1 if any workflow failed to build, otherwise 0
+    """
+    c.pipeline_setup['working_directory']['cache_workflow'] = True
+    max_workers = _prebuild_workers(len(sublist), c)
+    failed = []
+    print(f'Building {len(sublist)} participant workflows '
+          f'({max_workers} at once)')
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_prebuild_workflow, sub, c, p_name,
+                                   plugin, plugin_args): i for
+                   i, sub in enumerate(sublist)}
+        for done, future in enumerate(as_completed(futures), 1):
+            subject_id, _, log_dir = set_subject(sublist[futures[future]], c)
+            try:
+                future.result()
+                print(f'[{done}/{len(sublist)}] Built workflow for '
+                      f'{subject_id}')
+            # pylint: disable=broad-except
+            except Exception as exception:
+                failed.append(futures[future])
+                print(f'[{done}/{len(sublist)}] Failed to build workflow '
+                      f'for {subject_id}: {exception}', file=sys.stderr)
+                failed_to_start(log_dir, exception)
+    if failed:
+        print(f'{len(failed)} of {len(sublist)} participant workflows failed '
+              'to build:\n' + '\n'.join(
+                  f'    {set_subject(sublist[i], c)[0]}' for
+                  i in sorted(failed)), file=sys.stderr)
+    return [sub for i, sub in enumerate(sublist) if i not in failed
+            ], int(bool(failed))
+
+
+def pack_participants(jobs, c, manager):
+    """Give each participant's job its own core and memory reservation
+    and budget, and bound the job manager by the cores and memory of
+    ``num_participants_at_once`` participants instead of a number of
+    participants, so that more small participants and fewer large ones
+    run at once.
+
+    Parameters
+    ----------
+    jobs : list of CPAC.pipeline.job_manager.Job
+        participant jobs, whose first argument is the participant's data
+        configuration entry and second the pipeline configuration; each
+        job's configuration is replaced with a copy with its budget
+
+    c : CPAC.utils.configuration.Configuration
+
+    manager : CPAC.pipeline.job_manager.JobManager
+
+    Notes
+    -----
+    Reservations only cover node types in the memory model. A
+    participant whose built workflow has a larger node estimate runs
+    with its budget raised to fit that node, up to
+    ``maximum_memory_per_participant``.
+    """
+    from CPAC.utils.utils import check_config_resources
+    sub_mem_gb, num_cores_per_sub, _, _ = check_config_resources(c)
+    participants = c['pipeline_setup', 'system_config',
+                     'num_participants_at_once']
+    manager.max_jobs = None
+    manager.max_cores = participants * max(1, int(num_cores_per_sub))
+    manager.max_memory_gb = participants * sub_mem_gb
+    for job, (cores, memory_gb) in zip(jobs, participant_reservations(
+            [job.args[0] for job in jobs], c)):
+        job.cores, job.memory_gb = cores, memory_gb
+        job_config = deepcopy(job.args[1])
+        job_config.pipeline_setup['system_config'].update({
+            'max_cores_per_participant': cores,
+            'maximum_memory_per_participant': memory_gb})
+        # run_workflow's arguments
+        sub, _, run, timing, p_name, plugin, plugin_args, *rest = job.args
+        job.args = (sub, job_config, run, timing, p_name, plugin,
+                    {**(plugin_args or {}), 'maximum_memory_gb': sub_mem_gb},
+                    *rest)
+    print(f'Packing {len(jobs)} participants into {manager.max_cores} cores '
+          f'and {manager.max_memory_gb:.2f} GB:\n' + '\n'.join(
+              f'    {job.name}: {job.cores} cores, {job.memory_gb:.2f} GB'
+              for job in jobs))
+
+
+def _image_size(path):
+    """Voxels × TRs of a local image, or None if it can't be read"""
+    from CPAC.pipeline.nipype_pipeline_engine import get_data_size
+    if not isinstance(path, str) or '://' in path or not os.path.isfile(path):
+        return None
+    try:
+        return get_data_size(path)
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+
+def _participant_images(sub):
+    """Functional scans and anatomical NIfTI images of a participant's
+    data configuration entry"""
+    func = [scan.get('scan') if isinstance(scan, dict) else scan for
+            scan in (sub.get('func') or {}).values()]
+    anat = sub.get('anat')
+    anat = list(anat.values()) if isinstance(anat, dict) else [anat]
+    anat = [path for path in anat if isinstance(path, str) and
+            path.endswith(('.nii', '.nii.gz'))]
+    return func, anat
+
+
+def participant_reservations(sublist, c):
+    """Estimate the cores and peak memory each participant needs, so that
+    participants can be packed onto the cores and memory of
+    ``num_participants_at_once`` participants.
+
+    A participant reserves a core per functional scan plus one, up to
+    ``max_cores_per_participant`` and at least the ANTs and OpenMP
+    threads. With a memory model (``observed_usage: memory_model``), a
+    participant reserves the summed estimates of as many of the most
+    memory-hungry node types as it has cores, at the size of its
+    largest image, plus 1 GB for Nipype, up to
+    ``maximum_memory_per_participant``; otherwise, or if an image can't
+    be read, it reserves ``maximum_memory_per_participant``.
+
+    Parameters
+    ----------
+    sublist : list of dict
+        participant data configuration entries
+
+    c : CPAC.utils.configuration.Configuration
+
+    Returns
+    -------
+    list of tuple
+        ``(cores, memory_gb)`` of each participant
+    """
+    from CPAC.pipeline.memory_model import MemoryModel
+    from CPAC.utils.utils import check_config_resources
+    (sub_mem_gb, num_cores_per_sub, num_ants_cores, num_omp_cores
+     ) = check_config_resources(c)
+    num_cores_per_sub = max(1, int(num_cores_per_sub))
+    memory_model = c['pipeline_setup', 'system_config', 'observed_usage',
+                     'memory_model']
+    model = MemoryModel(memory_model['path'], memory_model['margin']) if (
+        memory_model['path'] and os.path.exists(memory_model['path'])
+    ) else None
+    reservations = []
+    for sub in sublist:
+        func, anat = _participant_images(sub)
+        cores = min(num_cores_per_sub, max(num_ants_cores, num_omp_cores,
+                                           len(func) + 1))
+        sizes = [_image_size(path) for path in func + anat]
+        memory_gb = None
+        if model is not None and sizes and None not in sizes:
+            memory_gb = model.peak_estimate(max(sizes), cores)
+        memory_gb = sub_mem_gb if memory_gb is None else min(
+            memory_gb + 1, sub_mem_gb)
+        if c['network_centrality', 'run']:
+            memory_gb = max(memory_gb, c['network_centrality',
+                                         'memory_allocation'])
+        reservations.append((cores, memory_gb))
+    return reservations
+
+
+def participant_hours(sublist, c, reservations):
+    """Estimate the hours each participant will take to run, so that
+    participants can be packed into cluster tasks.
+
+    A participant takes the median CPU-hours of the participants in
+    ``observed_usage: callback_log``, scaled by the size of its images
+    relative to the median participant's, and multiplied by
+    ``on_grid: pack_tasks: margin``. The CPU-hours are divided by its
+    reserved cores, but by no more than the median parallelism
+    (CPU-hours per wall-clock hour) the observed participants reached,
+    as workflows don't keep every core busy throughout. Without
+    observations, each participant is estimated to take
+    ``DEFAULT_PARTICIPANT_HOURS``.
+
+    Parameters
+    ----------
+    sublist : list of dict
+        participant data configuration entries
+
+    c : CPAC.utils.configuration.Configuration
+
+    reservations : list of tuple
+        ``(cores, memory_gb)`` of each participant, as from
+        ``participant_reservations``
+
+    Returns
+    -------
+    list of float
+        estimated hours of each participant
+    """
+    from statistics import median
+    from CPAC.pipeline.plan import load_participant_hours
+    observed = load_participant_hours([c['pipeline_setup', 'system_config',
+                                         'observed_usage', 'callback_log']])
+    if not observed:
+        return [DEFAULT_PARTICIPANT_HOURS] * len(sublist)
+    cpu_hours = median(hours.cpu_hours for hours in observed.values())
+    parallelism = median(hours.cpu_hours / hours.hours if hours.hours else
+                         1 for hours in observed.values()) or 1
+    sizes = []
+    for sub in sublist:
+        images = [_image_size(path) for path in sum(
+            _participant_images(sub), [])]
+        sizes.append(sum(images) if images and None not in images else
+                     None)
+    known = [size for size in sizes if size]
+    median_size = median(known) if known else None
+    margin = c['pipeline_setup', 'system_config', 'on_grid', 'pack_tasks',
+               'margin']
+    return [cpu_hours * (size / median_size if size and median_size else 1) /
+            min(cores, parallelism) * margin for
+            size, (cores, _) in zip(sizes, reservations)]
+
+
+def cluster_tasks(sublist, c):
+    """Divide participants into cluster tasks.
+
+    With ``on_grid: pack_tasks`` on, participants are packed into tasks
+    by their estimated cores, memory and hours; otherwise each
+    participant is a task requesting the configured cores and memory
+    per participant.
+
+    Parameters
+    ----------
+    sublist : list of dict
+        participant data configuration entries
+
+    c : CPAC.utils.configuration.Configuration
+
+    Returns
+    -------
+    list of CPAC.pipeline.cluster.ClusterTask
+    """
+    from CPAC.pipeline.cluster import ClusterTask, pack_tasks
+    pack = c['pipeline_setup', 'system_config', 'on_grid', 'pack_tasks']
+    if not pack['run']:
+        system_config = c.pipeline_setup['system_config']
+        return [ClusterTask([participant],
+                            DEFAULT_PARTICIPANT_HOURS * len(sublist),
+                            system_config['max_cores_per_participant'],
+                            system_config['maximum_memory_per_participant'])
+                for participant in range(len(sublist))]
+    reservations = participant_reservations(sublist, c)
+    return pack_tasks(reservations,
+                      participant_hours(sublist, c, reservations),
+                      pack['max_hours'])
+
+
+def report_cohort_plan(sublist, c, p_name):
+    """Print the totals of the pipeline plans written by participants'
+    ``test_config`` runs and save them beside the participants' logs.
+
+    Parameters
+    ----------
+    sublist : list of dict
+
+    c : CPAC.utils.configuration.Configuration
+
+    p_name : str
+        pipeline name string
+
+    Returns
+    -------
+    dict or None
+        cohort totals, or None if no participant wrote a plan
+    """
+    from CPAC.pipeline.plan import cohort_plan, PipelinePlan
+    plan_files = [os.path.join(set_subject(sub, c, p_name)[2],
+                               'pipeline_plan.json') for sub in sublist]
+    plans = [PipelinePlan.load(plan_file) for plan_file in plan_files if
+             os.path.exists(plan_file)]
+    if not plans:
+        return None
+    totals = cohort_plan(plans)
+    with open(os.path.join(c.pipeline_setup['log_directory']['path'],
+                           p_name, 'cohort_plan.json'), 'w',
+              encoding='utf-8') as plan_file:
+        json.dump(totals, plan_file, indent=2)
+    print('Cohort plan:\n' + '\n'.join(f'    {key}: {value}' for
+                                         key, value in totals.items()))
+    return totals
 
 
 def run_T1w_longitudinal(sublist, cfg):
@@ -228,9 +605,9 @@ def run(subject_list_file, config_file=None, p_name=None, plugin=None,
 
     # Import packages
     import os
-    import time
 
-    from CPAC.pipeline.cpac_pipeline import run_workflow
+    from CPAC.pipeline.cpac_pipeline import run_cohort_workflows, \
+        run_workflow, WorkflowRunError
 
     print('Run called with config file {0}'.format(config_file))
 
@@ -394,7 +771,8 @@ def run(subject_list_file, config_file=None, p_name=None, plugin=None,
             run_condor_jobs(c, config_file, subject_list_file, p_name)
         # All other schedulers are supported
         else:
-            run_cpac_on_cluster(config_file, subject_list_file, cluster_files_dir)
+            exitcode = run_cpac_on_cluster(config_file, subject_list_file,
+                                           cluster_files_dir, p_name)
 
     # Run on one computer
     else:
@@ -573,97 +951,61 @@ def run(subject_list_file, config_file=None, p_name=None, plugin=None,
         '''
         # END LONGITUDINAL TEMPLATE PIPELINE
 
+        if c['pipeline_setup', 'system_config', 'prebuild_workflows']:
+            sublist, exitcode = prebuild_workflows(sublist, c, p_name, plugin,
+                                                   plugin_args)
+            if exitcode and c['pipeline_setup', 'system_config',
+                              'fail_fast']:
+                return exitcode
+
+        # Run every participant's nodes through one scheduler
+        if c['pipeline_setup', 'system_config', 'shared_scheduler',
+             'run'] and not test_config:
+            return run_cohort_workflows(sublist, c, p_name,
+                                        plugin_args) or exitcode
+
         # If it only allows one, run it linearly
         if c.pipeline_setup['system_config']['num_participants_at_once'] == 1:
             for sub in sublist:
                 try:
-                    run_workflow(sub, c, True, pipeline_timing_info,
+                    # each participant gets its own copy, as in a Process
+                    run_workflow(sub, deepcopy(c), True, pipeline_timing_info,
                                  p_name, plugin, plugin_args, test_config)
+                except WorkflowRunError:
+                    # already logged with the run's timing and outputs
+                    exitcode = 1
                 except Exception as exception:  # pylint: disable=broad-except
                     exitcode = 1
                     failed_to_start(set_subject(sub, c)[2], exception)
+            if test_config:
+                report_cohort_plan(sublist, c, p_name)
             return exitcode
 
-        # Init job queue
-        job_queue = []
-
-        # Allocate processes
-        processes = [Process(target=run_workflow,
-                             args=(sub, c, True, pipeline_timing_info, p_name,
-                                   plugin, plugin_args, test_config)) for
-                     sub in sublist]
         working_dir = os.path.join(c['pipeline_setup', 'working_directory',
                                      'path'], p_name)
         # Create pipeline-specific working dir if not exists
         if not os.path.exists(working_dir):
             os.makedirs(working_dir)
-        # Set PID context to pipeline-specific file
-        with open(os.path.join(working_dir, 'pid.txt'), 'w', encoding='utf-8'
-                  ) as pid:
-            # If we're allocating more processes than are subjects, run
-            # them all
-            if len(sublist) <= c.pipeline_setup['system_config'][
-                    'num_participants_at_once']:
-                for i, _p in enumerate(processes):
-                    try:
-                        _p.start()
-                        print(_p.pid, file=pid)
-                    # pylint: disable=broad-except
-                    except Exception as exception:
-                        exitcode = 1
-                        failed_to_start(set_subject(sublist[i], c)[2],
-                                        exception)
-            # Otherwise manage resources to run processes incrementally
-            else:
-                idx = 0
-                while idx < len(sublist):
-                    # If the job queue is empty and we haven't started indexing
-                    if len(job_queue) == 0 and idx == 0:
-                        # Init subject process index
-                        idc = idx
-                        # Launch processes (one for each subject)
-                        for _p in processes[idc: idc + c.pipeline_setup[
-                                'system_config']['num_participants_at_once']]:
-                            try:
-                                _p.start()
-                                print(_p.pid, file=pid)
-                                job_queue.append(_p)
-                                idx += 1
-                            # pylint: disable=broad-except
-                            except Exception as exception:
-                                exitcode = 1
-                                failed_to_start(set_subject(sublist[idx],
-                                                            c)[2], exception)
-                    # Otherwise, jobs are running - check them
-                    else:
-                        # Check every job in the queue's status
-                        for job in job_queue:
-                            # If the job is not alive
-                            if not job.is_alive():
-                                # Find job and delete it from queue
-                                print('found dead job ', job)
-                                loc = job_queue.index(job)
-                                del job_queue[loc]
-                                # ...and start the next available
-                                # process (subject)
-                                try:
-                                    processes[idx].start()
-                                    # Append this to job queue and
-                                    # increment index
-                                    # pylint: disable=modified-iterating-list
-                                    job_queue.append(processes[idx])
-                                    idx += 1
-                                # pylint: disable=broad-except
-                                except Exception as exception:
-                                    exitcode = 1
-                                    failed_to_start(set_subject(sublist[idx],
-                                                                c)[2],
-                                                    exception)
-                        # Add sleep so while loop isn't consuming 100% of CPU
-                        time.sleep(2)
-            # set exitcode to 1 if any exception
-            if hasattr(pid, 'exitcode'):
-                exitcode = exitcode or pid.exitcode
-            # Close PID txt file to indicate finish
-            pid.close()
+        system_config = c.pipeline_setup['system_config']
+        manager = JobManager(
+            max_jobs=system_config['num_participants_at_once'],
+            retries=system_config['participant_retries']['max_retries'],
+            backoff=system_config['participant_retries']['backoff'],
+            pid_file=os.path.join(working_dir, 'pid.txt'),
+            on_error=lambda job, exception: failed_to_start(
+                set_subject(job.args[0], c)[2], exception))
+        jobs = [Job(set_subject(sub, c)[0], run_workflow,
+                    (sub, c, True, pipeline_timing_info, p_name, plugin,
+                     plugin_args, test_config)) for sub in sublist]
+        if system_config['pack_participants']:
+            pack_participants(jobs, c, manager)
+        # Run participants in their own processes, starting the next as
+        # soon as one finishes, and list their PIDs in a
+        # pipeline-specific file
+        jobs = manager.run(jobs)
+        # set exitcode to 1 if any participant failed
+        if any(job.failed for job in jobs):
+            exitcode = 1
+        if test_config:
+            report_cohort_plan(sublist, c, p_name)
     return exitcode
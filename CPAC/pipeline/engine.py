@@ -16,12 +16,12 @@
 # License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
 import ast
 import copy
-from itertools import chain
+from itertools import product
 import logging
 import os
 import re
 from types import FunctionType
-from typing import Tuple, Union
+from typing import NamedTuple, Tuple, Union
 import warnings
 
 from CPAC.pipeline import \
@@ -37,6 +37,7 @@ from CPAC.pipeline.check_outputs import ExpectedOutputs
 from CPAC.pipeline.utils import source_set
 from CPAC.registration.registration import transform_derivative
 from CPAC.utils.bids_utils import insert_entity, res_in_filename
+from CPAC.utils.copy_on_write import CopyOnWriteDict
 from CPAC.utils.datasource import (
     create_anat_datasource,
     create_func_datasource,
@@ -44,14 +45,15 @@ from CPAC.utils.datasource import (
     create_general_datasource,
     resolve_resolution
 )
-from CPAC.utils.docs import grab_docstring_dct
+from CPAC.utils.docs import grab_docstring_dct, node_block_descriptor
 from CPAC.utils.interfaces.function import Function
 from CPAC.utils.interfaces.datasink import DataSink
 from CPAC.utils.monitoring import getLogger, LOGTAIL, \
                                   WARNING_FREESURFER_OFF_WITH_DATA
 from CPAC.utils.outputs import Outputs
+from CPAC.utils.provenance import Provenance
 from CPAC.utils.utils import check_prov_for_regtool, \
-    create_id_string, get_last_prov_entry, read_json, write_output_json
+    create_id_string, read_json, write_output_json
 
 from CPAC.resources.templates.lookup_table import lookup_identifier
 
@@ -59,6 +61,124 @@ logger = getLogger('nipype.workflow')
 verbose_logger = logging.getLogger('engine')
 
 
+class _StratOption(NamedTuple):
+    """One resource pool entry as an input option in ``get_strats``"""
+    prov: Provenance
+    resource: str
+    resource_strat_dct: dict
+
+
+def _variant_strat(json_info, spread):
+    """The variants a strategy took, plus ``NO-`` entries for each
+    variant of its resource that it did not take"""
+    strat = [val[0] if isinstance(val, list) else val for
+             val in json_info.get('CpacVariant', {}).values()]
+    strat += [f'NO-{label}' for label in spread if
+              'NO-' not in label and label not in strat]
+    return strat
+
+
+def _variants_compatible(current_strat, other_strat, current_spread,
+                         other_spread):
+    """Whether two linked inputs' strategies agree on every variant both
+    inputs' resources can take"""
+    for variant in current_spread:
+        if variant not in other_spread:
+            continue
+        in_current_strat = variant is None or variant in current_strat
+        in_other_strat = (variant is None and None in other_spread) or \
+            variant in other_strat
+        if in_current_strat != in_other_strat:
+            return False
+    return True
+
+
+def _combine_strats(total_pool, linked_resources, variant_pool):
+    """Combine one strategy option per input, in ``itertools.product``
+    order, dropping combinations whose linked inputs took incompatible
+    variants.
+
+    Parameters
+    ----------
+    total_pool : list of lists of _StratOption
+        deduplicated options for each input
+
+    linked_resources : list of lists of str
+        groups of inputs that have to come from compatible strategies
+
+    variant_pool : dict
+        ``{resource: set of variants}``
+
+    Returns
+    -------
+    list of tuples of _StratOption
+    """
+    strat_cache = {}
+    compatible_cache = {}
+
+    def compatible(xlabel, xoption, ylabel, yoption):
+        key = (xlabel, xoption.prov, ylabel, yoption.prov)
+        if key not in compatible_cache:
+            for label, option in ((xlabel, xoption), (ylabel, yoption)):
+                if (label, option.prov) not in strat_cache:
+                    strat_cache[(label, option.prov)] = _variant_strat(
+                        option.resource_strat_dct['json'],
+                        variant_pool[label])
+            compatible_cache[key] = _variants_compatible(
+                strat_cache[(xlabel, xoption.prov)],
+                strat_cache[(ylabel, yoption.prov)],
+                variant_pool[xlabel], variant_pool[ylabel])
+        return compatible_cache[key]
+
+    pairs = [(xlabel, ylabel) for linked in linked_resources for
+             xlabel in linked for ylabel in linked if xlabel != ylabel]
+    if not pairs:
+        return list(product(*total_pool))
+
+    # each linked label is read from the last input producing it
+    positions = {}
+    for position, options in enumerate(total_pool):
+        resources = {option.resource for option in options}
+        if len(resources) > 1:
+            positions = None
+            break
+        positions[resources.pop()] = position
+    if positions is None or not all(
+            label in positions for pair in pairs for label in pair):
+        # inputs without a single resource each: check every combination
+        return [strat_tuple for strat_tuple in product(*total_pool) if
+                all(compatible(xlabel, options[xlabel], ylabel,
+                               options[ylabel]) for
+                    options in [{option.resource: option for
+                                 option in strat_tuple}] for
+                    xlabel, ylabel in pairs)]
+
+    # check each linked pair as soon as both its inputs are chosen, so
+    # incompatible branches of the product are never expanded
+    checks = {}
+    for xlabel, ylabel in pairs:
+        checks.setdefault(max(positions[xlabel], positions[ylabel]), []
+                          ).append((positions[xlabel], xlabel,
+                                    positions[ylabel], ylabel))
+    chosen = [None] * len(total_pool)
+    strat_lists = []
+
+    def expand(position):
+        for option in total_pool[position]:
+            chosen[position] = option
+            if all(compatible(xlabel, chosen[xposition], ylabel,
+                              chosen[yposition]) for
+                   xposition, xlabel, yposition, ylabel in
+                   checks.get(position, [])):
+                if position + 1 < len(total_pool):
+                    expand(position + 1)
+                else:
+                    strat_lists.append(tuple(chosen))
+
+    expand(0)
+    return strat_lists
+
+
 class ResourcePool:
     def __init__(self, rpool=None, name=None, cfg=None, pipe_list=None):
 
@@ -239,14 +359,15 @@ class ResourcePool:
 
     def set_data(self, resource, node, output, json_info, pipe_idx, node_name,
                  fork=False, inject=False):
-        json_info = json_info.copy()
+        json_info = CopyOnWriteDict(json_info)
         cpac_prov = []
         if 'CpacProvenance' in json_info:
             cpac_prov = json_info['CpacProvenance']
-        current_prov_list = list(cpac_prov)
-        new_prov_list = list(cpac_prov)   # <---- making a copy, it was already a list
+        current_prov_list = Provenance(cpac_prov)
+        new_prov_list = current_prov_list
         if not inject:
-            new_prov_list.append(f'{resource}:{node_name}')
+            new_prov_list = Provenance([*current_prov_list,
+                                        f'{resource}:{node_name}'])
         try:
             res, new_pipe_idx = self.generate_prov_string(new_prov_list)
         except IndexError:
@@ -254,7 +375,7 @@ class ResourcePool:
                              'provenance information and should not be an '
                              'injection.')
         if not json_info:
-            json_info = {'RawSources': [resource]}     # <---- this will be repopulated to the full file path at the end of the pipeline building, in gather_pipes()
+            json_info = CopyOnWriteDict({'RawSources': [resource]})     # <---- this will be repopulated to the full file path at the end of the pipeline building, in gather_pipes()
         json_info['CpacProvenance'] = new_prov_list
 
         if resource not in self.rpool.keys():
@@ -364,6 +485,11 @@ class ResourcePool:
     def get_pipe_idxs(self, resource):
         return self.rpool[resource].keys()
 
+    def strategy_counts(self):
+        '''Number of strategies of each resource in the pool'''
+        return {resource: len(strats) for resource, strats in
+                self.rpool.items()}
+
     def get_json(self, resource, strat=None):
         # NOTE: resource_strat_dct has to be entered properly by the developer
         # it has to either be rpool[resource][strat] or strat_pool[resource]
@@ -396,9 +522,8 @@ class ResourcePool:
         if not isinstance(prov, list):
             raise Exception('\n[!] Developer info: the CpacProvenance '
                             f'entry for {prov} has to be a list.\n')
-        last_entry = get_last_prov_entry(prov)
-        resource = last_entry.split(':')[0]
-        return (resource, str(prov))
+        prov = Provenance(prov)
+        return (prov.resource, str(prov))
 
     def generate_prov_list(self, prov_str):
         if not isinstance(prov_str, str):
@@ -443,8 +568,6 @@ class ResourcePool:
         # TODO: NOTE: NOT COMPATIBLE WITH SUB-RPOOL/STRAT_POOLS
         # TODO: (and it doesn't have to be)
 
-        import itertools
-
         linked_resources = []
         resource_list = []
         if debug:
@@ -468,6 +591,8 @@ class ResourcePool:
             else:
                 resource_list.append(resource)
 
+        # one list of strategy options per input, duplicate provenances
+        # dropped
         total_pool = []
         variant_pool = {}
         len_inputs = len(resource_list)
@@ -483,26 +608,29 @@ class ResourcePool:
             if not rp_dct:
                 len_inputs -= 1
                 continue
-            sub_pool = []
+            sub_pool = {}
             if debug:
                 verbose_logger.debug('len(rp_dct): %s\n', len(rp_dct))
+            variants = variant_pool.setdefault(fetched_resource, set())
             for strat in rp_dct.keys():
                 json_info = self.get_json(fetched_resource, strat)
-                cpac_prov = json_info['CpacProvenance']
-                sub_pool.append(cpac_prov)
-                if fetched_resource not in variant_pool:
-                    variant_pool[fetched_resource] = []
+                cpac_prov = Provenance(json_info['CpacProvenance'])
+                if cpac_prov not in sub_pool:
+                    sub_pool[cpac_prov] = _StratOption(
+                        cpac_prov, cpac_prov.resource,
+                        self.rpool[cpac_prov.resource][str(cpac_prov)])
                 if 'CpacVariant' in json_info:
                     for key, val in json_info['CpacVariant'].items():
-                        if val not in variant_pool[fetched_resource]:
-                            variant_pool[fetched_resource] += val
-                            variant_pool[fetched_resource].append(
-                                f'NO-{val[0]}')
+                        if isinstance(val, list) or val not in variants:
+                            variants.update(val)
+                            variants.add(f'NO-{val[0]}')
 
             if debug:
                 verbose_logger = getLogger('engine')
-                verbose_logger.debug('%s sub_pool: %s\n', resource, sub_pool)
-            total_pool.append(sub_pool)
+                verbose_logger.debug('%s sub_pool: %s\n', resource,
+                                     [option.prov for option in
+                                      sub_pool.values()])
+            total_pool.append(list(sub_pool.values()))
 
         if not total_pool:
             raise LookupError('\n\n[!] C-PAC says: None of the listed '
@@ -510,165 +638,63 @@ class ResourcePool:
                               'exist in the resource pool.\n\nResources:\n'
                               '%s\n\n' % resource_list)
 
-        # TODO: right now total_pool is:
-        # TODO:    [[[T1w:anat_ingress, desc-preproc_T1w:anatomical_init, desc-preproc_T1w:acpc_alignment], [T1w:anat_ingress,desc-preproc_T1w:anatomical_init]],
-        # TODO:     [[T1w:anat_ingress, desc-preproc_T1w:anatomical_init, desc-preproc_T1w:acpc_alignment, desc-brain_mask:brain_mask_afni], [T1w:anat_ingress, desc-preproc_T1w:anatomical_init, desc-brain_mask:brain_mask_afni]]]
-
-        # TODO: and the code below thinks total_pool is a list of lists, like [[pipe_idx, pipe_idx], [pipe_idx, pipe_idx, pipe_idx], etc.]
-        # TODO: and the actual resource is encoded in the tag: of the last item, every time!
         # keying the strategies to the resources, inverting it
         if len_inputs > 1:
-            strats = itertools.product(*total_pool)
-
-            # we now currently have "strats", the combined permutations of all the strategies, as a list of tuples, each tuple combining one version of input each, being one of the permutations.
-            # OF ALL THE DIFFERENT INPUTS. and they are tagged by their fetched inputs with {name}:{strat}.
-            # so, each tuple has ONE STRAT FOR EACH INPUT, so if there are three inputs, each tuple will have 3 items.
+            # each combination has ONE STRAT FOR EACH INPUT, so if there are
+            # three inputs, each combination will have 3 items.
             new_strats = {}
-
-            # get rid of duplicates - TODO: refactor .product
-            strat_str_list = []            
-            strat_list_list = []
-            for strat_tuple in strats:
-                strat_list = list(copy.deepcopy(strat_tuple))
-                strat_str = str(strat_list)
-                if strat_str not in strat_str_list:
-                    strat_str_list.append(strat_str)
-                    strat_list_list.append(strat_list)
-
-            if debug:
-                verbose_logger = getLogger('engine')
-                verbose_logger.debug('len(strat_list_list): %s\n',
-                                     len(strat_list_list))
-            for strat_list in strat_list_list:
-
-                json_dct = {}
-                for strat in strat_list:
-                    # strat is a prov list for a single resource/input
-                    strat_resource, strat_idx = \
-                        self.generate_prov_string(strat)
-                    strat_json = self.get_json(strat_resource,
-                                               strat=strat_idx)
-                    json_dct[strat_resource] = strat_json
-
-                drop = False
-                if linked_resources:
-                    for linked in linked_resources:  # <--- 'linked' is each tuple
-                        if drop:
-                            break
-                        for xlabel in linked:
-                            if drop:
-                                break
-                            xjson = copy.deepcopy(json_dct[xlabel])
-                            for ylabel in linked:
-                                if xlabel == ylabel:
-                                    continue
-                                yjson = copy.deepcopy(json_dct[ylabel])
-                                
-                                if 'CpacVariant' not in xjson:
-                                    xjson['CpacVariant'] = {}
-                                if 'CpacVariant' not in yjson:
-                                    yjson['CpacVariant'] = {}
-                                    
-                                current_strat = []
-                                for key, val in xjson['CpacVariant'].items():
-                                    if isinstance(val, list):
-                                        current_strat.append(val[0])
-                                    else:
-                                        current_strat.append(val)
-                                current_spread = list(set(variant_pool[xlabel]))
-                                for spread_label in current_spread:
-                                    if 'NO-' in spread_label:
-                                        continue
-                                    if spread_label not in current_strat:
-                                        current_strat.append(f'NO-{spread_label}')
-                                
-                                other_strat = []
-                                for key, val in yjson['CpacVariant'].items():
-                                    if isinstance(val, list):
-                                        other_strat.append(val[0])
-                                    else:
-                                        other_strat.append(val)
-                                other_spread = list(set(variant_pool[ylabel]))
-                                for spread_label in other_spread:
-                                    if 'NO-' in spread_label:
-                                        continue
-                                    if spread_label not in other_strat:
-                                        other_strat.append(f'NO-{spread_label}')
-                                
-                                for variant in current_spread:
-                                    in_current_strat = False
-                                    in_other_strat = False
-                                    in_other_spread = False
-
-                                    if variant is None:
-                                        in_current_strat = True
-                                        if None in other_spread:
-                                            in_other_strat = True
-                                    if variant in current_strat:
-                                        in_current_strat = True
-                                    if variant in other_strat:
-                                        in_other_strat = True
-                                    if variant in other_spread:
-                                        in_other_spread = True
-
-                                    if not in_other_strat:
-                                        if in_other_spread:
-                                            if in_current_strat:
-                                                drop = True
-                                                break
-
-                                    if in_other_strat:
-                                        if in_other_spread:
-                                            if not in_current_strat:
-                                                drop = True
-                                                break       
-                                if drop:
-                                    break
-                if drop:
-                    continue
-
+            strat_lists = _combine_strats(total_pool, linked_resources,
+                                          variant_pool)
+            for strat_list in strat_lists:
                 # make the merged strat label from the multiple inputs
                 # strat_list is actually the merged CpacProvenance lists
-                pipe_idx = str(strat_list)
+                cpac_prov = Provenance([option.prov for option in strat_list])
+                pipe_idx = str(cpac_prov)
                 new_strats[pipe_idx] = ResourcePool()     # <----- new_strats is A DICTIONARY OF RESOURCEPOOL OBJECTS!
                 # placing JSON info at one level higher only for copy convenience
-                new_strats[pipe_idx].rpool['json'] = {}
-                new_strats[pipe_idx].rpool['json']['subjson'] = {}
-                new_strats[pipe_idx].rpool['json']['CpacProvenance'] = strat_list
+                strat_json = {'subjson': {}, 'CpacProvenance': cpac_prov}
+                # one entry per input, as pipe numbers (and so node
+                # names) are positions in this list
+                self.pipe_list += [pipe_idx] * len(strat_list)
 
                 # now just invert resource:strat to strat:resource for each resource:strat
-                for cpac_prov in strat_list:
-                    resource, strat = self.generate_prov_string(cpac_prov)
-                    resource_strat_dct = self.rpool[resource][strat]   # <----- remember, this is the dct of 'data' and 'json'.
+                for option in strat_list:
+                    resource = option.resource
+                    resource_strat_dct = option.resource_strat_dct   # <----- remember, this is the dct of 'data' and 'json'.
                     new_strats[pipe_idx].rpool[resource] = resource_strat_dct   # <----- new_strats is A DICTIONARY OF RESOURCEPOOL OBJECTS! each one is a new slice of the resource pool combined together.
-                    self.pipe_list.append(pipe_idx)
                     if 'CpacVariant' in resource_strat_dct['json']:
-                        if 'CpacVariant' not in new_strats[pipe_idx].rpool['json']:
-                            new_strats[pipe_idx].rpool['json']['CpacVariant'] = {}
+                        variants = strat_json.setdefault('CpacVariant', {})
                         for younger_resource, variant_list in resource_strat_dct['json']['CpacVariant'].items():
-                            if younger_resource not in new_strats[pipe_idx].rpool['json']['CpacVariant']:
-                                new_strats[pipe_idx].rpool['json']['CpacVariant'][younger_resource] = variant_list
-                    # preserve each input's JSON info also
+                            variants.setdefault(younger_resource, variant_list)
+                    # preserve each input's JSON info also, sharing its
+                    # structure until a node block writes to it
                     data_type = resource.split('_')[-1]
-                    if data_type not in new_strats[pipe_idx].rpool['json']['subjson']:
-                        new_strats[pipe_idx].rpool['json']['subjson'][data_type] = {}
-                    new_strats[pipe_idx].rpool['json']['subjson'][data_type].update(copy.deepcopy(resource_strat_dct['json']))
+                    strat_json['subjson'].setdefault(
+                        data_type, CopyOnWriteDict()).update(
+                            resource_strat_dct['json'])
+                new_strats[pipe_idx].rpool['json'] = CopyOnWriteDict(
+                    strat_json)
+            if debug:
+                verbose_logger = getLogger('engine')
+                verbose_logger.debug('len(new_strats): %s\n',
+                                     len(new_strats))
         else:
             new_strats = {}
             for resource_strat_list in total_pool:       # total_pool will have only one list of strats, for the one input
-                for cpac_prov in resource_strat_list:     # <------- cpac_prov here doesn't need to be modified, because it's not merging with other inputs
-                    resource, pipe_idx = self.generate_prov_string(cpac_prov)
-                    resource_strat_dct = self.rpool[resource][pipe_idx]   # <----- remember, this is the dct of 'data' and 'json'.
+                for option in resource_strat_list:     # <------- cpac_prov here doesn't need to be modified, because it's not merging with other inputs
+                    resource, pipe_idx = option.resource, str(option.prov)
+                    resource_strat_dct = option.resource_strat_dct   # <----- remember, this is the dct of 'data' and 'json'.
                     new_strats[pipe_idx] = ResourcePool(rpool={resource: resource_strat_dct})   # <----- again, new_strats is A DICTIONARY OF RESOURCEPOOL OBJECTS!
                     # placing JSON info at one level higher only for copy convenience
-                    new_strats[pipe_idx].rpool['json'] = resource_strat_dct['json']  # TODO: WARNING- THIS IS A LEVEL HIGHER THAN THE ORIGINAL 'JSON' FOR EASE OF ACCESS IN CONNECT_BLOCK WITH THE .GET(JSON)
-                    new_strats[pipe_idx].rpool['json']['subjson'] = {}
-                    new_strats[pipe_idx].rpool['json']['CpacProvenance'] = cpac_prov
+                    # (a copy-on-write view, so connecting a node block
+                    # doesn't write into the main rpool's JSON)
+                    strat_json = CopyOnWriteDict(resource_strat_dct['json'])
                     # preserve each input's JSON info also
-                    data_type = resource.split('_')[-1]                    
-                    if data_type not in new_strats[pipe_idx].rpool['json']['subjson']:
-                        new_strats[pipe_idx].rpool['json']['subjson'][data_type] = {}
-                    new_strats[pipe_idx].rpool['json']['subjson'][data_type].update(copy.deepcopy(resource_strat_dct['json']))
+                    data_type = resource.split('_')[-1]
+                    strat_json['subjson'] = {data_type: CopyOnWriteDict(
+                        resource_strat_dct['json'])}
+                    strat_json['CpacProvenance'] = option.prov
+                    new_strats[pipe_idx].rpool['json'] = strat_json
         return new_strats
 
     def derivative_xfm(self, wf, label, connection, json_info, pipe_idx,
@@ -676,7 +702,7 @@ class ResourcePool:
 
         if label in self.xfm:
 
-            json_info = dict(json_info)
+            json_info = CopyOnWriteDict(json_info)
 
             # get the bold-to-template transform from the current strat_pool
             # info
@@ -858,8 +884,8 @@ class ResourcePool:
         substring_excl = []
         outputs_logger = getLogger(f'{cfg["subject_id"]}_expectedOutputs')
         expected_outputs = ExpectedOutputs()
-        movement_filter_keys = grab_docstring_dct(motion_estimate_filter).get(
-            'outputs', [])
+        movement_filter_keys = node_block_descriptor(
+            motion_estimate_filter).outputs
 
         if add_excl:
             excl += add_excl
@@ -877,132 +903,40 @@ class ResourcePool:
             # substring_excl.append(['bold'])
             excl += Outputs.debugging
 
-        for resource in self.rpool.keys():
-
-            if resource not in Outputs.any:
-                continue
-
-            if resource in excl:
-                continue
-
-            drop = False
-            for substring_list in substring_excl:
-                bool_list = []
-                for substring in substring_list:
-                    if substring in resource:
-                        bool_list.append(True)
-                    else:
-                        bool_list.append(False)
-                for item in bool_list:
-                    if not item:
-                        break
-                else:
-                    drop = True
-                if drop:
-                    break
-            if drop:
-                continue
-
-            subdir = 'other'
-            if resource in Outputs.anat:
-                subdir = 'anat'
-                #TODO: get acq- etc.
-            elif resource in Outputs.func:
-                subdir = 'func'
-                #TODO: other stuff like acq- etc.
-
+        unique_id = self.get_name()
+        part_id = unique_id.split('_')[0]
+        ses_id = unique_id.split('_')[1]
+        if 'ses-' not in ses_id:
+            ses_id = f"ses-{ses_id}"
+        out_dir = cfg.pipeline_setup['output_directory']['path']
+        pipe_name = cfg.pipeline_setup['pipeline_name']
+        container = os.path.join(f'pipeline_{pipe_name}', part_id, ses_id)
+        batch_sinks = cfg['pipeline_setup', 'output_directory',
+                          'batch_sinks']
+        sinks = {}
+
+        for resource, subdir in self._sinkable_resources(excl,
+                                                         substring_excl):
+            num_variant = 0
+            if len(self.rpool[resource]) == 1:
+                num_variant = ""
+            unlabelled = self._unlabelled_forks(resource,
+                                                movement_filter_keys)
             for pipe_idx in self.rpool[resource]:
-                unique_id = self.get_name()
-                part_id = unique_id.split('_')[0]
-                ses_id = unique_id.split('_')[1]
-
-                if 'ses-' not in ses_id:
-                    ses_id = f"ses-{ses_id}"
-
-                out_dir = cfg.pipeline_setup['output_directory']['path']
-                pipe_name = cfg.pipeline_setup['pipeline_name']
-                container = os.path.join(f'pipeline_{pipe_name}', part_id,
-                                         ses_id)
+                pipe_x = self.get_pipe_number(pipe_idx)
+                json_info = self.rpool[resource][pipe_idx]['json']
                 filename = f'{unique_id}_{res_in_filename(self.cfg, resource)}'
-
-                out_path = os.path.join(out_dir, container, subdir, filename)
-
                 out_dct = {
                     'unique_id': unique_id,
                     'out_dir': out_dir,
                     'container': container,
                     'subdir': subdir,
                     'filename': filename,
-                    'out_path': out_path
+                    'out_path': os.path.join(out_dir, container, subdir,
+                                             filename)
                 }
                 self.rpool[resource][pipe_idx]['out'] = out_dct
 
-                # TODO: have to link the pipe_idx's here. and call up 'desc-preproc_T1w' from a Sources in a json and replace. here.
-                # TODO: can do the pipeline_description.json variants here too!
-
-        for resource in self.rpool.keys():
-
-            if resource not in Outputs.any:
-                continue
-
-            if resource in excl:
-                continue
-
-            drop = False
-            for substring_list in substring_excl:
-                bool_list = []
-                for substring in substring_list:
-                    if substring in resource:
-                        bool_list.append(True)
-                    else:
-                        bool_list.append(False)
-                for item in bool_list:
-                    if not item:
-                        break
-                else:
-                    drop = True
-                if drop:
-                    break
-            if drop:
-                continue
-
-            num_variant = 0
-            if len(self.rpool[resource]) == 1:
-                num_variant = ""
-            all_jsons = [self.rpool[resource][pipe_idx]['json'] for pipe_idx in
-                         self.rpool[resource]]
-            unlabelled = set(key for json_info in all_jsons for key in
-                             json_info.get('CpacVariant', {}).keys() if
-                             key not in (*movement_filter_keys, 'regressors'))
-            if 'bold' in unlabelled:
-                all_bolds = list(
-                    chain.from_iterable(json_info['CpacVariant']['bold'] for
-                                        json_info in all_jsons if
-                                        'CpacVariant' in json_info and
-                                        'bold' in json_info['CpacVariant']))
-                # not any(not) because all is overloaded as a parameter here
-                if not any(not re.match(r'apply_(phasediff|blip)_to_'
-                                        r'timeseries_separately_.*', _bold)
-                           for _bold in all_bolds):
-                    # this fork point should only result in 0 or 1 forks
-                    unlabelled.remove('bold')
-                del all_bolds
-            all_forks = {key: set(
-                chain.from_iterable(json_info['CpacVariant'][key] for
-                                    json_info in all_jsons if
-                                    'CpacVariant' in json_info and
-                                    key in json_info['CpacVariant'])) for
-                key in unlabelled}
-            # del all_jsons
-            for key, forks in all_forks.items():
-                if len(forks) < 2:  # no int suffix needed if only one fork
-                    unlabelled.remove(key)
-            # del all_forks
-            for pipe_idx in self.rpool[resource]:
-                pipe_x = self.get_pipe_number(pipe_idx)
-                json_info = self.rpool[resource][pipe_idx]['json']
-                out_dct = self.rpool[resource][pipe_idx]['out']
-
                 try:
                     if unlabelled:
                         num_variant += 1
@@ -1017,7 +951,6 @@ class ResourcePool:
                 if out_dct['subdir'] == 'other' and not all:
                     continue
 
-                unique_id = out_dct['unique_id']
                 resource_idx = resource
 
                 if isinstance(num_variant, int):
@@ -1156,28 +1089,108 @@ class ResourcePool:
 
                 wf.connect(id_string, 'out_filename', write_json, 'filename')
 
-                ds = pe.Node(DataSink(), name=f'sinker_{resource_idx}_'
-                                              f'{pipe_x}')
-                ds.inputs.parameterization = False
-                ds.inputs.base_directory = out_dct['out_dir']
-                ds.inputs.encrypt_bucket_keys = cfg.pipeline_setup[
-                    'Amazon-AWS']['s3_encryption']
-                ds.inputs.container = out_dct['container']
-
-                if cfg.pipeline_setup['Amazon-AWS'][
-                    'aws_output_bucket_credentials']:
-                    ds.inputs.creds_path = cfg.pipeline_setup['Amazon-AWS'][
-                        'aws_output_bucket_credentials']
+                if batch_sinks:
+                    # one DataSink per output subdirectory, with one pair
+                    # of '@' (no subfolder) inputs per output
+                    if subdir not in sinks:
+                        sinks[subdir] = self._data_sink(
+                            cfg, f'sinker_{subdir}', out_dct)
+                    ds = sinks[subdir]
+                    field = f'{subdir}.@{resource_idx}_{pipe_x}'
+                else:
+                    ds = self._data_sink(
+                        cfg, f'sinker_{resource_idx}_{pipe_x}', out_dct)
+                    field = f'{subdir}.@data'
                 expected_outputs += (out_dct['subdir'], create_id_string(
                     self.cfg, unique_id, resource_idx,
                     template_desc=id_string.inputs.template_desc,
                     atlas_id=atlas_id, subdir=out_dct['subdir']))
-                wf.connect(nii_name, 'out_file',
-                           ds, f'{out_dct["subdir"]}.@data')
+                wf.connect(nii_name, 'out_file', ds, field)
                 wf.connect(write_json, 'json_file',
-                           ds, f'{out_dct["subdir"]}.@json')
+                           ds, field.replace('.@', '.@json_', 1) if
+                           batch_sinks else f'{subdir}.@json')
         outputs_logger.info(expected_outputs)
 
+    def _sinkable_resources(self, excl, substring_excl):
+        """Index of the resources in the pool to write out, with their
+        output subdirectories
+
+        Parameters
+        ----------
+        excl : list of str
+            resources not to write out
+
+        substring_excl : list of list of str
+            resources containing all of any list's substrings are not
+            written out
+
+        Returns
+        -------
+        list of 2-tuples
+            (resource, subdir)
+        """
+        excl = set(excl)
+        index = []
+        for resource in self.rpool.keys():
+            if resource not in Outputs.any or resource in excl:
+                continue
+            if any(all(substring in resource for substring in substring_list)
+                   for substring_list in substring_excl):
+                continue
+            subdir = 'other'
+            if resource in Outputs.anat:
+                subdir = 'anat'
+                #TODO: get acq- etc.
+            elif resource in Outputs.func:
+                subdir = 'func'
+                #TODO: other stuff like acq- etc.
+            index.append((resource, subdir))
+        return index
+
+    def _unlabelled_forks(self, resource, movement_filter_keys):
+        """Fork points that distinguish a resource's strategies and so
+        need numbered ``desc`` labels in output filenames
+
+        Parameters
+        ----------
+        resource : str
+
+        movement_filter_keys : list of str
+            fork points labelled by their own entity
+
+        Returns
+        -------
+        set of str
+        """
+        all_forks = {}
+        for strat in self.rpool[resource].values():
+            for key, forks in strat['json'].get('CpacVariant', {}).items():
+                if key not in (*movement_filter_keys, 'regressors'):
+                    all_forks.setdefault(key, set()).update(forks)
+        if 'bold' in all_forks and not any(
+                not re.match(r'apply_(phasediff|blip)_to_'
+                             r'timeseries_separately_.*', _bold)
+                for _bold in all_forks['bold']):
+            # this fork point should only result in 0 or 1 forks
+            del all_forks['bold']
+        # no int suffix needed if only one fork
+        return {key for key, forks in all_forks.items() if len(forks) > 1}
+
+    def _data_sink(self, cfg, name, out_dct):
+        """DataSink node for a participant's outputs"""
+        ds = pe.Node(DataSink(), name=name)
+        ds.inputs.parameterization = False
+        ds.inputs.base_directory = out_dct['out_dir']
+        ds.inputs.encrypt_bucket_keys = cfg.pipeline_setup[
+            'Amazon-AWS']['s3_encryption']
+        ds.inputs.container = out_dct['container']
+
+        if cfg.pipeline_setup['Amazon-AWS'][
+                'aws_output_bucket_credentials']:
+            ds.inputs.creds_path = cfg.pipeline_setup['Amazon-AWS'][
+                'aws_output_bucket_credentials']
+        return ds
+
     def node_data(self, resource, **kwargs):
         '''Factory function to create NodeData objects
 
@@ -1270,10 +1283,7 @@ class NodeBlock:
                             f'{outputs} in Node Block "{name}"\n')
 
     def grab_tiered_dct(self, cfg, key_list):
-        cfg_dct = cfg
-        for key in key_list:
-            cfg_dct = cfg_dct.__getitem__(key)
-        return cfg_dct
+        return cfg[key_list]
 
     def connect_block(self, wf, cfg, rpool):
         debug = cfg.pipeline_setup['Debugging']['verbose']
@@ -1448,7 +1458,7 @@ class NodeBlock:
                             verbose_logger.debug('Node name: %s', node_name)
                             prov_dct = \
                                 rpool.get_resource_strats_from_prov(
-                                    ast.literal_eval(pipe_idx))
+                                    strat_pool.get('json')['CpacProvenance'])
                             for key, val in prov_dct.items():
                                 verbose_logger.debug('-------------------')
                                 verbose_logger.debug('Input - %s:', key)
@@ -1566,7 +1576,8 @@ def flatten_list(node_block_function: Union[FunctionType, list, Tuple],
     if isinstance(node_block_function, (list, tuple)):
         resource_list = node_block_function
     elif isinstance(node_block_function, FunctionType):
-        resource_list = grab_docstring_dct(node_block_function).get(key, [])
+        resource_list = node_block_descriptor(
+            node_block_function).docstring_dct.get(key, [])
     elif isinstance(node_block_function, str):
         resource_list = [node_block_function]
     if isinstance(resource_list, dict):
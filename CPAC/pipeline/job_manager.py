@@ -0,0 +1,187 @@
+# Copyright (C) 2022  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Run participant and group-level jobs in their own processes
+
+``JobManager`` starts each job in a ``multiprocessing.Process`` as soon
+as its core and memory reservation fits, and waits on the running
+processes' sentinels with ``multiprocessing.connection.wait`` so that a
+freed slot is refilled the moment a job exits rather than at the next
+poll. Each job's exit code is recorded, and failed jobs can be retried
+after an exponentially growing backoff.
+"""
+import heapq
+import multiprocessing
+import sys
+from dataclasses import dataclass, field
+from itertools import count
+from multiprocessing.connection import wait
+from time import monotonic, sleep
+from typing import Callable, Iterable, List, Optional
+
+
+@dataclass
+class Job:
+    """A function to run in its own process"""
+    name: str
+    target: Callable
+    args: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+    cores: float = 0
+    """cores reserved while the job runs"""
+    memory_gb: float = 0
+    """memory reserved while the job runs"""
+    attempts: int = 0
+    exitcode: Optional[int] = None
+    """exit code of the latest attempt, None until it finishes"""
+
+    @property
+    def failed(self):
+        """whether the latest attempt exited with an error"""
+        return self.exitcode not in (None, 0)
+
+
+class JobManager:
+    """Run jobs in processes within a number of jobs, cores and memory.
+
+    Jobs start in order, skipping ahead to later jobs that fit when the
+    next one doesn't. A job larger than the whole budget runs alone.
+
+    Parameters
+    ----------
+    max_jobs : int, optional
+        most jobs running at once
+
+    max_cores, max_memory_gb : float, optional
+        most cores and memory reserved by running jobs at once
+
+    retries : int
+        times to rerun a failed job
+
+    backoff : float
+        seconds to wait before a failed job's first retry, doubling
+        before each further retry
+
+    pid_file : str, optional
+        file to list the PID of each process started in
+
+    on_error : callable, optional
+        called with a job and the exception from inside the ``except``
+        block when the job's process fails to start
+
+    Examples
+    --------
+    >>> jobs = [Job(str(code), sys.exit, (code,)) for code in (0, 3)]
+    >>> [job.exitcode for job in JobManager(max_jobs=1).run(jobs)]
+    [0, 3]
+    """
+    def __init__(self, max_jobs: Optional[int] = None,
+                 max_cores: Optional[float] = None,
+                 max_memory_gb: Optional[float] = None, retries: int = 0,
+                 backoff: float = 60, pid_file: Optional[str] = None,
+                 on_error: Optional[Callable] = None):
+        self.max_jobs = max_jobs
+        self.max_cores = max_cores
+        self.max_memory_gb = max_memory_gb
+        self.retries = retries
+        self.backoff = backoff
+        self.pid_file = pid_file
+        self.on_error = on_error
+        self.running = {}
+        """process sentinel to ``(job, process)``"""
+
+    def fits(self, job: Job) -> bool:
+        """Whether a job's reservation fits beside the running jobs"""
+        if not self.running:
+            return True
+        jobs = [running_job for running_job, _ in self.running.values()]
+        return ((self.max_jobs is None or len(jobs) < self.max_jobs) and
+                (self.max_cores is None or job.cores + sum(
+                    running_job.cores for running_job in jobs
+                ) <= self.max_cores) and
+                (self.max_memory_gb is None or job.memory_gb + sum(
+                    running_job.memory_gb for running_job in jobs
+                ) <= self.max_memory_gb))
+
+    def start(self, job: Job, pid_file=None) -> bool:
+        """Start a job's process
+
+        Returns
+        -------
+        bool
+            whether the process started
+        """
+        job.attempts += 1
+        job.exitcode = None
+        process = multiprocessing.Process(target=job.target, args=job.args,
+                                          kwargs=job.kwargs, name=job.name)
+        try:
+            process.start()
+        except Exception as exception:  # pylint: disable=broad-except
+            job.exitcode = 1
+            if self.on_error is not None:
+                self.on_error(job, exception)
+            return False
+        if pid_file is not None:
+            print(process.pid, file=pid_file, flush=True)
+        self.running[process.sentinel] = (job, process)
+        return True
+
+    def run(self, jobs: Iterable[Job]) -> List[Job]:
+        """Run jobs until each has succeeded or used up its retries
+
+        Returns
+        -------
+        list of Job
+            ``jobs``, with their exit codes
+        """
+        jobs = list(jobs)
+        queue = list(jobs)
+        # heap of ``(time, order, job)`` of failed jobs to retry
+        retry_queue = []
+        order = count()
+        pid_file = open(self.pid_file, 'w', encoding='utf-8') if (
+            self.pid_file) else None
+        try:
+            while queue or retry_queue or self.running:
+                while retry_queue and retry_queue[0][0] <= monotonic():
+                    queue.append(heapq.heappop(retry_queue)[2])
+                for job in list(queue):
+                    if self.fits(job):
+                        queue.remove(job)
+                        self.start(job, pid_file)
+                if not self.running:
+                    if retry_queue:
+                        sleep(max(0, retry_queue[0][0] - monotonic()))
+                    continue
+                timeout = max(0, retry_queue[0][0] - monotonic()) if (
+                    retry_queue) else None
+                for sentinel in wait(list(self.running), timeout):
+                    job, process = self.running.pop(sentinel)
+                    process.join()
+                    job.exitcode = process.exitcode
+                    if job.failed and job.attempts <= self.retries:
+                        delay = self.backoff * 2 ** (job.attempts - 1)
+                        print(f'{job.name} exited with code {job.exitcode}; '
+                              f'retrying in {delay:g} s (attempt '
+                              f'{job.attempts + 1} of {self.retries + 1})',
+                              file=sys.stderr)
+                        heapq.heappush(retry_queue, (monotonic() + delay,
+                                                     next(order), job))
+        finally:
+            if pid_file is not None:
+                pid_file.close()
+        return jobs
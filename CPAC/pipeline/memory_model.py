@@ -0,0 +1,310 @@
+# Copyright (C) 2022  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Per-node memory model learned from the callback logs of past runs
+
+Every run's ``callback.log`` can be added to a persistent store of
+observed ``runtime_memory_gb``, ``input_data_shape`` (voxels × TRs) and
+``num_threads`` per node type (node name without the participant
+workflow's name and pipe numbers). For each node type with enough
+observations, the store fits
+
+    memory ≈ intercept + per_voxel_tr × voxels × TRs + per_thread × threads
+
+by least squares and estimates a node's memory as that fit plus a margin
+of residual standard deviations, so estimates follow the data being
+processed instead of a fixed multiplier.
+"""
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, NamedTuple, Optional
+import numpy as np
+from CPAC.pipeline.plan import _group_key, _node_key
+
+MAX_OBSERVATIONS = 500
+"""most recent observations kept per node type"""
+MIN_OBSERVATIONS = 3
+"""fewest observations of a node type to estimate from"""
+STORE_VERSION = 1
+
+
+class Observation(NamedTuple):
+    """One node's observed peak memory"""
+    memory_gb: float
+    size: Optional[int]
+    """voxels × TRs of the node's input, if known"""
+    threads: int
+
+
+class MemoryFit(NamedTuple):
+    """Least-squares fit of one node type's memory usage"""
+    intercept: float
+    per_voxel_tr: float
+    per_thread: float
+    residual_sd: float
+    max_memory_gb: float
+    observations: int
+
+    def estimate(self, size=None, threads=1, margin=2):
+        """Estimated memory (GB) for an input of ``size`` voxels × TRs
+        run on ``threads`` threads, plus ``margin`` residual standard
+        deviations.
+
+        Without a known size, a size-dependent fit falls back to the
+        largest observation.
+
+        Examples
+        --------
+        >>> fit = MemoryFit(0.5, 1e-8, 0.25, 0.1, 3.0, 10)
+        >>> round(fit.estimate(1e8, 2, margin=0), 2)
+        2.0
+        >>> round(fit.estimate(1e8, 2), 2)
+        2.2
+        >>> fit.estimate(None, 2)
+        3.0
+        """
+        if size is None and self.per_voxel_tr:
+            return self.max_memory_gb
+        return max(0.0, self.intercept + self.per_voxel_tr * (size or 0) +
+                   self.per_thread * threads) + margin * self.residual_sd
+
+
+def _size(shape):
+    if not shape or not all(isinstance(dim, (int, float)) for dim in shape):
+        return None
+    return int(np.prod(shape))
+
+
+def _number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(
+        value, bool) else None
+
+
+def fit_observations(observations: List[Observation]
+                     ) -> Optional[MemoryFit]:
+    """Fit memory against input size and threads.
+
+    Size and threads are only regressors if they vary across the
+    observations; a node type observed at a single size is fit as a
+    constant.
+
+    Returns
+    -------
+    MemoryFit or None
+        None if fewer than ``MIN_OBSERVATIONS``
+
+    Examples
+    --------
+    >>> obs = [Observation(1 + 2e-8 * size, size, 1) for size in
+    ...        (1e7, 5e7, 1e8, 2e8)]
+    >>> fit = fit_observations(obs)
+    >>> round(fit.intercept, 6), round(fit.per_voxel_tr * 1e8, 6)
+    (1.0, 2.0)
+    """
+    if len(observations) < MIN_OBSERVATIONS:
+        return None
+    memory = np.array([obs.memory_gb for obs in observations], dtype=float)
+    sized = [obs.size is not None for obs in observations]
+    sizes = np.array([obs.size or 0 for obs in observations], dtype=float)
+    threads = np.array([obs.threads for obs in observations], dtype=float)
+    columns = [np.ones_like(memory)]
+    use_size = all(sized) and np.ptp(sizes) > 0
+    use_threads = np.ptp(threads) > 0
+    if use_size:
+        columns.append(sizes)
+    if use_threads:
+        columns.append(threads)
+    design = np.column_stack(columns)
+    coefficients, *_ = np.linalg.lstsq(design, memory, rcond=None)
+    residuals = memory - design @ coefficients
+    dof = max(1, len(memory) - design.shape[1])
+    coefficients = list(coefficients)
+    intercept = coefficients.pop(0)
+    per_voxel_tr = coefficients.pop(0) if use_size else 0.0
+    per_thread = coefficients.pop(0) if use_threads else 0.0
+    return MemoryFit(float(intercept), float(per_voxel_tr), float(per_thread),
+                     float(np.sqrt(np.sum(residuals ** 2) / dof)),
+                     float(memory.max()), len(memory))
+
+
+class MemoryModel:
+    """Persistent store of observed per-node memory usage and the fits
+    learned from it.
+
+    Parameters
+    ----------
+    path : str
+        JSON file the store is read from and saved to
+
+    margin : float
+        residual standard deviations added to each estimate
+    """
+    def __init__(self, path, margin=2):
+        self.path = path
+        self.margin = margin
+        self.observations: Dict[str, List[Observation]] = {}
+        self.sources: Dict[str, int] = {}
+        """bytes of each callback log already added"""
+        self._new: Dict[str, List[Observation]] = {}
+        self._fits: Dict[str, Optional[MemoryFit]] = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as store_file:
+                store = json.load(store_file)
+            if store.get('version') == STORE_VERSION:
+                self.observations = {
+                    node_type: [Observation(*obs) for obs in observations]
+                    for node_type, observations in
+                    store.get('observations', {}).items()}
+                self.sources = store.get('sources', {})
+
+    def add_callback_log(self, callback_log: str) -> int:
+        """Add the observations in a callback log that haven't been
+        added yet.
+
+        Returns
+        -------
+        int
+            number of observations added
+        """
+        source = os.path.abspath(callback_log)
+        offset = self.sources.get(source, 0)
+        if offset > os.path.getsize(callback_log):
+            offset = 0  # log was replaced
+        added = 0
+        with open(callback_log, 'rb') as log_file:
+            log_file.seek(offset)
+            for line in log_file:
+                if not line.endswith(b'\n'):
+                    break  # still being written
+                offset += len(line)
+                try:
+                    node = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(node, dict) or 'id' not in node:
+                    continue
+                memory = _number(node.get('runtime_memory_gb'))
+                if memory is None or node.get('error'):
+                    continue
+                self.add(node['id'], Observation(
+                    memory, _size(node.get('input_data_shape')),
+                    int(_number(node.get('num_threads')) or 1)))
+                added += 1
+        self.sources[source] = offset
+        return added
+
+    def add(self, node_id: str, observation: Observation):
+        """Add one observation of a node, by its full name"""
+        node_type = _group_key(_node_key(node_id))
+        self._add(self.observations, node_type, observation)
+        self._add(self._new, node_type, observation)
+        self._fits.pop(node_type, None)
+
+    @staticmethod
+    def _add(observations, node_type, observation):
+        observations = observations.setdefault(node_type, [])
+        observations.append(observation)
+        del observations[:-MAX_OBSERVATIONS]
+
+    def fit(self, node_id: str) -> Optional[MemoryFit]:
+        """Fit for a node's type, by the node's full name"""
+        return self._fit_type(_group_key(_node_key(node_id)))
+
+    def _fit_type(self, node_type):
+        if node_type not in self._fits:
+            self._fits[node_type] = fit_observations(
+                self.observations.get(node_type, []))
+        return self._fits[node_type]
+
+    def estimate(self, node_id: str, size: Optional[int] = None,
+                 threads: int = 1) -> Optional[float]:
+        """Estimated memory (GB) of a node, by its full name, or None
+        if its type hasn't been observed enough"""
+        fit = self.fit(node_id)
+        if fit is None:
+            return None
+        return fit.estimate(size, threads, self.margin)
+
+    def peak_estimate(self, size: Optional[int] = None, concurrent: int = 1
+                      ) -> Optional[float]:
+        """Estimated peak memory (GB) of a participant whose largest input
+        is ``size`` voxels × TRs: the estimates of the ``concurrent`` most
+        memory-hungry node types summed, as if they ran at once.
+
+        Returns
+        -------
+        float or None
+            None if no node type has been observed enough
+        """
+        estimates = sorted((fit.estimate(size, 1, self.margin) for fit in
+                            map(self._fit_type, self.observations) if
+                            fit is not None), reverse=True)
+        if not estimates:
+            return None
+        return sum(estimates[:max(1, concurrent)])
+
+    def save(self):
+        """Add the observations made since loading to the store on disk,
+        which other runs may have added to in the meantime"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        with _locked(f'{self.path}.lock'):
+            on_disk = MemoryModel(self.path, self.margin)
+            for node_type, observations in self._new.items():
+                for observation in observations:
+                    self._add(on_disk.observations, node_type, observation)
+            for source, offset in self.sources.items():
+                on_disk.sources[source] = max(offset, on_disk.sources.get(
+                    source, 0))
+            partial = f'{self.path}.{os.getpid()}.partial'
+            with open(partial, 'w', encoding='utf-8') as store_file:
+                json.dump({'version': STORE_VERSION,
+                           'sources': on_disk.sources,
+                           'observations': on_disk.observations}, store_file)
+            os.replace(partial, self.path)
+        self.observations, self.sources = (on_disk.observations,
+                                           on_disk.sources)
+        self._new = {}
+        self._fits = {}
+        return self.path
+
+
+@contextmanager
+def _locked(lock_path):
+    with open(lock_path, 'w', encoding='utf-8') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def update_memory_model(path: str, callback_logs: Iterable[str]) -> int:
+    """Add callback logs to a memory-model store
+
+    Returns
+    -------
+    int
+        number of observations added
+    """
+    model = MemoryModel(path)
+    added = sum(model.add_callback_log(callback_log) for callback_log in
+                callback_logs if os.path.exists(callback_log))
+    if added:
+        model.save()
+    return added
@@ -23,12 +23,14 @@ from nipype.pipeline import engine as pe
 # import everything in nipype.pipeline.engine.__all__
 from nipype.pipeline.engine import *  # noqa: F401,F403
 # import our DEFAULT_MEM_GB and override Node, MapNode
-from .engine import DEFAULT_MEM_GB, export_graph, get_data_size, Node, \
-                    MapNode, UNDEFINED_SIZE, Workflow
+from .engine import DEFAULT_MEM_GB, export_graph, get_data_size, \
+                    merge_duplicate_nodes, Node, MapNode, run_workflows, \
+                    UNDEFINED_SIZE, Workflow
 
 __all__ = [
     interface for interface in dir(pe) if not interface.startswith('_')
-] + ['DEFAULT_MEM_GB', 'export_graph', 'get_data_size', 'Node', 'MapNode',
+] + ['DEFAULT_MEM_GB', 'export_graph', 'get_data_size',
+     'merge_duplicate_nodes', 'Node', 'MapNode', 'run_workflows',
      'UNDEFINED_SIZE', 'Workflow']
 
 del pe
@@ -8,6 +8,7 @@
 #     * Applies a random seed
 #     * Supports overriding memory estimates via a log file and a buffer
 #     * Adds quotation marks around strings in dotfiles
+#     * Optionally merges duplicate nodes in flattened workflow graphs
 
 # ORIGINAL WORK'S ATTRIBUTION NOTICE:
 #     Copyright (c) 2009-2016, Nipype developers
@@ -51,7 +52,9 @@ import os
 import re
 from copy import deepcopy
 from inspect import Parameter, Signature, signature
+import networkx as nx
 from nibabel import load
+from nipype import config as nipype_config
 from nipype.interfaces.utility import Function
 from nipype.pipeline import engine as pe
 from nipype.pipeline.engine.utils import (
@@ -60,8 +63,10 @@ from nipype.pipeline.engine.utils import (
     generate_expanded_graph,
     get_print_name,
     load_resultfile as _load_resultfile,
+    merge_dict,
     _replacefunk,
-    _run_dot
+    _run_dot,
+    write_workflow_resources
 )
 from nipype.utils.filemanip import fname_presuffix
 from nipype.utils.functions import getsource
@@ -319,6 +324,9 @@ class Node(pe.Node):
                     multiplicand,
                     getattr(self, '_mem_x', {}).get('mode'))
             if _check_mem_x_path(multiplicand):
+                # logged in the callback log for memory models
+                self.input_data_shape = load(
+                    _grab_first_path(multiplicand)).shape
                 return get_data_size(
                     _grab_first_path(multiplicand),
                     getattr(self, '_mem_x', {}).get('mode'))
@@ -450,6 +458,9 @@ class MapNode(Node, pe.MapNode):
 
 class Workflow(pe.Workflow):
     """Controls the setup and execution of a pipeline of processes."""
+    merge_duplicates = False
+    """Merge nodes that would do identical work when flattening the
+    graph. See ``merge_duplicate_nodes``."""
 
     def __init__(self, name, base_dir=None, debug=False):
         """Create a workflow object.
@@ -472,6 +483,14 @@ class Workflow(pe.Workflow):
         self._nodes_cache = set()
         self._nested_workflows_cache = set()
 
+    def _create_flat_graph(self):
+        flatgraph = super()._create_flat_graph()
+        if self.merge_duplicates:
+            removed = merge_duplicate_nodes(flatgraph)
+            logger.info('Merged %d duplicate nodes in workflow %s', removed,
+                        self.name)
+        return flatgraph
+
     def _configure_exec_nodes(self, graph):
         """Ensure that each node knows where to get inputs from"""
         for node in graph.nodes():
@@ -507,6 +526,39 @@ class Workflow(pe.Workflow):
                                         TypeError):
                                     self._handle_just_in_time_exception(node)
 
+    def _execution_graph(self, plugin, plugin_args, first_index=0):
+        """Expanded, configured graph of this workflow's nodes, as
+        ``Workflow.run`` would hand to its plugin.
+
+        Parameters
+        ----------
+        plugin : str
+            name of the plugin MapNodes run their subnodes with
+
+        plugin_args : dict
+
+        first_index : int
+            index of this workflow's first node, so that nodes of several
+            workflows run together have distinct indices
+
+        Returns
+        -------
+        networkx.DiGraph
+        """
+        flatgraph = self._create_flat_graph()
+        self.config = merge_dict(deepcopy(nipype_config._sections),
+                                 self.config)
+        self._set_needed_outputs(flatgraph)
+        execgraph = generate_expanded_graph(deepcopy(flatgraph))
+        for index, node in enumerate(execgraph.nodes(), first_index):
+            node.config = merge_dict(deepcopy(self.config), node.config)
+            node.base_dir = self.base_dir
+            node.index = index
+            if isinstance(node, pe.MapNode):
+                node.use_plugin = (plugin, plugin_args)
+        self._configure_exec_nodes(execgraph)
+        return execgraph
+
     def _get_dot(
         self, prefix=None, hierarchy=None, colored=False, simple_form=True,
         level=0
@@ -699,6 +751,154 @@ class Workflow(pe.Workflow):
             logger.info(dotstr)
 
 
+def run_workflows(workflows, runner, updatehash=False):
+    """Run several workflows' nodes through one plugin instance, so that
+    a single executor packs nodes from every workflow into the resources
+    it was given, instead of each workflow running its own pool.
+
+    Each workflow keeps its own ``base_dir`` and configuration; the
+    plugin is run with the first workflow's configuration.
+
+    Parameters
+    ----------
+    workflows : list of Workflow
+
+    runner : nipype.pipeline.plugins.base.PluginBase
+        plugin instance, e.g. ``MultiProcPlugin(plugin_args)``
+
+    updatehash : bool
+
+    Returns
+    -------
+    list of networkx.DiGraph
+        each workflow's execution graph
+
+    Examples
+    --------
+    >>> from CPAC.pipeline.nipype_pipeline_engine.plugins import (
+    ...     LinearPlugin)
+    >>> import tempfile
+    >>> def identity(x):
+    ...     return x
+    >>> workflows = []
+    >>> for participant in ('sub-1', 'sub-2'):
+    ...     wf = Workflow(f'cpac_{participant}', base_dir=tempfile.mkdtemp())
+    ...     node = Node(Function(input_names=['x'], output_names=['x'],
+    ...                          function=identity), name='node')
+    ...     node.inputs.x = participant
+    ...     wf.add_nodes([node])
+    ...     workflows.append(wf)
+    >>> execgraphs = run_workflows(workflows, LinearPlugin({}))
+    >>> sorted(node.index for execgraph in execgraphs for node in execgraph)
+    [0, 1]
+    >>> [node.result.outputs.x for execgraph in execgraphs for
+    ...  node in execgraph]
+    ['sub-1', 'sub-2']
+    """
+    plugin = type(runner).__name__[:-len('Plugin')]
+    execgraphs = []
+    first_index = 0
+    for wf in workflows:
+        # pylint: disable=protected-access
+        execgraphs.append(wf._execution_graph(plugin, runner.plugin_args,
+                                              first_index))
+        first_index += len(execgraphs[-1])
+    if not execgraphs:
+        return execgraphs
+    runner.run(nx.union_all(execgraphs), updatehash=updatehash,
+               config=workflows[0].config)
+    if nipype_config.resource_monitor:
+        for wf, execgraph in zip(workflows, execgraphs):
+            write_workflow_resources(execgraph, filename=os.path.join(
+                wf.base_dir or os.getcwd(), wf.name, 'resource_monitor.json'))
+    return execgraphs
+
+
+def _node_signature(graph, node):
+    """Everything a flattened graph's node's work depends on, or ``None``
+    for nodes that expand into (or join) iterables"""
+    # pylint: disable=protected-access
+    if isinstance(node, pe.JoinNode) or node.iterables or getattr(
+            node, 'itersource', None):
+        return None
+    inputs = [node.inputs.trait_get()]
+    if isinstance(node, pe.MapNode):
+        inputs += [node._interface.inputs.trait_get(), node.iterfield,
+                   node.nested, node._serial]
+    return (
+        type(node), type(node.interface),
+        repr([sorted(state.items()) if isinstance(state, dict) else state
+              for state in inputs]),
+        repr(sorted(node.outputs.copyable_trait_names())
+             if node.outputs else None),
+        repr((node.overwrite, node.run_without_submitting,
+              node.plugin_args, node.config, node._n_procs, node._mem_gb,
+              getattr(node, '_mem_x', None), getattr(node, 'seed', None))),
+        tuple(sorted((id(source), repr(data['connect'])) for
+                     source, _, data in graph.in_edges(node, data=True))))
+
+
+def merge_duplicate_nodes(graph):
+    """Merge nodes in a flattened workflow graph that have the same
+    interface, parameters and upstream sources, so that work repeated
+    across forks (e.g., resampling the same derivative to the same
+    template) runs once.
+
+    Each duplicate's downstream connections are moved to the first
+    equivalent node in topological order, and the duplicate is removed.
+
+    Parameters
+    ----------
+    graph : networkx.DiGraph
+        flattened workflow graph, modified in place
+
+    Returns
+    -------
+    int
+        number of nodes removed
+
+    Examples
+    --------
+    >>> from nipype.interfaces.utility import IdentityInterface
+    >>> wf = Workflow('example')
+    >>> source = Node(IdentityInterface(fields=['x']), name='source')
+    >>> source.inputs.x = 1
+    >>> for fork in range(3):
+    ...     sink = Node(IdentityInterface(fields=['x']), name=f'sink{fork}')
+    ...     sink.inputs.x = fork
+    ...     for duplicate in range(2):
+    ...         copy = Node(IdentityInterface(fields=['x']),
+    ...                     name=f'copy{fork}{duplicate}')
+    ...         wf.connect(source, 'x', copy, 'x')
+    ...     wf.connect(copy, 'x', sink, 'x')
+    >>> graph = wf._create_flat_graph()
+    >>> merge_duplicate_nodes(graph)  # the six copies become one
+    5
+    >>> sorted(node.name for node in graph.successors(
+    ...     next(node for node in graph if node.name == 'copy00')))
+    ['sink0', 'sink1', 'sink2']
+    """
+    representatives = {}
+    removed = 0
+    for node in list(nx.topological_sort(graph)):
+        signature = _node_signature(graph, node)
+        if signature is None:
+            continue
+        representative = representatives.setdefault(signature, node)
+        if representative is node:
+            continue
+        for _, target, data in list(graph.out_edges(node, data=True)):
+            if graph.has_edge(representative, target):
+                connect = graph[representative][target]['connect']
+                connect.extend(connection for connection in data['connect']
+                               if connection not in connect)
+            else:
+                graph.add_edge(representative, target, **deepcopy(data))
+        graph.remove_node(node)
+        removed += 1
+    return removed
+
+
 def get_data_size(filepath, mode='xyzt'):
     """Function to return the size of a functional image (x * y * z * t)
 
@@ -10,6 +10,11 @@ STATEMENT OF CHANGES:
 CHANGES:
     * Supports just-in-time dynamic memory allocation
     * Supports overriding memory estimates via a log file and a buffer
+    * Supports data-aware memory estimates from a learned memory model
+    * Supports sharing resources fairly among several participants' nodes
+    * Supports dispatching ready nodes by remaining critical-path length
+    * Supports admission control and suspension by live process memory
+    * Supports writing live scheduler metrics for the monitoring server
 
 ORIGINAL WORK'S ATTRIBUTION NOTICE:
     Copyright (c) 2009-2016, Nipype developers
@@ -34,17 +39,33 @@ This file is part of C-PAC.
 """
 import gc
 import json
+import os
 import platform
 import resource
+import shutil
+import signal
 import sys
+import tempfile
+import time
 from copy import deepcopy
 from logging import INFO
 from textwrap import indent
 from traceback import format_exception
-from nipype.pipeline.plugins.multiproc import logger
-from numpy import flatnonzero
+import psutil
+from nipype.pipeline.plugins.multiproc import logger, run_node
+from nibabel import load
+from numpy import flatnonzero, prod
+from CPAC.pipeline.memory_model import MemoryModel
+from CPAC.pipeline.plan import _group_key, _node_key, critical_path_hours, \
+                               load_thread_limits
 from CPAC.pipeline.nipype_pipeline_engine import MapNode, UNDEFINED_SIZE
+from CPAC.pipeline.nipype_pipeline_engine.engine import _check_mem_x_path, \
+                                                        _grab_first_path
 from CPAC.utils.monitoring import log_nodes_cb
+from CPAC.utils.monitoring.metrics import write_scheduler_metrics
+
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS')
+"""environment variables that set multi-threaded tools' thread counts"""
 
 
 def get_peak_usage():
@@ -68,6 +89,74 @@ def get_peak_usage():
     return proc_peak / 1024. / 1024.
 
 
+def _process_memory_gb(process, descendants=True):
+    """Memory (GB) of a process and, by default, all of its descendants
+
+    Each process counts its proportional set size (PSS) where the
+    platform reports it and its unique set size (USS) otherwise, so
+    pages that forked processes share copy-on-write are not counted
+    once per process. Processes whose memory maps can't be read count
+    their resident set size.
+    """
+    try:
+        processes = [process, *process.children(recursive=True)
+                     ] if descendants else [process]
+    except psutil.Error:
+        return 0
+    used = 0
+    for proc in processes:
+        try:
+            info = proc.memory_full_info()
+            used += getattr(info, 'pss', info.uss)
+        except psutil.AccessDenied:
+            try:
+                used += proc.memory_info().rss
+            except psutil.Error:
+                pass
+        except psutil.Error:
+            pass
+    return used / 1024 ** 3
+
+
+def run_node_in_worker(node, updatehash, taskid, pid_dir=None,
+                       environ=None):
+    """Run a node in a worker process
+
+    Parameters
+    ----------
+    node, updatehash, taskid
+        as for ``nipype.pipeline.plugins.multiproc.run_node``
+
+    pid_dir : str, optional
+        directory to record the worker's PID in while the node runs, so
+        that the scheduler can measure and signal it
+
+    environ : dict, optional
+        environment variables, such as thread counts, to set while the
+        node runs
+    """
+    environ = environ or {}
+    previous = {variable: os.environ.get(variable) for variable in environ}
+    os.environ.update(environ)
+    pid_file = os.path.join(pid_dir, f'{taskid}.pid') if pid_dir else None
+    if pid_file:
+        with open(pid_file, 'w', encoding='utf-8') as pid:
+            pid.write(str(os.getpid()))
+    try:
+        return run_node(node, updatehash, taskid)
+    finally:
+        if pid_file:
+            try:
+                os.remove(pid_file)
+            except OSError:
+                pass
+        for variable, value in previous.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+
+
 def parse_previously_observed_mem_gb(callback_log_path):
     """Function to parse the previously observed memory usage.
 
@@ -99,9 +188,33 @@ class CpacNipypeCustomPluginMixin():
                 1 + plugin_args['runtime']['buffer'] / 100
             ) for node_key, observation in parse_previously_observed_mem_gb(
                 plugin_args['runtime']['usage']).items()}
+        if plugin_args.get('memory_model'):
+            self.memory_model = MemoryModel(
+                plugin_args['memory_model']['path'],
+                plugin_args['memory_model']['margin'])
         super().__init__(plugin_args=plugin_args)
         self.peak = 0
         self._stats = None
+        self._participant_rank = None
+        self._critical_path = None
+        self.live_memory = plugin_args.get('live_memory')
+        self._pid_dir = tempfile.mkdtemp(prefix='cpac_pids_') if (
+            self.live_memory) else None
+        self._suspended = []
+        """task IDs of suspended tasks, in order of suspension"""
+        self._suspended_at_gb = 0
+        """memory in use when the latest task was suspended"""
+        self._thread_limits = load_thread_limits(
+            plugin_args['adaptive_threads'].get('callback_logs', [])
+        ) if plugin_args.get('adaptive_threads') is not None else None
+        """most useful threads per node type, or None to keep nodes'
+        threads as built"""
+        self._built_threads = {}
+        """threads of each adapted job as built"""
+        self._metrics = plugin_args.get('scheduler_metrics')
+        self._metrics_written = 0
+        self._participant_started = {}
+        """when each participant's first job was submitted"""
 
     def _check_resources_(self, running_tasks):
         """
@@ -120,12 +233,289 @@ class CpacNipypeCustomPluginMixin():
         Nipype memory usage"""
         free_memory_gb, free_processors = self._check_resources_(running_tasks)
 
+        if self.live_memory:
+            return self._check_live_memory(running_tasks, free_memory_gb,
+                                           free_processors)
+
         # Nipype memory usage
         self.peak = get_peak_usage()
         free_memory_gb -= self.peak
 
         return free_memory_gb, free_processors
 
+    def _check_live_memory(self, running_tasks, free_memory_gb,
+                           free_processors):
+        """Limit free memory by the memory this process and the workers
+        running tasks actually use, deferring new jobs while usage is at
+        or above ``live_memory['defer_at']`` of the budget or while any
+        job is suspended. With no tasks running, jobs are always
+        admitted, so usage outside the running tasks can't stall the
+        run."""
+        running_tids = {tid for tid, _ in running_tasks}
+        self._suspended = [tid for tid in self._suspended if
+                           tid in running_tids]
+        self.peak = psutil.Process().memory_info().rss / 1024 ** 3
+        if not running_tasks:
+            return free_memory_gb, free_processors
+        used_gb = self._used_memory_gb()
+        self._manage_live_memory(used_gb)
+        if self._suspended or (
+            used_gb >= self.live_memory['defer_at'] * self.memory_gb
+        ):
+            return 0, free_processors
+        return min(free_memory_gb - self.peak, self.memory_gb - used_gb
+                   ), free_processors
+
+    def _used_memory_gb(self):
+        """Memory (GB) used by this process and the worker processes
+        running tasks. Idle pool workers are not counted. Without
+        recorded worker PIDs, all descendants are counted."""
+        if self._pid_dir is None:
+            return _process_memory_gb(psutil.Process())
+        used = _process_memory_gb(psutil.Process(), descendants=False)
+        for tid, _ in self.pending_tasks:
+            process = self._task_process(tid)
+            if process is not None:
+                used += _process_memory_gb(process)
+        return used
+
+    def _task_process(self, tid):
+        """Worker process running a task, or None if the task hasn't
+        started"""
+        if self._pid_dir is None:
+            return None
+        try:
+            with open(os.path.join(self._pid_dir, f'{tid}.pid'), 'r',
+                      encoding='utf-8') as pid:
+                return psutil.Process(int(pid.read()))
+        except (OSError, ValueError, psutil.Error):
+            return None
+
+    def _signal_task(self, tid, signum):
+        """Send a signal to a task's worker process and its descendants
+
+        Returns
+        -------
+        bool
+            whether the task's process was found
+        """
+        process = self._task_process(tid)
+        if process is None:
+            return False
+        try:
+            processes = [process, *process.children(recursive=True)]
+        except psutil.Error:
+            return False
+        for proc in processes:
+            try:
+                proc.send_signal(signum)
+            except psutil.Error:
+                pass
+        return True
+
+    def _lowest_priority_task(self, tids):
+        """The running task to suspend first: the one with the shortest
+        remaining critical path if known, otherwise the latest started"""
+        if self._critical_path is None:
+            return tids[0]
+        jobids = dict(self.pending_tasks)
+        return min(tids, key=lambda tid: self._remaining_path(jobids[tid]))
+
+    def _manage_live_memory(self, used_gb):
+        """Suspend the lowest-priority running task while memory use is
+        above ``live_memory['suspend_at']`` of the budget, and resume
+        suspended tasks, earliest first, once it drops below
+        ``live_memory['defer_at']`` or nothing else is running
+
+        A suspended task keeps the memory it holds; suspending it only
+        stops it from growing. So another task is only suspended while
+        usage keeps rising past the usage at the latest suspension.
+        """
+        running = [tid for tid, _ in self.pending_tasks if
+                   tid not in self._suspended and
+                   self._task_process(tid) is not None]
+        suspend_at = self.live_memory.get('suspend_at')
+        if self._suspended and (
+            used_gb < self.live_memory['defer_at'] * self.memory_gb or
+            not running
+        ):
+            tid = self._suspended.pop(0)
+            self._signal_task(tid, signal.SIGCONT)
+            logger.info('Resumed task %d (%0.2f/%0.2f GB in use)', tid,
+                        used_gb, self.memory_gb)
+        elif suspend_at is not None and len(running) > 1 and (
+            used_gb > suspend_at * self.memory_gb
+        ) and (not self._suspended or used_gb > self._suspended_at_gb):
+            tid = self._lowest_priority_task(running)
+            if self._signal_task(tid, signal.SIGSTOP):
+                self._suspended.append(tid)
+                self._suspended_at_gb = used_gb
+                logger.warning('Suspended task %d until memory frees up '
+                               '(%0.2f/%0.2f GB in use)', tid, used_gb,
+                               self.memory_gb)
+
+    def _generate_dependency_list(self, graph):
+        """Generate the dependency list and, if configured, estimate each
+        node's remaining critical path"""
+        super()._generate_dependency_list(graph)
+        if self.plugin_args.get('critical_path'):
+            self._critical_path = critical_path_hours(
+                graph, self.procs,
+                self.plugin_args['critical_path'].get('callback_logs', []))
+
+    def _remaining_path(self, jobid):
+        """Estimated remaining critical-path hours of a job. A MapNode's
+        subnodes share their MapNode's."""
+        if jobid < len(self._critical_path):
+            return self._critical_path[jobid]
+        for mapnode, subnodes in self.mapnodesubids.items():
+            if jobid in subnodes:
+                return self._critical_path[mapnode]
+        return 0
+
+    def _participant(self, jobid):
+        """Name of the participant workflow a job belongs to"""
+        return self.procs[jobid].fullname.split('.', 1)[0]
+
+    def _participant_usage(self):
+        """Memory (GB) and processors used by each participant's running
+        jobs"""
+        usage = {}
+        for _, jobid in self.pending_tasks:
+            used = usage.setdefault(self._participant(jobid), [0, 0])
+            used[0] += self.procs[jobid].mem_gb
+            used[1] += self.procs[jobid].n_procs
+        return usage
+
+    def _share_used(self, usage, participant):
+        """Largest fraction of its memory or processor share a
+        participant is using"""
+        share = self.plugin_args['participant_share']
+        memory_gb, n_procs = usage.get(participant, (0, 0))
+        return max(memory_gb / share['memory_gb'], n_procs / share['n_procs'])
+
+    def _prioritize(self, jobids, usage=None):
+        """Order ready jobs by remaining critical path, if configured,
+        and among the participants sharing this plugin, if any.
+
+        Jobs with the longest estimated chain of work left go first.
+        With ``participant_share['priority'] == 'fair'``, jobs of the
+        participants using the least of their share go before that;
+        with ``'in_order'``, jobs of participants earlier in the graph
+        do. Ties keep their order from ``_sort_jobs``.
+        """
+        if self._critical_path is not None:
+            jobids = sorted(jobids, key=self._remaining_path, reverse=True)
+        if not self.plugin_args.get('participant_share'):
+            return list(jobids)
+        if self._participant_rank is None:
+            self._participant_rank = {}
+            for jobid in range(len(self.procs)):
+                self._participant_rank.setdefault(self._participant(jobid),
+                                                  len(self._participant_rank))
+        if self.plugin_args['participant_share'].get('priority') == 'in_order':
+            return sorted(jobids, key=lambda jobid: self._participant_rank[
+                self._participant(jobid)])
+        return sorted(jobids, key=lambda jobid: (
+            self._share_used(usage, self._participant(jobid)),
+            self._participant_rank[self._participant(jobid)]))
+
+    def _exceeds_share(self, usage, jobid, next_job_gb, next_job_th,
+                       ready_participants):
+        """Would running a job take its participant past its share while
+        other participants have jobs ready?
+
+        A participant with nothing running can always start a job, so a
+        job larger than a share can't be starved.
+        """
+        participant = self._participant(jobid)
+        if participant not in usage or ready_participants == {participant}:
+            return False
+        share = self.plugin_args['participant_share']
+        memory_gb, n_procs = usage[participant]
+        return (memory_gb + next_job_gb > share['memory_gb'] or
+                n_procs + next_job_th > share['n_procs'])
+
+    def _adapt_threads(self, jobid, free_processors, waiting):
+        """Give a multi-threaded job its share of the free processors
+        when it's dispatched.
+
+        A job is multi-threaded if it was built with more than one
+        thread; interfaces that merely take a number of threads, as
+        every AFNI interface does, aren't widened when built with one,
+        since they'd reserve cores they don't use. Its share is
+        the free processors divided among the ``waiting`` ready jobs,
+        at least one and at most the threads its node type has been
+        able to use, so that a job alone gets every free processor and
+        jobs in a busy period get fewer. The job's threads and
+        ``THREAD_VARIABLES`` in its worker's environment are set to its
+        share.
+        """
+        node = self.procs[jobid]
+        if isinstance(node, MapNode) or node.run_without_submitting:
+            return
+        built = self._built_threads.setdefault(jobid, node.n_procs)
+        if built <= 1:
+            return
+        threads = max(1, min(
+            self._thread_limits.get(_group_key(_node_key(node.fullname)),
+                                    self.processors),
+            self.processors, free_processors // max(1, waiting)))
+        node.n_procs = threads
+        # pylint: disable=protected-access
+        node._thread_environ = {variable: str(threads) for
+                                variable in THREAD_VARIABLES}
+
+    def _write_metrics(self, num_ready, free_memory_gb, free_processors,
+                       force=False):
+        """Write queue depth, resources and each participant's progress
+        to ``scheduler_metrics['path']`` for the monitoring server, at
+        most every ``scheduler_metrics['interval']`` seconds unless
+        forced"""
+        now = time.time()
+        if not force and (
+            now - self._metrics_written < self._metrics['interval']
+        ):
+            return
+        self._metrics_written = now
+        running = {jobid for _, jobid in self.pending_tasks}
+        participants = {}
+        for jobid in range(len(self.procs)):
+            progress = participants.setdefault(self._participant(jobid), {
+                'total': 0, 'done': 0, 'running': 0})
+            progress['total'] += 1
+            if jobid in running:
+                progress['running'] += 1
+            elif self.proc_done[jobid] and not self.proc_pending[jobid]:
+                progress['done'] += 1
+        for participant, progress in participants.items():
+            progress['started'] = self._participant_started.get(participant)
+        try:
+            write_scheduler_metrics(self._metrics['path'], {
+                'updated': now, 'pid': os.getpid(),
+                'plugin': type(self).__name__,
+                'running': len(running), 'ready': num_ready,
+                'memory_gb': self.memory_gb,
+                'reserved_memory_gb': sum(self.procs[jobid].mem_gb for
+                                          jobid in running),
+                'used_memory_gb': self._used_memory_gb(),
+                'free_memory_gb': free_memory_gb,
+                'processors': self.processors,
+                'reserved_processors': sum(self.procs[jobid].n_procs for
+                                           jobid in running),
+                'free_processors': free_processors,
+                'participants': participants})
+        except OSError as os_error:
+            logger.debug('Could not write scheduler metrics: %s', os_error)
+
+    def _postrun_check(self):
+        if self._metrics is not None:
+            self._write_metrics(0, self.memory_gb, self.processors,
+                                force=True)
+        if self._pid_dir is not None:
+            shutil.rmtree(self._pid_dir, ignore_errors=True)
+        super()._postrun_check()
+
     def _clean_exception(self, jobid, graph):
         traceback = format_exception(*sys.exc_info())
         self._clean_queue(
@@ -133,6 +523,36 @@ class CpacNipypeCustomPluginMixin():
                                   "traceback": traceback}
         )
 
+    def _model_memory_estimate(self, node):
+        """
+        Estimate node memory from the memory model, once the input its
+        estimate depends on (if any) exists
+
+        Parameters
+        ----------
+        node : nipype.pipeline.engine.nodes.Node
+
+        Returns
+        -------
+        None
+        """
+        if getattr(node, '_memory_modelled', False):
+            return
+        size = None
+        mem_x = getattr(node, 'mem_x', None)
+        if mem_x and mem_x.get('file'):
+            mem_x_path = _grab_first_path(getattr(node.inputs,
+                                                  mem_x['file']))
+            if not _check_mem_x_path(mem_x_path):
+                return  # try again when the input exists
+            node.input_data_shape = load(mem_x_path).shape
+            size = int(prod(node.input_data_shape))
+        node._memory_modelled = True  # pylint: disable=protected-access
+        estimate = self.memory_model.estimate(node.fullname, size,
+                                              node.n_procs)
+        if estimate is not None:
+            node.override_mem_gb(estimate)
+
     def _override_memory_estimate(self, node):
         """
         Override node memory estimate with provided runtime memory
@@ -174,17 +594,22 @@ class CpacNipypeCustomPluginMixin():
         """
         if node_id in self.runtime:
             node.override_mem_gb(self.runtime[node_id])
-            return True
-        partial_matches = [nid for nid in self.runtime if node_id in nid]
-        if any(partial_matches):
+        else:
+            partial_matches = [nid for nid in self.runtime if node_id in nid]
+            if not any(partial_matches):
+                return False
             node.override_mem_gb(max(
                 self.runtime[partial_match] for
                 partial_match in partial_matches))
-            return True
-        return False
+        # observed usage takes precedence over the memory model
+        node._memory_modelled = True  # pylint: disable=protected-access
+        return True
 
     def _prerun_check(self, graph):
         """Check if any node exeeds the available resources"""
+        if self._pid_dir is not None:
+            # removed after each run
+            os.makedirs(self._pid_dir, exist_ok=True)
         tasks_mem_gb = []
         tasks_num_th = []
         overrun_message_mem = None
@@ -192,6 +617,8 @@ class CpacNipypeCustomPluginMixin():
         # estimate of C-PAC + Nipype overhead (GB):
         overhead_memory_estimate = 1
         for node in graph.nodes():
+            if hasattr(self, 'memory_model'):
+                self._model_memory_estimate(node)
             if hasattr(self, 'runtime'):
                 self._override_memory_estimate(node)
             try:
@@ -284,6 +711,9 @@ class CpacNipypeCustomPluginMixin():
                 tasks_list_msg,
             )
             self._stats = stats
+            if self._metrics is not None:
+                self._write_metrics(num_ready, free_memory_gb,
+                                    free_processors)
 
         if self.raise_insufficient:
             if free_memory_gb < self.peak or free_processors == 0:
@@ -299,12 +729,18 @@ class CpacNipypeCustomPluginMixin():
 
         jobids = self._sort_jobs(jobids,
                                  scheduler=self.plugin_args.get("scheduler"))
+        shared = bool(self.plugin_args.get('participant_share'))
+        usage = self._participant_usage() if shared else None
+        jobids = self._prioritize(jobids, usage)
+        if shared:
+            ready_participants = {self._participant(jobid) for
+                                  jobid in jobids}
 
         # Run garbage collector before potentially submitting jobs
         gc.collect()
 
         # Submit jobs
-        for jobid in jobids:
+        for position, jobid in enumerate(jobids):
             force_allocate_job = False
             # First expand mapnodes
             if isinstance(self.procs[jobid], MapNode):
@@ -319,6 +755,12 @@ class CpacNipypeCustomPluginMixin():
                     if not submit:
                         continue
 
+            if hasattr(self, 'memory_model'):
+                self._model_memory_estimate(self.procs[jobid])
+            if self._thread_limits is not None:
+                self._adapt_threads(jobid, free_processors,
+                                    len(jobids) - position)
+
             # Check requirements of this job
             next_job_gb = min(self.procs[jobid].mem_gb, self.memory_gb)
             next_job_th = min(self.procs[jobid].n_procs, self.processors)
@@ -340,6 +782,16 @@ class CpacNipypeCustomPluginMixin():
                     next_job_th,
                 )
                 continue
+            if shared and not force_allocate_job and self._exceeds_share(
+                usage, jobid, next_job_gb, next_job_th, ready_participants
+            ):
+                logger.debug(
+                    "Deferring job %s ID=%d: its participant is using its "
+                    "share while others have jobs ready.",
+                    self.procs[jobid].fullname,
+                    jobid,
+                )
+                continue
 
             free_memory_gb -= next_job_gb
             free_processors -= next_job_th
@@ -357,6 +809,9 @@ class CpacNipypeCustomPluginMixin():
             # change job status in appropriate queues
             self.proc_done[jobid] = True
             self.proc_pending[jobid] = True
+            if self._metrics is not None:
+                self._participant_started.setdefault(
+                    self._participant(jobid), time.time())
 
             # If cached and up-to-date just retrieve it, don't run
             if self._local_hash_check(jobid, graph):
@@ -394,5 +849,9 @@ class CpacNipypeCustomPluginMixin():
                 self.proc_pending[jobid] = False
             else:
                 self.pending_tasks.insert(0, (tid, jobid))
+                if shared:
+                    used = usage.setdefault(self._participant(jobid), [0, 0])
+                    used[0] += next_job_gb
+                    used[1] += next_job_th
             # Display stats next loop
             self._stats = None
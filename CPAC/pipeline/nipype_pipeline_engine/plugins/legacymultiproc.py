@@ -2,6 +2,8 @@
 Override Nipype's LegacyMultiProc:
 * _prerun_check to tell which Nodes use too many resources.
 * _check_resources to account for the main process' memory usage.
+* _submit_job to record worker PIDs for live memory management and
+  set adapted thread counts.
 
 Copyright (C) 2022  C-PAC Developers
 
@@ -20,9 +22,10 @@ License for more details.
 You should have received a copy of the GNU Lesser General Public
 License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
 """
-from nipype.pipeline.plugins.legacymultiproc import \
+from nipype.pipeline.plugins.legacymultiproc import logger, \
     LegacyMultiProcPlugin as LegacyMultiProc
-from .cpac_nipype_custom import CpacNipypeCustomPluginMixin
+from .cpac_nipype_custom import CpacNipypeCustomPluginMixin, \
+                                run_node_in_worker
 
 
 class LegacyMultiProcPlugin(CpacNipypeCustomPluginMixin, LegacyMultiProc):
@@ -30,3 +33,22 @@ class LegacyMultiProcPlugin(CpacNipypeCustomPluginMixin, LegacyMultiProc):
     __doc__ = LegacyMultiProc.__doc__
     _check_resources = CpacNipypeCustomPluginMixin._check_resources
     _prerun_check = CpacNipypeCustomPluginMixin._prerun_check
+
+    def _submit_job(self, node, updatehash=False):
+        environ = getattr(node, '_thread_environ', None)
+        if self._pid_dir is None and not environ:
+            return super()._submit_job(node, updatehash)
+        self._taskid += 1
+
+        # Don't allow streaming outputs
+        if getattr(node.interface, "terminal_output", "") == "stream":
+            node.interface.terminal_output = "allatonce"
+
+        self._task_obj[self._taskid] = self.pool.apply_async(
+            run_node_in_worker, (node, updatehash, self._taskid,
+                                 self._pid_dir, environ),
+            callback=self._async_callback)
+
+        logger.debug("[LegacyMultiProc] Submitted task %s (taskid=%d).",
+                     node.fullname, self._taskid)
+        return self._taskid
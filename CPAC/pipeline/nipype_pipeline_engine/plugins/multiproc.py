@@ -2,6 +2,7 @@
 Override Nipype's MultiProc:
 * _prerun_check to tell which Nodes use too many resources.
 * _check_resources to account for the main process' memory usage.
+* _submit_job to record worker PIDs for live memory monitoring.
 
 Copyright (C) 2022  C-PAC Developers
 
@@ -20,8 +21,10 @@ License for more details.
 You should have received a copy of the GNU Lesser General Public
 License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
 """
-from nipype.pipeline.plugins.multiproc import MultiProcPlugin as MultiProc
-from .cpac_nipype_custom import CpacNipypeCustomPluginMixin
+from nipype.pipeline.plugins.multiproc import logger, \
+                                             MultiProcPlugin as MultiProc
+from .cpac_nipype_custom import CpacNipypeCustomPluginMixin, \
+                                run_node_in_worker
 
 
 class MultiProcPlugin(CpacNipypeCustomPluginMixin, MultiProc):
@@ -29,3 +32,23 @@ class MultiProcPlugin(CpacNipypeCustomPluginMixin, MultiProc):
     __doc__ = MultiProc.__doc__
     _check_resources = CpacNipypeCustomPluginMixin._check_resources
     _prerun_check = CpacNipypeCustomPluginMixin._prerun_check
+
+    def _submit_job(self, node, updatehash=False):
+        environ = getattr(node, '_thread_environ', None)
+        if self._pid_dir is None and not environ:
+            return super()._submit_job(node, updatehash)
+        self._taskid += 1
+
+        # Don't allow streaming outputs
+        if getattr(node.interface, "terminal_output", "") == "stream":
+            node.interface.terminal_output = "allatonce"
+
+        result_future = self.pool.submit(run_node_in_worker, node,
+                                         updatehash, self._taskid,
+                                         self._pid_dir, environ)
+        result_future.add_done_callback(self._async_callback)
+        self._task_obj[self._taskid] = result_future
+
+        logger.debug("[MultiProc] Submitted task %s (taskid=%d).",
+                     node.fullname, self._taskid)
+        return self._taskid
@@ -0,0 +1,398 @@
+# Copyright (C) 2022  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Estimate what a built participant workflow will cost before running it
+
+A plan counts the strategies per resource, the nodes per node-block
+and the expected outputs of a built workflow and, from callback logs
+and output directories of earlier runs when available, estimates its
+CPU-hours, peak memory and output disk usage. The same observations
+estimate how long the chain of work depending on each node will take,
+so that schedulers can start long-pole nodes first.
+"""
+import json
+import os
+import re
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from statistics import median
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from CPAC.utils.interfaces.datasink import DataSink
+
+_PIPE_NUMBER = re.compile(r'_\d+(?=\.|$)')
+
+
+class NodeUsage(NamedTuple):
+    """Observed resource usage of one node"""
+    cpu_hours: float
+    memory_gb: float
+
+
+def _node_key(fullname):
+    """Node name without the participant workflow's name"""
+    return fullname.split('.', 1)[-1]
+
+
+def _group_key(node_key):
+    """Node name without pipe numbers, shared by a node's forks
+
+    Examples
+    --------
+    >>> _group_key('func_preproc_12.motion_correct_3dvolreg_12')
+    'func_preproc.motion_correct_3dvolreg'
+    """
+    return _PIPE_NUMBER.sub('', node_key)
+
+
+def _number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(
+        value, bool) else None
+
+
+def _timestamp(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else None
+
+
+def _callback_usage(callback_logs):
+    """Each finished node's callback-log entry and ``NodeUsage``"""
+    for callback_log in callback_logs:
+        if not callback_log or not os.path.exists(callback_log):
+            continue
+        with open(callback_log, 'r', encoding='utf-8') as log_file:
+            for line in log_file:
+                try:
+                    node = json.loads(line)
+                    start = _timestamp(node.get('start'))
+                    finish = _timestamp(node.get('finish'))
+                except (AttributeError, ValueError):
+                    continue
+                if start is None or finish is None or 'id' not in node:
+                    continue
+                threads = _number(node.get('runtime_threads')) or _number(
+                    node.get('num_threads')) or 1
+                memory = _number(node.get('runtime_memory_gb')) or _number(
+                    node.get('estimated_memory_gb')) or 0
+                yield node, NodeUsage(
+                    (finish - start).total_seconds() / 3600 * threads,
+                    memory)
+
+
+def load_callback_usage(callback_logs: Iterable[str]) -> Dict[str, NodeUsage]:
+    """Read observed per-node usage from callback logs of earlier runs.
+
+    Parameters
+    ----------
+    callback_logs : iterable of str
+        paths to ``callback.log`` files; missing paths are skipped
+
+    Returns
+    -------
+    dict
+        node name without the participant workflow's name to
+        ``NodeUsage``, keeping the largest observation of each node
+    """
+    usage = {}
+    for node, observed in _callback_usage(callback_logs):
+        key = _node_key(node['id'])
+        usage[key] = NodeUsage(*map(max, zip(usage.get(key, observed),
+                                             observed)))
+    return usage
+
+
+class ParticipantHours(NamedTuple):
+    """Observed CPU-hours and wall-clock hours of one participant"""
+    cpu_hours: float
+    hours: float
+
+
+def load_participant_hours(callback_logs: Iterable[str]
+                           ) -> Dict[str, ParticipantHours]:
+    """Read the CPU-hours each participant workflow of earlier runs took,
+    and the wall-clock hours from its first node's start to its last
+    node's finish, from their callback logs.
+
+    Parameters
+    ----------
+    callback_logs : iterable of str
+        paths to ``callback.log`` files; missing paths are skipped
+
+    Returns
+    -------
+    dict
+        participant workflow's name to ``ParticipantHours``
+    """
+    cpu_hours = {}
+    spans = {}
+    for node, observed in _callback_usage(callback_logs):
+        workflow = node['id'].split('.', 1)[0]
+        cpu_hours[workflow] = cpu_hours.get(workflow, 0) + observed.cpu_hours
+        start, finish = _timestamp(node['start']), _timestamp(node['finish'])
+        first, last = spans.get(workflow, (start, finish))
+        spans[workflow] = (min(first, start), max(last, finish))
+    return {workflow: ParticipantHours(
+        cpu_hours[workflow],
+        (spans[workflow][1] - spans[workflow][0]).total_seconds() / 3600)
+        for workflow in cpu_hours}
+
+
+def load_thread_limits(callback_logs: Iterable[str]) -> Dict[str, int]:
+    """Read how many threads each node type has been able to use from
+    callback logs of earlier runs.
+
+    A node type that never kept all of more than one allocated thread
+    busy is limited to the most threads it was seen to use. Node types
+    that did, or that only ran single-threaded, may scale further and
+    aren't limited.
+
+    Parameters
+    ----------
+    callback_logs : iterable of str
+        paths to ``callback.log`` files; missing paths are skipped
+
+    Returns
+    -------
+    dict
+        node name without the participant workflow's name and pipe
+        numbers to its most useful threads
+    """
+    used = {}
+    for node, _ in _callback_usage(callback_logs):
+        allocated = _number(node.get('num_threads')) or 1
+        busy = _number(node.get('runtime_threads'))
+        if allocated > 1 and busy is not None:
+            used.setdefault(_group_key(_node_key(node['id'])), []).append(
+                (busy, allocated))
+    return {key: max(1, int(max(busy for busy, _ in observed))) for
+            key, observed in used.items() if
+            all(busy < allocated for busy, allocated in observed)}
+
+
+def _group_usage(usage):
+    """Median CPU-hours and largest memory of each node type's forks"""
+    group_usage = {}
+    for key, observed in usage.items():
+        group_usage.setdefault(_group_key(key), []).append(observed)
+    return {key: NodeUsage(median(obs.cpu_hours for obs in observed),
+                           max(obs.memory_gb for obs in observed))
+            for key, observed in group_usage.items()}
+
+
+def critical_path_hours(graph, nodes: List, callback_logs: Iterable[str] = ()
+                        ) -> List[float]:
+    """Estimate, for each node, the hours from its start to the end of
+    the longest chain of nodes that depends on it.
+
+    A node's duration is its observed CPU-hours in earlier runs divided
+    by its threads, or the median of its node type's forks. Nodes never
+    observed take the median observed duration, or 1 if nothing was
+    observed, so that without history a path's length counts its nodes.
+
+    Parameters
+    ----------
+    graph : networkx.DiGraph
+        execution graph
+
+    nodes : list
+        every node of ``graph``, in topological order
+
+    callback_logs : iterable of str
+        callback logs of earlier runs of this or similar pipelines
+
+    Returns
+    -------
+    list of float
+        remaining critical-path hours of each of ``nodes``
+    """
+    usage = load_callback_usage(callback_logs)
+    group_usage = _group_usage(usage)
+    default = median(observed.cpu_hours for observed in
+                     usage.values()) if usage else 1
+    index = {node: i for i, node in enumerate(nodes)}
+    remaining = [0.0] * len(nodes)
+    for i in reversed(range(len(nodes))):
+        key = _node_key(nodes[i].fullname)
+        observed = usage.get(key, group_usage.get(_group_key(key)))
+        duration = default if observed is None else (
+            observed.cpu_hours / max(1, nodes[i].n_procs))
+        remaining[i] = duration + max((remaining[index[successor]] for
+                                       successor in graph.successors(
+                                           nodes[i])), default=0)
+    return remaining
+
+
+def _directory_size_gb(path):
+    return sum(os.path.getsize(os.path.join(root, filename)) for
+               root, _, filenames in os.walk(path) for
+               filename in filenames) / 1024 ** 3
+
+
+@dataclass
+class PipelinePlan:
+    """Counts and cost estimates for one participant's workflow"""
+    participant: str
+    strategies: Dict[str, int] = field(default_factory=dict)
+    """number of strategies per resource"""
+    nodes: Dict[str, int] = field(default_factory=dict)
+    """number of nodes per node name without pipe numbers"""
+    outputs: int = 0
+    """number of outputs connected to DataSinks"""
+    cpu_hours: Optional[float] = None
+    """CPU-hours of the nodes with earlier observations"""
+    unestimated_nodes: int = 0
+    """number of nodes without earlier observations"""
+    peak_memory_gb: float = 0
+    """memory of the most memory-hungry nodes that can run at once"""
+    disk_gb: Optional[float] = None
+    """mean output size of earlier participants"""
+
+    @property
+    def total_nodes(self):
+        """number of nodes in the workflow"""
+        return sum(self.nodes.values())
+
+    @property
+    def max_strategies(self):
+        """largest number of strategies of any resource"""
+        return max(self.strategies.values(), default=0)
+
+    def report(self):
+        """Human-readable summary"""
+        forked = {resource: count for resource, count in
+                  self.strategies.items() if count > 1}
+        lines = [f'Pipeline plan for {self.participant}:',
+                 f'    Nodes: {self.total_nodes}',
+                 f'    Resources: {len(self.strategies)} '
+                 f'({len(forked)} with more than one strategy, at most '
+                 f'{self.max_strategies})',
+                 f'    Outputs: {self.outputs}',
+                 '    Estimated CPU-hours: ' + (
+                     'unknown' if self.cpu_hours is None else
+                     f'{self.cpu_hours:.2f}' + (
+                         f' ({self.unestimated_nodes} nodes not estimated)'
+                         if self.unestimated_nodes else '')),
+                 f'    Estimated peak memory (GB): {self.peak_memory_gb:.2f}',
+                 '    Estimated output disk usage (GB): ' + (
+                     'unknown' if self.disk_gb is None else
+                     f'{self.disk_gb:.2f}')]
+        return '\n'.join(lines)
+
+    def save(self, filename):
+        """Write this plan to a JSON file and return its path"""
+        with open(filename, 'w', encoding='utf-8') as plan_file:
+            json.dump(asdict(self), plan_file, indent=2)
+        return filename
+
+    @classmethod
+    def load(cls, filename):
+        """Read a plan written by ``save``"""
+        with open(filename, 'r', encoding='utf-8') as plan_file:
+            return cls(**json.load(plan_file))
+
+
+def plan_workflow(wf, participant, strategies=None, callback_logs=(),
+                  reference_output_dirs=(), max_concurrent_nodes=1
+                  ) -> PipelinePlan:
+    """Count and estimate the cost of a built participant workflow
+    without running it.
+
+    Parameters
+    ----------
+    wf : Workflow
+
+    participant : str
+
+    strategies : dict, optional
+        number of strategies per resource, as from
+        ``ResourcePool.strategy_counts``
+
+    callback_logs : iterable of str
+        callback logs of earlier runs of this or similar pipelines
+
+    reference_output_dirs : iterable of str
+        output directories of earlier participants of this pipeline
+
+    max_concurrent_nodes : int
+        most nodes that can run at once for one participant
+
+    Returns
+    -------
+    PipelinePlan
+    """
+    # pylint: disable=protected-access
+    graph = wf._create_flat_graph()
+    usage = load_callback_usage(callback_logs)
+    group_usage = _group_usage(usage)
+
+    plan = PipelinePlan(participant, strategies=dict(strategies or {}))
+    cpu_hours = 0
+    memory = []
+    for node in graph.nodes():
+        key = _node_key(node.fullname)
+        group = _group_key(key)
+        plan.nodes[group] = plan.nodes.get(group, 0) + 1
+        if isinstance(node.interface, DataSink):
+            plan.outputs += sum(len(data['connect']) for *_, data in
+                                graph.in_edges(node, data=True))
+        observed = usage.get(key, group_usage.get(group))
+        if observed is None:
+            plan.unestimated_nodes += 1
+            try:
+                memory.append(node.mem_gb)
+            except (FileNotFoundError, KeyError, TypeError):
+                memory.append(node._mem_gb)
+        else:
+            cpu_hours += observed.cpu_hours
+            memory.append(observed.memory_gb)
+    if usage:
+        plan.cpu_hours = cpu_hours
+    plan.peak_memory_gb = sum(sorted(memory, reverse=True)[
+        :max(1, max_concurrent_nodes)])
+    sizes = [_directory_size_gb(path) for path in reference_output_dirs if
+             os.path.isdir(path)]
+    if sizes:
+        plan.disk_gb = sum(sizes) / len(sizes)
+    return plan
+
+
+def cohort_plan(plans: Iterable[PipelinePlan]) -> dict:
+    """Total the plans of a cohort's participants
+
+    Examples
+    --------
+    >>> cohort_plan([PipelinePlan('sub-1', {'T1w': 1}, {'a': 3}, 2, 1.5,
+    ...                           peak_memory_gb=4),
+    ...              PipelinePlan('sub-2', {'T1w': 2}, {'a': 5}, 4, None, 5,
+    ...                           peak_memory_gb=3, disk_gb=2)])
+    ... # doctest: +NORMALIZE_WHITESPACE
+    {'participants': 2, 'nodes': 8, 'outputs': 6, 'max_strategies': 2,
+     'cpu_hours': 1.5, 'unestimated_nodes': 5, 'peak_memory_gb': 4,
+     'disk_gb': 2}
+    """
+    plans = list(plans)
+    known = [plan.cpu_hours for plan in plans if plan.cpu_hours is not None]
+    disks = [plan.disk_gb for plan in plans if plan.disk_gb is not None]
+    return {
+        'participants': len(plans),
+        'nodes': sum(plan.total_nodes for plan in plans),
+        'outputs': sum(plan.outputs for plan in plans),
+        'max_strategies': max((plan.max_strategies for plan in plans),
+                              default=0),
+        'cpu_hours': sum(known) if known else None,
+        'unestimated_nodes': sum(plan.unestimated_nodes for plan in plans),
+        'peak_memory_gb': max((plan.peak_memory_gb for plan in plans),
+                              default=0),
+        'disk_gb': sum(disks) if disks else None}
@@ -355,6 +355,7 @@ latest_schema = Schema({
             'pull_source_once': bool1_1,
             'write_func_outputs': bool1_1,
             'write_debugging_outputs': bool1_1,
+            'batch_sinks': bool1_1,
             'output_tree': str,
             'quality_control': {
                 'generate_quality_control_images': bool1_1,
@@ -364,6 +365,7 @@ latest_schema = Schema({
         'working_directory': {
             'path': str,
             'remove_working_dir': bool1_1,
+            'cache_workflow': bool1_1,
         },
         'log_directory': {
             'run_logging': bool1_1,
@@ -393,6 +395,11 @@ latest_schema = Schema({
                     'parallel_environment': Maybe(str),
                     'queue': Maybe(str),
                 },
+                'pack_tasks': {
+                    'run': bool1_1,
+                    'max_hours': All(Number, Range(min=0, min_included=False)),
+                    'margin': All(Number, Range(min=1)),
+                },
             },
             'maximum_memory_per_participant': Number,
             'raise_insufficient': bool1_1,
@@ -400,12 +407,38 @@ latest_schema = Schema({
             'num_ants_threads': int,
             'num_OMP_threads': int,
             'num_participants_at_once': int,
+            'participant_retries': {
+                'max_retries': All(int, Range(min=0)),
+                'backoff': All(Number, Range(min=0)),
+            },
+            'pack_participants': bool1_1,
+            'prebuild_workflows': bool1_1,
+            'merge_duplicate_nodes': bool1_1,
+            'shared_scheduler': {
+                'run': bool1_1,
+                'priority': In({'fair', 'in_order'}),
+            },
+            'critical_path_priority': bool1_1,
+            'live_memory': {
+                'run': bool1_1,
+                'defer_at': All(Number, Range(min=0, max=1)),
+                'suspend_at': Maybe(All(Number, Range(min=0, max=1))),
+            },
+            'adaptive_threads': bool1_1,
+            'scheduler_metrics': {
+                'run': bool1_1,
+                'interval': All(Number, Range(min=0)),
+            },
             'random_seed': Maybe(Any(
                 'random',
                 All(int, Range(min=1, max=np.iinfo(np.int32).max)))),
             'observed_usage': {
                 'callback_log': Maybe(str),
                 'buffer': Number,
+                'memory_model': {
+                    'path': Maybe(str),
+                    'margin': Number,
+                },
             },
         },
         'Amazon-AWS': {
@@ -1003,10 +1036,12 @@ latest_schema = Schema({
                 'sca_roi_paths', valid_options['sca']['roi_paths'])
         ),
         'norm_timeseries_for_DR': bool1_1,
+        'in_process': bool1_1,
     },
     'network_centrality': {
         'run': bool1_1,
         'memory_allocation': Number,
+        'in_process': bool1_1,
         'template_specification_file': Maybe(str),
         'degree_centrality': {
             'weight_options': [In(
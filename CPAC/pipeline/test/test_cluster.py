@@ -0,0 +1,44 @@
+"""Tests for packing participants into cluster job-array tasks"""
+import json
+import yaml
+from CPAC.pipeline.cluster import LocalScheduler, pack_tasks, task_arrays, \
+                                  write_tasks
+
+
+def _record_participant(sub_dict, c, *args):
+    if sub_dict['subject_id'] == 'sub-fail':
+        raise RuntimeError('participant failed')
+    with open(sub_dict['record'], 'a', encoding='utf-8') as record:
+        print(json.dumps([sub_dict['subject_id'], c[
+            'pipeline_setup', 'system_config', 'max_cores_per_participant'
+        ], c['pipeline_setup', 'system_config',
+             'maximum_memory_per_participant']]), file=record)
+
+
+def test_local_scheduler(tmp_path):
+    '''Test that the local stand-in scheduler runs each packed task's
+    participants within the task's requests'''
+    record = str(tmp_path / 'record.jsonl')
+    sublist = [{'subject_id': subject_id, 'record': record} for
+               subject_id in ('sub-1', 'sub-2', 'sub-3', 'sub-fail')]
+    subject_list_file = str(tmp_path / 'data_config.yml')
+    config_file = str(tmp_path / 'pipeline_config.yml')
+    with open(subject_list_file, 'w', encoding='utf-8') as data_config:
+        yaml.safe_dump(sublist, data_config)
+    with open(config_file, 'w', encoding='utf-8') as pipeline_config:
+        yaml.safe_dump({'pipeline_setup': {'pipeline_name': 'cluster'}},
+                       pipeline_config)
+    tasks = pack_tasks([(1, 1.5), (1, 2), (2, 6), (1, 2)], [2, 1, 5, 1],
+                       max_hours=4)
+    assert [task.participants for task in tasks] == [[2], [0, 1, 3]]
+    array_tasks = []
+    for array_idx, array in enumerate(task_arrays(tasks)):
+        tasks_file = write_tasks(str(tmp_path / f'tasks.{array_idx}.json'),
+                                 array, config_file, subject_list_file)
+        array_tasks += LocalScheduler(
+            max_cores=2, max_memory_gb=8, target=_record_participant
+        ).submit(tasks_file)
+    assert [job.exitcode for job in array_tasks] == [0, 1]
+    with open(record, 'r', encoding='utf-8') as records:
+        assert sorted(json.loads(line) for line in records) == [
+            ['sub-1', 1, 2], ['sub-2', 1, 2], ['sub-3', 2, 6]]
@@ -1,6 +1,8 @@
 """Tests for cpac_pipeline.py"""
 import pytest
-from CPAC.pipeline.cpac_pipeline import run_workflow
+from nipype.interfaces.utility import IdentityInterface
+from CPAC.pipeline import nipype_pipeline_engine as pe
+from CPAC.pipeline.cpac_pipeline import _packed_memory_budget, run_workflow
 from CPAC.pipeline.nipype_pipeline_engine.plugins import MultiProcPlugin
 from CPAC.utils.configuration import Configuration
 
@@ -24,3 +26,86 @@ def test_plugin_param(plugin):
             assert "MultiProcPlugin" in str(e.value)
         elif isinstance(plugin, bool):
             assert "bool" in str(e.value)
+
+
+class _FailingPlugin:
+    '''Stand-in for MultiProcPlugin that records its arguments and fails
+    like a node crashing mid-run'''
+    instances = []
+
+    def __init__(self, plugin_args):
+        self.plugin_args = plugin_args
+        self.instances.append(self)
+
+    def run(self, graph, updatehash=False, config=None):
+        # pylint: disable=unused-argument
+        raise RuntimeError('node crashed')
+
+
+def test_run_cohort_workflows(tmp_path, monkeypatch):
+    '''Test that a shared-scheduler run sizes the plugin for the
+    participants run at once and, when the run fails, still checks each
+    participant's outputs and removes its working directory'''
+    # pylint: disable=import-outside-toplevel
+    from nipype.interfaces.utility import IdentityInterface
+    from CPAC.pipeline import cpac_pipeline
+    from CPAC.pipeline.nipype_pipeline_engine import Node, Workflow
+
+    c = Configuration({'pipeline_setup': {
+        'pipeline_name': 'cohort',
+        'log_directory': {'path': str(tmp_path / 'log')},
+        'output_directory': {'path': str(tmp_path / 'output')},
+        'working_directory': {'path': str(tmp_path / 'working'),
+                              'remove_working_dir': True},
+        'system_config': {'num_participants_at_once': 4}}})
+
+    def build_workflow(sub, c, run, p_name=None, plugin_args=None):
+        # pylint: disable=unused-argument
+        assert run is False
+        wf = Workflow(f'cpac_{sub["subject_id"]}',
+                      base_dir=c.pipeline_setup['working_directory']['path'])
+        wf.add_nodes([Node(IdentityInterface(['x']), name='node')])
+        (tmp_path / 'working' / wf.name).mkdir(parents=True)
+        return wf
+
+    checked = []
+    monkeypatch.setattr(cpac_pipeline, 'run_workflow', build_workflow)
+    monkeypatch.setattr(cpac_pipeline, 'MultiProcPlugin', _FailingPlugin)
+    # 1 GB and 1 core per participant, whatever this machine has
+    monkeypatch.setattr(cpac_pipeline, 'check_config_resources',
+                        lambda c: (1, 1, 1, 1))
+    monkeypatch.setattr(cpac_pipeline, 'check_outputs',
+                        lambda output_dir, log_dir, pipe_name, subject_id:
+                        checked.append(subject_id) or '')
+    _FailingPlugin.instances.clear()
+    assert cpac_pipeline.run_cohort_workflows(
+        [{'subject_id': 'sub-1'}, {'subject_id': 'sub-2'}], c) == 1
+    plugin, = _FailingPlugin.instances
+    assert (plugin.plugin_args['n_procs'],
+            plugin.plugin_args['memory_gb']) == (2, 2)
+    assert plugin.plugin_args['participant_share']['n_procs'] == 1
+    assert checked == ['sub-1', 'sub-2']
+    assert not any((tmp_path / 'working').iterdir())
+
+
+def test_packed_memory_budget():
+    '''Test that a packed participant's budget fits its built workflow's
+    largest node, within the configured maximum'''
+    wf = pe.Workflow('cpac_sub-1')
+    inner = pe.Workflow('func_preproc')
+    inner.add_nodes([pe.Node(IdentityInterface(['x']), name='large',
+                             mem_gb=5)])
+    wf.add_nodes([inner, pe.Node(IdentityInterface(['x']), name='small',
+                                 mem_gb=0.5)])
+    assert _packed_memory_budget(wf, 2, 16) == 6
+    assert _packed_memory_budget(wf, 8, 16) == 8
+    assert _packed_memory_budget(wf, 2, 4) == 4
+
+    # pylint: disable=protected-access
+    graph = wf._create_flat_graph()
+    with pytest.raises(RuntimeError, match='Insufficient resources'):
+        MultiProcPlugin({'memory_gb': 2, 'n_procs': 1,
+                         'raise_insufficient': True})._prerun_check(graph)
+    MultiProcPlugin({'memory_gb': _packed_memory_budget(wf, 2, 16),
+                     'n_procs': 1, 'raise_insufficient': True}
+                    )._prerun_check(graph)
@@ -1,10 +1,21 @@
 
+import json
 import os
+import nibabel as nb
+import numpy as np
 import pytest
 import pkg_resources as p
-from CPAC.pipeline.cpac_runner import run_T1w_longitudinal
-from CPAC.pipeline.cpac_pipeline import load_cpac_pipe_config
+from CPAC.pipeline.cpac_runner import _prebuild_workers, \
+                                     pack_participants, \
+                                     participant_hours, \
+                                     participant_reservations, \
+                                     run_T1w_longitudinal
+from CPAC.pipeline.cpac_pipeline import load_cpac_pipe_config, \
+                                       run_workflow
+from CPAC.pipeline.job_manager import Job, JobManager
+from CPAC.pipeline.memory_model import MemoryModel, Observation
 from CPAC.utils.bids_utils import create_cpac_data_config
+from CPAC.utils.configuration import Configuration
 
 
 @pytest.mark.skip(reason='not a pytest test')
@@ -23,6 +34,92 @@ def test_run_T1w_longitudinal(bids_dir, cfg, test_dir, part_id):
     run_T1w_longitudinal(sub_data_list, cfg)
 
 
+def test_participant_reservations(tmp_path):
+    '''Test that participants reserve memory by the sizes of their images'''
+    store = str(tmp_path / 'memory_model.json')
+    model = MemoryModel(store)
+    for size in (1000, 2000, 4000):
+        model.add('cpac_sub-0.func_preproc_0.motion_correct_0',
+                  Observation(0.5 + size / 1000, size, 1))
+    model.save()
+    sublist = []
+    for participant, trs in [('sub-1', 1), ('sub-2', 3)]:
+        bold = str(tmp_path / f'{participant}_bold.nii.gz')
+        nb.Nifti1Image(np.zeros((10, 10, 10, trs), dtype=np.int8),
+                       np.eye(4)).to_filename(bold)
+        sublist.append({'subject_id': participant,
+                        'func': {'rest': {'scan': bold}}})
+    # sizes of remote images aren't known
+    sublist.append({'subject_id': 'sub-3',
+                    'func': {'rest': {'scan': 's3://bucket/bold.nii.gz'}}})
+    cfg = Configuration({'pipeline_setup': {'system_config': {
+        'maximum_memory_per_participant': 8,
+        'observed_usage': {'memory_model': {'path': store, 'margin': 0}}}}})
+    assert participant_reservations(sublist, cfg) == [
+        (1, pytest.approx(1.5 + 1)), (1, pytest.approx(3.5 + 1)), (1, 8)]
+    # never more than the configured maximum
+    cfg['pipeline_setup', 'system_config',
+        'maximum_memory_per_participant'] = 4
+    assert participant_reservations(sublist, cfg) == [
+        (1, pytest.approx(1.5 + 1)), (1, 4), (1, 4)]
+
+
+
+def test_pack_participants(monkeypatch):
+    '''Test that packed participants run with their reservations as
+    budgets and the configured maximum to raise them to'''
+    monkeypatch.setattr('CPAC.utils.utils.check_config_resources',
+                        lambda c: (8, 2, 1, 1))
+    cfg = Configuration({'pipeline_setup': {'system_config': {
+        'num_participants_at_once': 2}}})
+    plugin_args = {'status_callback': None}
+    jobs = [Job(f'sub-{i}', run_workflow, ({'subject_id': f'sub-{i}'}, cfg,
+                                          True, None, 'packed', 'MultiProc',
+                                          plugin_args, False))
+            for i in range(2)]
+    manager = JobManager(max_jobs=2)
+    pack_participants(jobs, cfg, manager)
+    assert (manager.max_jobs, manager.max_cores, manager.max_memory_gb
+            ) == (None, 4, 16)
+    for job in jobs:
+        assert job.args[1]['pipeline_setup', 'system_config',
+                           'maximum_memory_per_participant'] == 8
+        assert job.args[6] == {'status_callback': None,
+                               'maximum_memory_gb': 8}
+        assert job.args[7] is False
+    assert plugin_args == {'status_callback': None}
+
+@pytest.mark.parametrize('memory_gb,workers', [(8, 6), (2.5, 5), (0.2, 1)])
+def test_prebuild_workers(monkeypatch, memory_gb, workers):
+    '''Test that workflows are pre-built within the cores and memory of
+    num_participants_at_once participants'''
+    monkeypatch.setattr('CPAC.utils.utils.check_config_resources',
+                        lambda c: (memory_gb, 3, 1, 1))
+    cfg = Configuration({'pipeline_setup': {'system_config': {
+        'num_participants_at_once': 2}}})
+    assert _prebuild_workers(10, cfg) == workers
+    assert _prebuild_workers(1, cfg) == 1
+
+def test_participant_hours(tmp_path):
+    '''Test that participants' hours are divided by their cores only up
+    to the parallelism observed participants reached'''
+    callback_log = str(tmp_path / 'callback.log')
+    with open(callback_log, 'w', encoding='utf-8') as log_file:
+        for participant in ('sub-1', 'sub-2'):
+            # 3 CPU-hours over 2 hours
+            for node, start, finish in [('a', 0, 1), ('b', 0, 1),
+                                        ('c', 1, 2)]:
+                print(json.dumps({
+                    'id': f'cpac_{participant}.{node}', 'num_threads': 1,
+                    'start': f'2022-01-01T0{start}:00:00',
+                    'finish': f'2022-01-01T0{finish}:00:00'}),
+                    file=log_file)
+    cfg = Configuration({'pipeline_setup': {'system_config': {
+        'observed_usage': {'callback_log': callback_log},
+        'on_grid': {'pack_tasks': {'margin': 1}}}}})
+    assert participant_hours([{}, {}], cfg, [(1, 4), (4, 4)]) == [
+        pytest.approx(3), pytest.approx(2)]
+
 cfg = p.resource_filename("CPAC", os.path.join(
     "resources", "configs", "pipeline_config_default.yml"))
 bids_dir = "/Users/steven.giavasis/data/neurodata_hnu"
@@ -31,3 +128,43 @@ part_id = "0025427"
 
 if __name__ == '__main__':
     test_run_T1w_longitudinal(bids_dir, cfg, test_dir, part_id)
+
+
+def test_sequential_run_failures(tmp_path, monkeypatch):
+    '''Test that running participants one at a time reports only the
+    participants whose workflows failed to build as failing to start'''
+    # pylint: disable=import-outside-toplevel
+    import yaml
+    from CPAC.pipeline import cpac_pipeline, cpac_runner
+    config_file = str(tmp_path / 'pipeline_config.yml')
+    subject_list_file = str(tmp_path / 'data_config.yml')
+    with open(config_file, 'w', encoding='utf-8') as pipeline_config:
+        yaml.safe_dump({'FROM': 'default', 'pipeline_setup': {
+            'pipeline_name': 'sequential',
+            'output_directory': {'path': str(tmp_path / 'output')},
+            'working_directory': {'path': str(tmp_path / 'working')},
+            'log_directory': {'path': str(tmp_path / 'log')},
+            'system_config': {'num_participants_at_once': 1,
+                              'max_cores_per_participant': 1,
+                              'maximum_memory_per_participant': 1}}},
+                       pipeline_config)
+    with open(subject_list_file, 'w', encoding='utf-8') as data_config:
+        yaml.safe_dump([{'subject_id': 'sub-crashed', 'unique_id': None},
+                        {'subject_id': 'sub-unbuilt', 'unique_id': None}],
+                       data_config)
+
+    def run_workflow(sub, *args):
+        # pylint: disable=unused-argument
+        if sub['subject_id'] == 'sub-crashed':
+            raise cpac_pipeline.WorkflowRunError('cpac_sub-crashed did not '
+                                                 'complete')
+        raise ValueError('invalid participant')
+
+    failed_to_start = []
+    monkeypatch.setattr(cpac_pipeline, 'run_workflow', run_workflow)
+    monkeypatch.setattr(cpac_runner, 'failed_to_start',
+                        lambda log_dir, exception: failed_to_start.append(
+                            os.path.basename(log_dir)))
+    assert cpac_runner.run(subject_list_file, config_file,
+                           tracking=False) == 1
+    assert failed_to_start == ['sub-unbuilt']
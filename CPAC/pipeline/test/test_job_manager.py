@@ -0,0 +1,37 @@
+"""Tests for the participant and group-level job manager"""
+import os
+import sys
+from CPAC.pipeline.job_manager import Job, JobManager
+
+
+def _fail_once(marker):
+    # pylint: disable=missing-function-docstring
+    if not os.path.exists(marker):
+        open(marker, 'w', encoding='utf-8').close()
+        sys.exit(2)
+
+
+def test_job_manager(tmp_path):
+    '''Test that failed jobs are retried and exit codes recorded'''
+    pid_file = str(tmp_path / 'pid.txt')
+    jobs = JobManager(max_jobs=2, retries=1, backoff=0, pid_file=pid_file
+                      ).run([Job('flaky', _fail_once,
+                                 (str(tmp_path / 'marker'),)),
+                             Job('broken', sys.exit, (3,))])
+    assert [(job.attempts, job.exitcode) for job in jobs] == [(2, 0), (2, 3)]
+    assert [job.failed for job in jobs] == [False, True]
+    with open(pid_file, 'r', encoding='utf-8') as pids:
+        assert len(pids.read().split()) == 4
+
+
+def test_job_reservations():
+    '''Test that jobs only start when their reservations fit'''
+    manager = JobManager(max_cores=4, max_memory_gb=8)
+    big = Job('big', sys.exit, cores=4, memory_gb=12)
+    small = Job('small', sys.exit, cores=2, memory_gb=3)
+    # a job larger than the budget can still run alone
+    assert manager.fits(big)
+    manager.running['sentinel'] = (small, None)
+    assert manager.fits(Job('fits', sys.exit, cores=2, memory_gb=5))
+    assert not manager.fits(Job('too many cores', sys.exit, cores=3))
+    assert not manager.fits(Job('too much memory', sys.exit, memory_gb=6))
@@ -0,0 +1,89 @@
+"""Tests for the learned per-node memory model"""
+import json
+import nibabel as nb
+import numpy as np
+from nipype.interfaces.utility import Function
+from CPAC.pipeline import nipype_pipeline_engine as pe
+from CPAC.pipeline.memory_model import MemoryModel, update_memory_model
+from CPAC.pipeline.nipype_pipeline_engine.plugins import MultiProcPlugin
+
+
+def _write_callback_log(path, participant, shapes, threads=1):
+    with open(path, 'a', encoding='utf-8') as log_file:
+        for pipe_num, shape in enumerate(shapes):
+            print(json.dumps({
+                'id': f'cpac_{participant}.func_preproc_{pipe_num}.'
+                      f'motion_correct_{pipe_num}',
+                'runtime_memory_gb': 0.5 + 1e-6 * float(np.prod(shape)),
+                'input_data_shape': shape,
+                'num_threads': threads}), file=log_file)
+        print(json.dumps({'id': f'cpac_{participant}.sinker',
+                          'runtime_memory_gb': 'N/A'}), file=log_file)
+
+
+def test_memory_model_store(tmp_path):
+    '''Test that callback logs accumulate in the store once each and fit
+    memory to input size'''
+    store = str(tmp_path / 'memory_model.json')
+    callback_log = tmp_path / 'callback.log'
+    _write_callback_log(callback_log, 'sub-1_ses-1',
+                        [(10, 10, 10, 100), (10, 10, 10, 200)])
+    assert update_memory_model(store, [str(callback_log)]) == 2
+    assert update_memory_model(store, [str(callback_log)]) == 0
+    # too few observations to estimate from
+    assert MemoryModel(store).estimate(
+        'cpac_sub-3_ses-1.func_preproc_7.motion_correct_7') is None
+
+    _write_callback_log(callback_log, 'sub-2_ses-1', [(10, 10, 10, 400)])
+    assert update_memory_model(store, [str(callback_log)]) == 1
+    model = MemoryModel(store, margin=0)
+    fit = model.fit('cpac_sub-3_ses-1.func_preproc_7.motion_correct_7')
+    assert fit.observations == 3
+    assert np.isclose(model.estimate(
+        'cpac_sub-3_ses-1.func_preproc_7.motion_correct_7', 300000), 0.8)
+    # without a size, the largest observation
+    assert np.isclose(model.estimate(
+        'cpac_sub-3_ses-1.func_preproc_7.motion_correct_7'), 0.9)
+    # only one node type has been observed
+    assert np.isclose(model.peak_estimate(300000, concurrent=4), 0.8)
+    assert MemoryModel(str(tmp_path / 'empty.json')).peak_estimate() is None
+
+
+def test_model_memory_estimate(tmp_path):
+    '''Test that the plugin estimates a node's memory from its input once
+    that input exists'''
+    store = str(tmp_path / 'memory_model.json')
+    callback_log = tmp_path / 'callback.log'
+    _write_callback_log(callback_log, 'sub-1_ses-1',
+                        [(10, 10, 10, 100), (10, 10, 10, 200),
+                         (10, 10, 10, 400)])
+    update_memory_model(store, [str(callback_log)])
+
+    def motion_correct(in_file):
+        return in_file
+
+    node = pe.Node(Function(input_names=['in_file'],
+                            output_names=['out_file'],
+                            function=motion_correct),
+                   name='motion_correct_3', mem_gb=0.1,
+                   mem_x=(1, 'in_file'))
+    wf = pe.Workflow('cpac_sub-2_ses-1')
+    func_preproc = pe.Workflow('func_preproc_3')
+    func_preproc.add_nodes([node])
+    wf.add_nodes([func_preproc])
+    # pylint: disable=protected-access
+    node, = wf._create_flat_graph().nodes()
+    plugin = MultiProcPlugin({'n_procs': 1, 'memory_gb': 4,
+                              'memory_model': {'path': store, 'margin': 0}})
+
+    # input doesn't exist yet
+    plugin._model_memory_estimate(node)
+    assert node.mem_x is not None
+
+    in_file = str(tmp_path / 'bold.nii.gz')
+    nb.Nifti1Image(np.zeros((10, 10, 10, 300), dtype=np.int8),
+                   np.eye(4)).to_filename(in_file)
+    node.inputs.in_file = in_file
+    plugin._model_memory_estimate(node)
+    assert node.input_data_shape == (10, 10, 10, 300)
+    assert np.isclose(node.mem_gb, 0.8)
@@ -1,11 +1,20 @@
+import json
 import os
+import shutil
+import subprocess
+import threading
+import time
+import psutil
 import pytest
 from nibabel.testing import data_path
 from nipype import Function
+from nipype.interfaces import afni
 from nipype.interfaces.utility import IdentityInterface
 from traits.trait_base import Undefined
 from CPAC.pipeline.nipype_pipeline_engine import (
-    DEFAULT_MEM_GB, get_data_size, Node, MapNode, Workflow)
+    DEFAULT_MEM_GB, get_data_size, Node, MapNode, run_workflows, Workflow)
+from CPAC.pipeline.nipype_pipeline_engine.plugins import \
+    LegacyMultiProcPlugin, MultiProcPlugin
 
 
 def get_sample_data(filepath):
@@ -21,6 +30,11 @@ def square_func(x):  # pylint: disable=invalid-name
 square = Function(["x"], ["f_x"], square_func)
 
 
+def add_func(x, y):  # pylint: disable=invalid-name
+    # pylint: disable=missing-function-docstring
+    return x + y
+
+
 def test_MapNode():  # pylint: disable=invalid-name
     square_node = MapNode(square, name="square", iterfield=["x"])
     square_node.inputs.x = [0, 1, 2, 3]
@@ -67,3 +81,238 @@ def test_Workflow(tmpdir):  # pylint: disable=invalid-name
     out_node = list(out.nodes)[0]
     assert out_node.mem_gb == DEFAULT_MEM_GB + get_data_size(
         example_filepath, 'xyzt') * 0.1
+
+
+def test_merge_duplicates(tmpdir):
+    '''Test that identical nodes in nested workflows run once and feed
+    every fork'''
+    wf = Workflow('example_workflow', base_dir=tmpdir)
+    wf.merge_duplicates = True
+    source = Node(square, name='source')
+    source.inputs.x = 3
+    for fork in range(2):
+        nested = Workflow(f'fork{fork}')
+        square_node = Node(square, name='square')
+        add = Node(Function(['x', 'y'], ['sum'], add_func), name='add')
+        add.inputs.y = fork
+        nested.connect(square_node, 'f_x', add, 'x')
+        wf.connect(source, 'f_x', nested, 'square.x')
+    out = wf.run()
+    assert sorted(node.fullname for node in out.nodes) == [
+        'example_workflow.fork0.add', 'example_workflow.fork0.square',
+        'example_workflow.fork1.add', 'example_workflow.source']
+    assert sorted(node.result.outputs.sum for node in out.nodes if
+                  node.name == 'add') == [81, 82]
+
+
+def test_shared_scheduler(tmpdir):
+    '''Test that participants sharing one plugin take turns within their
+    shares and that all their nodes run'''
+    workflows = []
+    for participant in ('sub-1', 'sub-2'):
+        wf = Workflow(f'cpac_{participant}', base_dir=str(tmpdir))
+        for x in range(3):
+            square_node = Node(Function(['x'], ['f_x'], square_func),
+                               name=f'square{x}', mem_gb=0.1)
+            square_node.inputs.x = x
+            wf.add_nodes([square_node])
+        workflows.append(wf)
+    plugin_args = {'n_procs': 2, 'memory_gb': 1, 'participant_share': {
+        'n_procs': 1, 'memory_gb': 0.5, 'priority': 'fair'}}
+    plugin = MultiProcPlugin(plugin_args)
+    # pylint: disable=protected-access
+    plugin.procs = sorted((node for wf in workflows for
+                           node in wf._create_flat_graph().nodes()),
+                          key=lambda node: node.fullname)
+    plugin.pending_tasks = [(0, 0)]  # sub-1's first node is running
+    usage = plugin._participant_usage()
+    assert plugin._prioritize([1, 2, 3, 4, 5], usage) == [3, 4, 5, 1, 2]
+    assert plugin._exceeds_share(usage, 1, 0.1, 1, {'cpac_sub-1',
+                                                    'cpac_sub-2'})
+    assert not plugin._exceeds_share(usage, 1, 0.1, 1, {'cpac_sub-1'})
+    assert not plugin._exceeds_share(usage, 3, 0.1, 1, {'cpac_sub-1',
+                                                        'cpac_sub-2'})
+    plugin_args['participant_share']['priority'] = 'in_order'
+    assert plugin._prioritize([3, 1, 4], usage) == [1, 3, 4]
+
+    execgraphs = run_workflows(workflows, MultiProcPlugin({
+        'n_procs': 2, 'memory_gb': 4, 'participant_share': {
+            'n_procs': 1, 'memory_gb': 2, 'priority': 'fair'}}))
+    assert [sorted(node.result.outputs.f_x for node in execgraph) for
+            execgraph in execgraphs] == [[0, 1, 4], [0, 1, 4]]
+
+
+def _status(pid, expected):
+    '''A process's status, waiting briefly for a signal to take effect'''
+    for _ in range(20):
+        status = psutil.Process(pid).status()
+        if status == expected:
+            break
+        time.sleep(0.05)
+    return status
+
+
+def test_live_memory():
+    '''Test that the latest-started task is suspended above the
+    suspension threshold and resumed below the deferral threshold'''
+    plugin = MultiProcPlugin({'n_procs': 3, 'memory_gb': 1, 'live_memory': {
+        'run': True, 'defer_at': 0.5, 'suspend_at': 0.8}})
+    sleepers = [subprocess.Popen(['sleep', '60']) for _ in range(3)]
+    try:
+        # pylint: disable=protected-access
+        for tid, sleeper in enumerate(sleepers, 1):
+            with open(os.path.join(plugin._pid_dir, f'{tid}.pid'), 'w',
+                      encoding='utf-8') as pid:
+                pid.write(str(sleeper.pid))
+        # task 3 started last
+        plugin.pending_tasks = [(3, 2), (2, 1), (1, 0)]
+        plugin._manage_live_memory(0.9)
+        assert plugin._suspended == [3]
+        assert _status(sleepers[2].pid, psutil.STATUS_STOPPED) == \
+            psutil.STATUS_STOPPED
+        # a suspended task keeps its memory, so only suspend another
+        # while usage keeps rising
+        plugin._manage_live_memory(0.9)
+        assert plugin._suspended == [3]
+        plugin._manage_live_memory(0.95)
+        assert plugin._suspended == [3, 2]
+        # never suspend the last running task
+        plugin._manage_live_memory(0.99)
+        assert plugin._suspended == [3, 2]
+        plugin._manage_live_memory(0.4)
+        plugin._manage_live_memory(0.4)
+        assert not plugin._suspended
+        for sleeper in sleepers[1:]:
+            assert _status(sleeper.pid, psutil.STATUS_SLEEPING) != \
+                psutil.STATUS_STOPPED
+        # no new jobs at or above the deferral threshold
+        plugin.live_memory['defer_at'] = 0
+        assert plugin._check_live_memory([(1, 0)], 1, 2) == (0, 2)
+        # unless nothing is running
+        assert plugin._check_live_memory([], 1, 2) == (1, 2)
+    finally:
+        for sleeper in sleepers:
+            sleeper.kill()
+            sleeper.wait()
+        shutil.rmtree(plugin._pid_dir)
+
+
+def test_live_memory_used(monkeypatch):
+    '''Test that live memory counts this process and the workers running
+    tasks, but not idle workers'''
+    # pylint: disable=import-outside-toplevel,protected-access
+    from CPAC.pipeline.nipype_pipeline_engine.plugins import \
+        cpac_nipype_custom
+    plugin = MultiProcPlugin({'n_procs': 2, 'memory_gb': 4, 'live_memory': {
+        'run': True, 'defer_at': 0.9, 'suspend_at': None}})
+    sleepers = [subprocess.Popen(['sleep', '60']) for _ in range(2)]
+    try:
+        with open(os.path.join(plugin._pid_dir, '1.pid'), 'w',
+                  encoding='utf-8') as pid:
+            pid.write(str(sleepers[0].pid))
+        memory = {os.getpid(): 0.5, sleepers[0].pid: 1, sleepers[1].pid: 2}
+        monkeypatch.setattr(
+            cpac_nipype_custom, '_process_memory_gb',
+            lambda process, descendants=True: memory[process.pid])
+        plugin.pending_tasks = [(1, 0)]
+        assert plugin._used_memory_gb() == 1.5
+    finally:
+        for sleeper in sleepers:
+            sleeper.kill()
+            sleeper.wait()
+        shutil.rmtree(plugin._pid_dir)
+    assert cpac_nipype_custom._process_memory_gb(psutil.Process()) > 0
+
+
+def test_live_memory_admits_when_idle(tmpdir):
+    '''Test that a job starts with nothing running, even with the memory
+    in use above the deferral threshold'''
+    wf = Workflow('live_memory', base_dir=str(tmpdir))
+    wf.add_nodes([Node(square, name='square')])
+    wf.get_node('square').inputs.x = 3
+    run = threading.Thread(target=wf.run, kwargs={
+        'plugin': MultiProcPlugin({
+            'n_procs': 2, 'memory_gb': 4, 'live_memory': {
+                'run': True, 'defer_at': 0.02, 'suspend_at': None}})},
+        daemon=True)
+    run.start()
+    run.join(60)
+    assert not run.is_alive()
+    assert os.path.exists(os.path.join(str(tmpdir), 'live_memory', 'square',
+                                       'result_square.pklz'))
+
+
+def thread_environ_func():
+    # pylint: disable=missing-function-docstring
+    import os  # pylint: disable=redefined-outer-name,reimported
+    return os.environ.get('OMP_NUM_THREADS')
+
+
+def test_adaptive_threads(tmpdir):
+    '''Test that multi-threaded nodes get their share of the free
+    processors when dispatched, within their observed scaling'''
+    callback_log = str(tmpdir / 'callback.log')
+    with open(callback_log, 'w', encoding='utf-8') as log_file:
+        for runtime_threads in (2, 1, 2):
+            print(json.dumps({
+                'id': 'cpac_sub-1.limited', 'num_threads': 4,
+                'runtime_threads': runtime_threads,
+                'start': '2022-01-01T00:00:00',
+                'finish': '2022-01-01T00:10:00'}), file=log_file)
+    plugin = MultiProcPlugin({'n_procs': 8, 'memory_gb': 4,
+                              'adaptive_threads': {
+                                  'callback_logs': [callback_log]}})
+    plugin.procs = [Node(Function([], ['threads'], thread_environ_func),
+                         name=name, n_procs=n_procs) for name, n_procs in
+                    [('single', 1), ('multi', 2), ('limited', 4)]]
+    # takes a number of threads, but was built single-threaded
+    plugin.procs.append(Node(afni.Calc(), name='calc'))
+    # pylint: disable=protected-access
+    for jobid in range(4):
+        plugin._adapt_threads(jobid, free_processors=8, waiting=1)
+    assert [node.n_procs for node in plugin.procs] == [1, 8, 2, 1]
+    plugin._adapt_threads(1, free_processors=6, waiting=4)
+    assert plugin.procs[1].n_procs == 1
+    assert plugin.procs[1]._thread_environ['OMP_NUM_THREADS'] == '1'
+
+    wf = Workflow('cpac_sub-2', base_dir=str(tmpdir))
+    wf.add_nodes([Node(Function([], ['threads'], thread_environ_func),
+                       name='multi', n_procs=2, mem_gb=0.1)])
+    execgraph = wf.run(plugin=MultiProcPlugin({
+        'n_procs': 3, 'memory_gb': 4, 'adaptive_threads': {}}))
+    node, = execgraph.nodes()
+    assert node.result.outputs.threads == '3'
+
+
+def worker_pid_func(pid_dir):
+    # pylint: disable=missing-function-docstring
+    import os  # pylint: disable=redefined-outer-name,reimported
+    recorded = []
+    for pid_file in os.listdir(pid_dir):
+        with open(os.path.join(pid_dir, pid_file), 'r',
+                  encoding='utf-8') as pid:
+            recorded.append(pid.read())
+    return str(os.getpid()) in recorded, os.environ.get('OMP_NUM_THREADS')
+
+
+@pytest.mark.parametrize('plugin_class', [LegacyMultiProcPlugin,
+                                          MultiProcPlugin])
+def test_worker_pids(plugin_class, tmpdir):
+    '''Test that both multiprocessing plugins record their workers' PIDs
+    for live memory management and set adapted threads, and remove
+    their PID directory after the run'''
+    plugin = plugin_class({'n_procs': 3, 'memory_gb': 4,
+                           'adaptive_threads': {}, 'live_memory': {
+                               'run': True, 'defer_at': 1,
+                               'suspend_at': None}})
+    pid_dir = plugin._pid_dir  # pylint: disable=protected-access
+    wf = Workflow('cpac_sub-1', base_dir=str(tmpdir))
+    node = Node(Function(['pid_dir'], ['recorded', 'threads'],
+                         worker_pid_func), name='multi', n_procs=2,
+                mem_gb=0.1)
+    node.inputs.pid_dir = pid_dir
+    wf.add_nodes([node])
+    node, = wf.run(plugin=plugin).nodes()
+    assert (node.result.outputs.recorded, node.result.outputs.threads) == (
+        True, '3')
+    assert not os.path.exists(pid_dir)
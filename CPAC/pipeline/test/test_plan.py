@@ -0,0 +1,88 @@
+"""Tests for pipeline plans"""
+import json
+from CPAC.utils.interfaces.datasink import DataSink
+from nipype.interfaces.utility import IdentityInterface
+from CPAC.pipeline import nipype_pipeline_engine as pe
+from CPAC.pipeline.nipype_pipeline_engine.plugins import MultiProcPlugin
+from CPAC.pipeline.plan import cohort_plan, critical_path_hours, \
+    PipelinePlan, plan_workflow
+
+
+def test_plan_workflow(tmp_path):
+    '''Test counts and estimates from an earlier run's callback log'''
+    wf = pe.Workflow('cpac_sub-1_ses-1')
+    sinker = pe.Node(DataSink(), name='sinker')
+    for pipe_num in range(3):
+        node = pe.Node(IdentityInterface(fields=['x']),
+                       name=f'smooth_{pipe_num}', mem_gb=pipe_num + 1)
+        wf.connect(node, 'x', sinker, f'out{pipe_num}')
+    callback_log = tmp_path / 'callback.log'
+    with open(callback_log, 'w', encoding='utf-8') as log_file:
+        for line in [{'id': 'cpac_sub-2_ses-1.smooth_0',
+                      'start': '2022-04-16T14:00:00',
+                      'finish': '2022-04-16T14:30:00',
+                      'runtime_threads': 2, 'runtime_memory_gb': 1.5},
+                     {'id': 'cpac_sub-2_ses-1.smooth_1',
+                      'start': '2022-04-16T14:00:00',
+                      'finish': '2022-04-16T15:00:00',
+                      'runtime_threads': 1, 'runtime_memory_gb': 0.5},
+                     {'id': 'cpac_sub-2_ses-1.sinker'}]:
+            print(json.dumps(line), file=log_file)
+    output_dir = tmp_path / 'sub-2_ses-1'
+    output_dir.mkdir()
+    (output_dir / 'out.nii.gz').write_bytes(b'\0' * 1024 ** 2)
+
+    plan = plan_workflow(wf, 'sub-1_ses-1', {'desc-sm_bold': 3},
+                         callback_logs=[str(callback_log),
+                                        str(tmp_path / 'missing.log')],
+                         reference_output_dirs=[str(output_dir)],
+                         max_concurrent_nodes=2)
+    assert plan.nodes == {'smooth': 3, 'sinker': 1}
+    assert plan.outputs == 3
+    assert plan.max_strategies == 3
+    # smooth_2 uses the median of its forks; sinker has no timing
+    assert plan.cpu_hours == 1 + 1 + 1
+    assert plan.unestimated_nodes == 1
+    assert plan.peak_memory_gb == 2 + 1.5
+    assert plan.disk_gb == 1 / 1024
+
+    saved = PipelinePlan.load(plan.save(str(tmp_path / 'plan.json')))
+    assert saved == plan
+    assert cohort_plan([plan, saved])['cpu_hours'] == 6
+    assert 'Nodes: 4' in plan.report()
+
+
+def test_critical_path_priority(tmp_path):
+    '''Test that ready nodes with the longest chain of work after them
+    are dispatched first'''
+    wf = pe.Workflow('cpac_sub-1_ses-1')
+    chain = [pe.Node(IdentityInterface(fields=['x']), name=name) for
+             name in ('register_0', 'warp_0', 'derivative_0')]
+    for upstream, downstream in zip(chain, chain[1:]):
+        wf.connect(upstream, 'x', downstream, 'x')
+    wf.add_nodes([pe.Node(IdentityInterface(fields=['x']), name='qc_0')])
+    callback_log = tmp_path / 'callback.log'
+    with open(callback_log, 'w', encoding='utf-8') as log_file:
+        for name, finish in [('register_1', '12:00'), ('qc_0', '10:30')]:
+            print(json.dumps({'id': f'cpac_sub-2_ses-1.{name}',
+                              'start': '2022-04-16T10:00:00',
+                              'finish': f'2022-04-16T{finish}:00',
+                              'runtime_threads': 1}), file=log_file)
+    # pylint: disable=protected-access
+    graph = wf._create_flat_graph()
+    plugin = MultiProcPlugin({'n_procs': 1, 'memory_gb': 1, 'critical_path': {
+        'callback_logs': [str(callback_log)]}})
+    plugin._generate_dependency_list(graph)
+    remaining = dict(zip((node.name for node in plugin.procs),
+                         critical_path_hours(graph, plugin.procs,
+                                             [str(callback_log)])))
+    # unobserved nodes take the median observed duration
+    assert remaining == {'register_0': 2 + 1.25 + 1.25,
+                         'warp_0': 1.25 + 1.25, 'derivative_0': 1.25,
+                         'qc_0': 0.5}
+    # qc_0 comes first in nipype's order but has less work after it
+    ready = sorted((jobid for jobid, node in enumerate(plugin.procs) if
+                    node.name in ('qc_0', 'register_0')),
+                   key=lambda jobid: plugin.procs[jobid].name != 'qc_0')
+    assert [plugin.procs[jobid].name for jobid in
+            plugin._prioritize(ready)] == ['register_0', 'qc_0']
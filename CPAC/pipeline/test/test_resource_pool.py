@@ -0,0 +1,123 @@
+"""Tests for combining ResourcePool strategies"""
+from CPAC.pipeline.engine import ResourcePool
+
+
+def _rpool(strats):
+    rpool = ResourcePool()
+    for resource, variants in strats.items():
+        rpool.rpool[resource] = {}
+        for variant in variants:
+            prov = ['T1w:anat_ingress', f'{resource}:{variant}']
+            rpool.rpool[resource][str(prov)] = {
+                'data': (None, variant),
+                'json': {'CpacProvenance': prov,
+                         'CpacVariant': {resource: [variant]}}}
+    return rpool
+
+
+def test_get_strats_linked_and_dedup():
+    '''Test that linked inputs only combine matching variants and that
+    duplicate provenances make one strategy'''
+    rpool = _rpool({'desc-a_bold': ['x', 'y'],
+                    'desc-b_mask': ['x', 'y'],
+                    'desc-c_T1w': ['p', 'q']})
+    # a second key for the same provenance
+    duplicate = rpool.rpool['desc-c_T1w'][
+        "['T1w:anat_ingress', 'desc-c_T1w:q']"]
+    rpool.rpool['desc-c_T1w']['duplicate'] = duplicate
+    for strat in rpool.rpool['desc-b_mask'].values():
+        # variants of the same choice, as after a shared fork
+        strat['json']['CpacVariant'] = {
+            'desc-a_bold': strat['json']['CpacVariant']['desc-b_mask']}
+
+    strats = rpool.get_strats([('desc-a_bold', 'desc-b_mask'),
+                               'desc-c_T1w'])
+    assert [[prov[-1] for prov in strat_pool.get('json')['CpacProvenance']]
+            for strat_pool in strats.values()] == [
+        ['desc-a_bold:x', 'desc-b_mask:x', 'desc-c_T1w:p'],
+        ['desc-a_bold:x', 'desc-b_mask:x', 'desc-c_T1w:q'],
+        ['desc-a_bold:y', 'desc-b_mask:y', 'desc-c_T1w:p'],
+        ['desc-a_bold:y', 'desc-b_mask:y', 'desc-c_T1w:q']]
+    for pipe_idx, strat_pool in strats.items():
+        assert pipe_idx == str(strat_pool.get('json')['CpacProvenance'])
+        assert set(strat_pool.get('json')['subjson']) == {'bold', 'mask',
+                                                          'T1w'}
+
+
+def test_set_data_provenance():
+    '''Test that set_data shares interned provenance and serializes it
+    like the plain nested lists'''
+    import json
+    from CPAC.utils.provenance import Provenance
+    rpool = ResourcePool()
+    rpool.set_data('T1w', None, 'out', {}, '', 'anat_ingress')
+    t1w_json = rpool.get_json('T1w', "['T1w:anat_ingress']")
+    rpool.set_data('desc-brain_T1w', None, 'out',
+                   {'CpacProvenance': [t1w_json['CpacProvenance']]}, '',
+                   'masking')
+    pipe_idx = "[['T1w:anat_ingress'], 'desc-brain_T1w:masking']"
+    prov = rpool.get_cpac_provenance('desc-brain_T1w', pipe_idx)
+    assert isinstance(prov, Provenance)
+    assert prov[0] is t1w_json['CpacProvenance']
+    assert json.loads(json.dumps(prov)) == [['T1w:anat_ingress'],
+                                            'desc-brain_T1w:masking']
+    assert rpool.generate_prov_string(prov.to_list()) == ('desc-brain_T1w',
+                                                          pipe_idx)
+
+
+def test_strat_json_copy_on_write():
+    '''Test that strategy JSON shares the ResourcePool's metadata without
+    node blocks' writes reaching other strategies or the ResourcePool'''
+    import copy
+    rpool = _rpool({'desc-a_bold': ['x', 'y'], 'desc-c_T1w': ['p']})
+    original = copy.deepcopy(rpool.rpool)
+    strats = rpool.get_strats(['desc-a_bold', 'desc-c_T1w'])
+    first, second = (strat_pool.get('json') for strat_pool in
+                     strats.values())
+    assert first['subjson']['bold'] == rpool.get_json(
+        'desc-a_bold', "['T1w:anat_ingress', 'desc-a_bold:x']")
+
+    # as in NodeBlock.connect_block
+    new_json_info = copy.deepcopy(first)
+    new_json_info['CpacVariant']['desc-a_bold'].append('node_block')
+    del new_json_info['subjson']
+    assert first['CpacVariant']['desc-a_bold'] == ['x']
+    assert second['CpacVariant']['desc-a_bold'] == ['y']
+    assert 'subjson' in first
+    assert rpool.rpool == original
+
+
+def test_gather_pipes_batch_sinks(tmp_path):
+    '''Test that batched DataSinks receive the same outputs as one
+    DataSink per output and strategy'''
+    from CPAC.utils.interfaces.datasink import DataSink
+    from nipype.interfaces.utility import IdentityInterface
+    from CPAC.pipeline import nipype_pipeline_engine as pe
+    from CPAC.utils.configuration import Configuration
+
+    def _sink_fields(batch_sinks):
+        cfg = Configuration({'pipeline_setup': {
+            'output_directory': {'path': str(tmp_path),
+                                 'batch_sinks': batch_sinks},
+            'log_directory': {'path': str(tmp_path)}}})
+        cfg['subject_id'] = 'sub-1_ses-1'
+        rpool = ResourcePool(name='sub-1_ses-1', cfg=cfg)
+        wf = pe.Workflow(name='wf')
+        node = pe.Node(IdentityInterface(fields=['out']), name='source')
+        rpool.set_data('desc-preproc_T1w', node, 'out', {}, '', 'ingress')
+        for variant in ('a', 'b'):
+            rpool.set_data('space-T1w_desc-brain_mask', node, 'out',
+                           {'CpacVariant': {'brain_mask': [variant]}}, '',
+                           f'mask_{variant}', fork=True)
+        rpool.gather_pipes(wf, cfg)
+        sinks = [sink for sink in wf._graph.nodes() if
+                 isinstance(sink.interface, DataSink)]
+        return len(sinks), sorted(field.split('@')[0] for sink in sinks for
+                                  *_, data in wf._graph.in_edges(
+                                      sink, data=True) for
+                                  _, field in data['connect'])
+
+    individual, batched = _sink_fields(False), _sink_fields(True)
+    assert individual[0] == 3
+    assert batched[0] == 1
+    assert batched[1] == individual[1] == ['anat.'] * 6
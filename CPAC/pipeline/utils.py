@@ -16,6 +16,7 @@
 # License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
 """C-PAC pipeline engine utilities"""
 from typing import Union
+from CPAC.utils.provenance import Provenance
 
 
 def source_set(sources: Union[str, list, set]) -> set:
@@ -81,6 +82,8 @@ def source_set(sources: Union[str, list, set]) -> set:
     ...     'tpattern:func_metadata_ingress'})
     True
     """
+    if isinstance(sources, Provenance):
+        return set(sources.sources)
     _set = set()
     if isinstance(sources, str):
         _set.add(sources)
@@ -1,10 +1,14 @@
-from .peer import (
-    pypeer_eye_masking,
-    pypeer_zscore,
-    pypeer_ravel_data,
-    motion_scrub,
-    prep_for_pypeer
-)
+from CPAC.utils.lazy import lazy_attributes
+
+# imported on first access, so that importing CPAC.pypeer doesn't require
+# PyPEER until one of these is used
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    name: f'.peer:{name}' for name in (
+        'pypeer_eye_masking',
+        'pypeer_zscore',
+        'pypeer_ravel_data',
+        'motion_scrub',
+        'prep_for_pypeer')})
 
 __all__ = [
     'pypeer_eye_masking',
@@ -12,4 +16,4 @@ __all__ = [
     'pypeer_ravel_data',
     'motion_scrub',
     'prep_for_pypeer'
-]
\ No newline at end of file
+]
@@ -1,5 +1,4 @@
 import os
-import csv
 import glob
 import nibabel as nb
 import numpy as np
@@ -33,42 +32,92 @@ def make_pypeer_dir(dirpath):
                         "directory path:\n{0}\n".format(dirpath))
 
 
-def pypeer_eye_masking(data_path, eye_mask_path):
-    eye_mask = nb.load(eye_mask_path).get_data()
+def load_eye_mask(eye_mask_path):
+    """Load the eye mask and the boolean selection of its voxels.
 
-    data = load_data(data_path)
+    Returns
+    -------
+    eye_mask : numpy.ndarray
+        3D eye mask values
+
+    in_mask : numpy.ndarray
+        3D boolean array, True where ``eye_mask`` is nonzero
+    """
+    eye_mask = np.asanyarray(nb.load(eye_mask_path).dataobj)
+    return eye_mask, eye_mask != 0
+
+
+def pypeer_eye_masking(data_path, eye_mask_path, eye_mask=None):
+    """Eye-mask a scan's data.
+
+    Parameters
+    ----------
+    data_path : str
+
+    eye_mask_path : str
+
+    eye_mask : tuple, optional
+        ``load_eye_mask(eye_mask_path)``, to not load the mask again for
+        each scan
+
+    Returns
+    -------
+    numpy.ndarray
+        4D data in the scan's data type, zero outside the eye mask
+    """
+    if eye_mask is None:
+        eye_mask = load_eye_mask(eye_mask_path)
+    eye_mask, in_mask = eye_mask
 
-    for vol in range(data.shape[3]):
-        output = np.multiply(eye_mask, data[:, :, :, vol])
-        data[:, :, :, vol] = output
+    data = np.asanyarray(load_data(data_path))
+    if not data.flags.writeable:
+        data = data.copy()
+
+    # scale the in-mask voxels and zero the rest in place, rather than
+    # multiplying every volume by the full mask
+    data[in_mask] = data[in_mask] * eye_mask[in_mask][:, np.newaxis]
+    data[~in_mask] = 0
 
     return data
 
 
-def pypeer_zscore(data):
-    volumes = data.shape[3]
+def pypeer_zscore(data, in_mask=None):
+    """Z-score each voxel's timeseries, in place if ``data`` is float64.
+    Voxels with no variance are only demeaned.
 
-    for x in range(data.shape[0]):
-        for y in range(data.shape[1]):
-            for z in range(data.shape[2]):
-                vmean = np.mean(np.array(data[x, y, z, :]))
-                vstdv = np.std(np.array(data[x, y, z, :]))
+    Parameters
+    ----------
+    data : numpy.ndarray
+        4D eye-masked data
 
-                for time in range(volumes):
-                    if vstdv != 0:
-                        data[x, y, z, time] = (float(
-                            data[x, y, z, time]) - float(vmean)) / vstdv
-                    else:
-                        data[x, y, z, time] = float(
-                            data[x, y, z, time]) - float(vmean)
+    in_mask : numpy.ndarray or None
+        3D boolean array of the voxels to standardize. Voxels outside it
+        must be all zeros, as after ``pypeer_eye_masking``; if None, the
+        voxels with any nonzero value.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``data`` if it is float64, otherwise new float64 data
+    """
+    if in_mask is None:
+        in_mask = data.any(axis=3)
+    # only the in-mask voxels are converted; the rest stay zero
+    voxels = data[in_mask].astype(np.float64)
+    if data.dtype != np.float64:
+        data = np.zeros(data.shape)
+    voxels -= voxels.mean(axis=1, keepdims=True)
+    vstdv = voxels.std(axis=1, keepdims=True)
+    vstdv[vstdv == 0] = 1
+    voxels /= vstdv
+    data[in_mask] = voxels
 
     return data
 
 
 def pypeer_ravel_data(data):
-    raveled_data = [data[:, :, :, vol].ravel() for vol in
-                    np.arange(data.shape[3])]
-    return raveled_data
+    # one raveled volume per timepoint, as views where the layout allows
+    return list(np.moveaxis(data, 3, 0).reshape(data.shape[3], -1))
 
 
 def motion_scrub(_ms_filename, _motion_threshold):
@@ -92,13 +141,11 @@ def motion_scrub(_ms_filename, _motion_threshold):
     Adapted to accept a direct file path to the mean FD 1D file.
     """
 
-    with open(_ms_filename, 'r') as f:
-        reader = csv.reader(f)
-        censor_pre = [x[0] for x in reader]
-
-    nuissance_vector = [float(x) for x in censor_pre]
+    nuissance_vector = np.loadtxt(_ms_filename, delimiter=',', usecols=0,
+                                  ndmin=1)
 
-    _removed_indices = [i for i, x in enumerate(nuissance_vector) if x >= float(_motion_threshold)]
+    _removed_indices = np.flatnonzero(
+        nuissance_vector >= float(_motion_threshold)).tolist()
 
     return _removed_indices
 
@@ -140,6 +187,8 @@ def prep_for_pypeer(peer_scan_names, data_scan_names, eye_mask_path,
 
     print("Found input files:\n{0}\n".format(func_standard_paths))
 
+    eye_mask = load_eye_mask(eye_mask_path)
+
     pypeer_outdir = func_standard_paths[0].split("functional_to_standard")[0]
     pypeer_outdir = os.path.join(pypeer_outdir, "PyPEER")
 
@@ -151,11 +200,14 @@ def prep_for_pypeer(peer_scan_names, data_scan_names, eye_mask_path,
     for func_path in func_standard_paths:
         scan_label = func_path.split("/")[-2].replace("_scan_", "")
 
-        if scan_label in peer_scan_names or scan_label in data_scan_names:
-            print("Eye-masking and z-score standardizing "
-                  "{0}..".format(scan_label))
-            masked_data = pypeer_eye_masking(func_path, eye_mask_path)
-            data = pypeer_zscore(masked_data)
+        if scan_label not in peer_scan_names and \
+                scan_label not in data_scan_names:
+            continue
+
+        print("Eye-masking and z-score standardizing "
+              "{0}..".format(scan_label))
+        masked_data = pypeer_eye_masking(func_path, eye_mask_path, eye_mask)
+        data = pypeer_zscore(masked_data, eye_mask[1])
 
         if gsr:
             print("Global signal regression for {0}..".format(scan_label))
@@ -0,0 +1,60 @@
+"""Fixtures for PyPEER preprocessing tests, stubbing PyPEER if it isn't
+installed"""
+import sys
+import types
+import nibabel as nb
+import numpy as np
+import pytest
+
+PEER_FUNCS = ('global_signal_regression', 'prepare_data_for_svr',
+              'train_model', 'save_model', 'load_model', 'predict_fixations',
+              'save_fixations', 'estimate_em', 'load_data')
+"""what CPAC.pypeer.peer imports from PyPEER.peer_func"""
+
+
+def _not_stubbed(*args, **kwargs):
+    raise NotImplementedError('not stubbed for these tests')
+
+
+@pytest.fixture(name='peer')
+def fixture_peer(monkeypatch):
+    '''CPAC.pypeer.peer, imported with a stub PyPEER if PyPEER isn't
+    installed, with PyPEER's data loading and model saving patched'''
+    try:
+        import PyPEER  # noqa: F401 pylint: disable=unused-import
+        stubbed = False
+    except ImportError:
+        stubbed = True
+        peer_func = types.ModuleType('PyPEER.peer_func')
+        for name in PEER_FUNCS:
+            setattr(peer_func, name, _not_stubbed)
+        pypeer = types.ModuleType('PyPEER')
+        pypeer.peer_func = peer_func
+        monkeypatch.setitem(sys.modules, 'PyPEER', pypeer)
+        monkeypatch.setitem(sys.modules, 'PyPEER.peer_func', peer_func)
+    package = sys.modules.get('CPAC.pypeer')
+    package_attributes = set(vars(package)) if package else set()
+
+    from CPAC.pypeer import peer
+    monkeypatch.setattr(peer, 'load_data',
+                        lambda path: np.asanyarray(nb.load(path).dataobj))
+    monkeypatch.setattr(peer, 'prepare_data_for_svr',
+                        lambda data, removed, mask: (data, removed))
+    monkeypatch.setattr(peer, 'save_model', lambda *args: None)
+    yield peer
+
+    if stubbed:
+        # so the stubbed module isn't reused once PyPEER is restored
+        del sys.modules['CPAC.pypeer.peer']
+        package = sys.modules['CPAC.pypeer']
+        for name in set(vars(package)) - package_attributes:
+            delattr(package, name)
+
+
+@pytest.fixture(name='trained')
+def fixture_trained(peer, monkeypatch):
+    '''The data each model is trained on, with training stubbed'''
+    trained = []
+    monkeypatch.setattr(peer, 'train_model', lambda data, removed, stim:
+                        trained.append(data) or (None, None))
+    return trained
@@ -0,0 +1,63 @@
+"""Tests for PyPEER preprocessing"""
+import os
+import nibabel as nb
+import numpy as np
+
+
+def _save(data, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    nb.Nifti1Image(data, np.eye(4)).to_filename(path)
+    return path
+
+
+def test_prep_for_pypeer(peer, trained, tmp_path, monkeypatch):
+    '''Test that integer scans are eye-masked and z-scored as floats, with
+    the eye mask loaded once for all scans'''
+    rng = np.random.default_rng(0)
+    eye_mask = np.zeros((3, 3, 2), dtype=np.int16)
+    eye_mask[1, 1, :] = [1, 2]
+    subject_dir = tmp_path / 'pipeline_peer' / 'sub-1'
+    eye_mask_path = _save(eye_mask, str(subject_dir / 'template_eye_mask' /
+                                        'eye_mask.nii.gz'))
+    scans = {}
+    for scan in ('peer1', 'peer2'):
+        scans[scan] = rng.integers(0, 100, (3, 3, 2, 5), dtype=np.int16)
+        # a voxel with no variance is only demeaned
+        scans[scan][1, 1, 1] = 7
+        _save(scans[scan], str(subject_dir / 'functional_to_standard' /
+                               f'_scan_{scan}' / 'bold.nii.gz'))
+
+    loads = []
+    load_eye_mask = peer.load_eye_mask
+    monkeypatch.setattr(peer, 'load_eye_mask', lambda path: loads.append(
+        path) or load_eye_mask(path))
+    peer.prep_for_pypeer(['peer1', 'peer2'], [], eye_mask_path,
+                         str(tmp_path), 'sub-1', None, None)
+    assert loads == [eye_mask_path]
+
+    assert len(trained) == 2
+    for data in trained:
+        assert data.dtype == np.float64
+        scan = next(scan for scan in scans.values() if np.allclose(
+            data[1, 1, 0], (scan[1, 1, 0] - scan[1, 1, 0].mean()) /
+            scan[1, 1, 0].std()))
+        assert np.allclose(data[1, 1, 1], 0)
+        assert not data[eye_mask == 0].any()
+        assert scan[eye_mask == 0].any()
+
+
+def test_pypeer_eye_masking(peer, tmp_path):
+    '''Test that scans are eye-masked in their own data type'''
+    eye_mask = np.zeros((3, 3, 2), dtype=np.int16)
+    eye_mask[1, 1, :] = [1, 2]
+    eye_mask_path = _save(eye_mask, str(tmp_path / 'eye_mask.nii.gz'))
+    scan = np.arange(90, dtype=np.int16).reshape((3, 3, 2, 5))
+    data = peer.pypeer_eye_masking(_save(scan, str(tmp_path / 'bold.nii.gz')),
+                                   eye_mask_path)
+    assert data.dtype == np.int16
+    assert np.array_equal(data, scan * eye_mask[..., np.newaxis])
+
+    zscored = peer.pypeer_zscore(data, eye_mask != 0)
+    assert zscored.dtype == np.float64
+    assert np.allclose(zscored.std(axis=3)[eye_mask != 0], 1)
+    assert not zscored[eye_mask == 0].any()
@@ -23,6 +23,7 @@ import nipype.interfaces.io as nio
 import nipype.interfaces.utility as util
 
 from CPAC.sca.utils import *
+from CPAC.utils.interfaces.function import Function
 from CPAC.utils.utils import extract_one_d
 from CPAC.utils.datasource import resample_func_roi, \
     create_roi_mask_dataflow, create_spatial_map_dataflow
@@ -31,7 +32,7 @@ from CPAC.timeseries.timeseries_analysis import get_roi_timeseries, \
     get_spatial_map_timeseries, resample_function
 
 
-def create_sca(name_sca='sca'):
+def create_sca(name_sca='sca', in_process=False):
     """
     Map of the correlations of the Region of Interest(Seed in native or MNI space) with the rest of brain voxels.
     The map is normalized to contain Z-scores, mapped in standard space and treated with spatial smoothing.
@@ -41,6 +42,11 @@ def create_sca(name_sca='sca'):
     name_sca : a string
         Name of the SCA workflow
 
+    in_process : boolean
+        Correlate all seeds with all voxels in one NumPy matrix product
+        (``compute_sca_correlations``) instead of AFNI 3dTcorr1D and
+        3dTCat
+
     Returns
     -------
     sca_workflow : workflow
@@ -70,7 +76,10 @@ def create_sca(name_sca='sca'):
 
     1. Compute pearson correlation between input timeseries 1D file and input functional file
        Use 3dTcorr1D to compute that. Input timeseries can be a 1D file containing parcellation ROI's
-       or a 3D mask
+       or a 3D mask. With ``in_process=True``, the masked functional file
+       is z-scored once and correlated with every seed in a single matrix
+       product, and the correlation stack and per-ROI volumes are written
+       from that buffer.
 
     2. Compute Fisher Z score of the correlation computed in step above. If a mask is provided then a
        a single Z score file is returned, otherwise z-scores for all ROIs are returned as a list of
@@ -118,6 +127,32 @@ def create_sca(name_sca='sca'):
                                                     ]),
                          name='outputspec')
 
+    if in_process:
+        corr = pe.Node(Function(input_names=['functional_file',
+                                             'timeseries_one_d',
+                                             'mask_file',
+                                             'fisher_z',
+                                             'split_rois'],
+                                output_names=['correlation_stack',
+                                              'correlation_files'],
+                                function=compute_sca_correlations,
+                                as_module=True),
+                       name='compute_sca_correlations', mem_gb=1.0,
+                       mem_x=(1e-08, 'functional_file'))
+        corr.inputs.fisher_z = False
+        corr.inputs.split_rois = True
+
+        sca.connect(inputNode, 'timeseries_one_d',
+                    corr, 'timeseries_one_d')
+        sca.connect(inputNode, 'functional_file',
+                    corr, 'functional_file')
+        sca.connect(corr, 'correlation_stack',
+                    outputNode, 'correlation_stack')
+        sca.connect(corr, 'correlation_files',
+                    outputNode, 'correlation_files')
+
+        return sca
+
     # 2. Compute voxel-wise correlation with Seed Timeseries
     corr = pe.Node(interface=preprocess.TCorr1D(),
                       name='3dTCorr1D', mem_gb=3.0)
@@ -170,7 +205,8 @@ def create_sca(name_sca='sca'):
     return sca
 
 
-def create_temporal_reg(wflow_name='temporal_reg', which='SR'):
+def create_temporal_reg(wflow_name='temporal_reg', which='SR',
+                        in_process=False):
     """
     Temporal multiple regression workflow
     Provides a spatial map of parameter estimates corresponding to each
@@ -192,6 +228,11 @@ def create_temporal_reg(wflow_name='temporal_reg', which='SR'):
         (which = 'RT') unless you provide a timeseries.txt file with a header
         containing the names of the timeseries.
 
+    in_process: boolean
+        Solve the regression for all timeseries with one NumPy
+        least-squares solve (``temporal_regression``) instead of FSL
+        fsl_glm, and write the per-map volumes directly from memory.
+
     Returns
     -------
 
@@ -295,6 +336,32 @@ def create_temporal_reg(wflow_name='temporal_reg', which='SR'):
                                   'temp_reg_map_z_files']),
                          name='outputspec')
 
+    if in_process:
+        temporalReg = pe.Node(Function(input_names=['subject_rest',
+                                                    'subject_timeseries',
+                                                    'subject_mask',
+                                                    'demean',
+                                                    'normalize',
+                                                    'which'],
+                                       output_names=['temp_reg_map',
+                                                     'temp_reg_map_files',
+                                                     'temp_reg_map_z',
+                                                     'temp_reg_map_z_files'],
+                                       function=temporal_regression,
+                                       as_module=True),
+                              name='temporal_regression', mem_gb=1.0,
+                              mem_x=(1e-08, 'subject_rest'))
+        temporalReg.inputs.which = which
+
+        for field in ['subject_rest', 'subject_timeseries', 'subject_mask',
+                      'demean', 'normalize']:
+            wflow.connect(inputNode, field, temporalReg, field)
+        for field in ['temp_reg_map', 'temp_reg_map_files',
+                      'temp_reg_map_z', 'temp_reg_map_z_files']:
+            wflow.connect(temporalReg, field, outputNode, field)
+
+        return wflow
+
     check_timeseries = pe.Node(util.Function(input_names=['in_file'],
                                              output_names=['out_file'],
                                              function=check_ts),
@@ -455,7 +522,9 @@ def SCA_AVG(wf, cfg, strat_pool, pipe_num, opt=None):
     wf.connect(resample_functional_roi_for_sca, 'out_func',
                      roi_timeseries_for_sca, 'inputspec.rest')
 
-    sca_roi = create_sca(f'sca_roi_{pipe_num}')
+    sca_roi = create_sca(
+        f'sca_roi_{pipe_num}',
+        in_process=cfg.seed_based_correlation_analysis['in_process'])
 
     node, out = strat_pool.get_data("space-template_desc-preproc_bold")
     wf.connect(node, out, sca_roi, 'inputspec.functional_file')
@@ -516,6 +585,49 @@ def dual_regression(wf, cfg, strat_pool, pipe_num, opt=None):
         dl_dir=cfg.pipeline_setup['working_directory']['path']
     )
 
+    if cfg.seed_based_correlation_analysis['in_process']:
+        # both stages on one in-memory copy of the masked BOLD
+        dr_in_process = pe.Node(Function(input_names=['subject_rest',
+                                                      'spatial_map',
+                                                      'subject_mask',
+                                                      'normalize'],
+                                         output_names=[
+                                             'subject_timeseries',
+                                             'temp_reg_map',
+                                             'temp_reg_map_files',
+                                             'temp_reg_map_z',
+                                             'temp_reg_map_z_files'],
+                                         function=dual_regression_maps,
+                                         as_module=True),
+                                name=f'dual_regression_{pipe_num}',
+                                mem_gb=1.0, mem_x=(1.5e-08, 'subject_rest'))
+        dr_in_process.inputs.normalize = \
+            cfg.seed_based_correlation_analysis['norm_timeseries_for_DR']
+
+        node, out = strat_pool.get_data("space-template_desc-preproc_bold")
+        wf.connect(node, out, resample_spatial_map_to_native_space_for_dr,
+                   'reference')
+        wf.connect(node, out, dr_in_process, 'subject_rest')
+        wf.connect(spatial_map_dataflow_for_dr,
+                   'select_spatial_map.out_file',
+                   resample_spatial_map_to_native_space_for_dr, 'in_file')
+        wf.connect(resample_spatial_map_to_native_space_for_dr, 'out_file',
+                   dr_in_process, 'spatial_map')
+
+        node, out = strat_pool.get_data("space-template_desc-bold_mask")
+        wf.connect(node, out, dr_in_process, 'subject_mask')
+
+        outputs = {
+            'space-template_desc-DualReg_correlations':
+                (dr_in_process, 'temp_reg_map'),
+            'desc-DualReg_statmap':
+                (dr_in_process, 'temp_reg_map_z'),
+            'atlas_name':
+                (spatial_map_dataflow_for_dr, 'select_spatial_map.out_name')
+        }
+
+        return (wf, outputs)
+
     spatial_map_timeseries_for_dr = get_spatial_map_timeseries(
         f'spatial_map_timeseries_for_DR_{pipe_num}'
     )
@@ -623,7 +735,8 @@ def multiple_regression(wf, cfg, strat_pool, pipe_num, opt=None):
 
     sc_temp_reg = create_temporal_reg(
         f'temporal_regression_sca_{pipe_num}',
-        which='RT')
+        which='RT',
+        in_process=cfg.seed_based_correlation_analysis['in_process'])
     sc_temp_reg.inputs.inputspec.normalize = \
     cfg.seed_based_correlation_analysis['norm_timeseries_for_DR']
     sc_temp_reg.inputs.inputspec.demean = True
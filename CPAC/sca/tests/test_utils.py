@@ -0,0 +1,212 @@
+"""Tests for in-process seed-based correlation"""
+import os
+import nibabel as nb
+import numpy as np
+import pytest
+import nipype.interfaces.utility as util
+from CPAC.pipeline import nipype_pipeline_engine as pe
+from CPAC.sca.utils import compute_sca_correlations
+from CPAC.utils.configuration import Configuration
+
+
+def _write_inputs(tmp_path, n_rois=3, timepoints=40):
+    rng = np.random.default_rng(26)
+    data = rng.standard_normal((4, 5, 6, timepoints)).astype(np.float32)
+    # a few constant (out-of-brain) voxels
+    data[0, 0, 0] = 0
+    data[3, 4, 5] = 7
+    func_file = str(tmp_path / 'func.nii.gz')
+    nb.Nifti1Image(data, np.eye(4)).to_filename(func_file)
+    seeds = rng.standard_normal((timepoints, n_rois))
+    ts_file = str(tmp_path / 'roi_ts.csv')
+    with open(ts_file, 'w') as f:
+        f.write('#' + ','.join(f'Mean_{i + 1}' for i in range(n_rois)) +
+                '\n')
+        np.savetxt(f, seeds, delimiter=',')
+    return data, seeds, func_file, ts_file
+
+
+@pytest.mark.parametrize('fisher_z', [True, False])
+def test_compute_sca_correlations(monkeypatch, tmp_path, fisher_z):
+    '''Test that the single-GEMM correlations match numpy.corrcoef'''
+    data, seeds, func_file, ts_file = _write_inputs(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    stack, roi_files = compute_sca_correlations(
+        func_file, ts_file, fisher_z=fisher_z, split_rois=True)
+    out = nb.load(stack).get_fdata()
+    assert out.shape == data.shape[:3] + (seeds.shape[1],)
+    assert len(roi_files) == seeds.shape[1]
+    assert os.path.basename(roi_files[1]).endswith('ROI_number_2.nii.gz')
+
+    for roi in range(seeds.shape[1]):
+        expected = np.corrcoef(data[1, 2, 3], seeds[:, roi])[0, 1]
+        if fisher_z:
+            expected = np.arctanh(expected)
+        assert out[1, 2, 3, roi] == pytest.approx(expected, abs=1e-5)
+        np.testing.assert_allclose(nb.load(roi_files[roi]).get_fdata(),
+                                   out[..., roi])
+    # constant voxels are excluded from the mask
+    assert not out[0, 0, 0].any()
+    assert not out[3, 4, 5].any()
+
+
+def test_compute_sca_correlations_timepoint_mismatch(monkeypatch, tmp_path):
+    '''Test that mismatched seed and BOLD lengths raise a clear error'''
+    _, _, func_file, _ = _write_inputs(tmp_path)
+    ts_file = str(tmp_path / 'short.1D')
+    np.savetxt(ts_file, np.ones((5, 2)))
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(ValueError, match='timepoints'):
+        compute_sca_correlations(func_file, ts_file)
+
+
+
+def test_create_sca_in_process(tmp_path):
+    '''Test that the in-process SCA workflow runs its node end to end'''
+    from CPAC.sca.sca import create_sca
+    data, seeds, func_file, ts_file = _write_inputs(tmp_path)
+    sca = create_sca('sca', in_process=True)
+    sca.base_dir = str(tmp_path / 'work')
+    sca.config['execution']['crashdump_dir'] = str(tmp_path)
+    sca.inputs.inputspec.functional_file = func_file
+    sca.inputs.inputspec.timeseries_one_d = ts_file
+    result = next(node for node in sca.run().nodes() if
+                  node.name == 'compute_sca_correlations').result
+    stack = nb.load(result.outputs.correlation_stack).get_fdata()
+    assert stack.shape == data.shape[:3] + (seeds.shape[1],)
+    assert len(result.outputs.correlation_files) == seeds.shape[1]
+    np.testing.assert_allclose(
+        stack[1, 2, 3, 0], np.corrcoef(data[1, 2, 3], seeds[:, 0])[0, 1],
+        rtol=1e-4)
+
+@pytest.mark.parametrize('normalize', [True, False])
+def test_temporal_regression(monkeypatch, tmp_path, normalize):
+    '''Test the single-solve GLM against per-voxel least squares'''
+    from CPAC.sca.utils import temporal_regression
+    data, seeds, func_file, ts_file = _write_inputs(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    beta_file, beta_files, z_file, z_files = temporal_regression(
+        func_file, ts_file, None, demean=True, normalize=normalize,
+        which='RT')
+    assert [os.path.basename(f) for f in beta_files] == [
+        f'temp_reg_map_roi_{i + 1}.nii.gz' for i in range(seeds.shape[1])]
+    assert len(z_files) == seeds.shape[1]
+
+    design = seeds - seeds.mean(axis=0)
+    if normalize:
+        design /= design.std(axis=0)
+    voxel = data[1, 2, 3] - data[1, 2, 3].mean()
+    expected, rss, _, _ = np.linalg.lstsq(design, voxel, rcond=None)
+    betas = nb.load(beta_file).get_fdata()[1, 2, 3]
+    np.testing.assert_allclose(betas, expected, rtol=1e-4, atol=1e-5)
+
+    # z-stats agree in sign with the t-statistics
+    sigma_sq = rss[0] / (design.shape[0] - design.shape[1])
+    tstats = expected / np.sqrt(
+        sigma_sq * np.diag(np.linalg.inv(design.T @ design)))
+    zstats = nb.load(z_file).get_fdata()[1, 2, 3]
+    assert np.all(np.sign(zstats) == np.sign(tstats))
+    assert np.all(np.abs(zstats) <= np.abs(tstats) + 1e-4)
+
+
+def _write_dual_regression_inputs(tmp_path):
+    rng = np.random.default_rng(27)
+    shape, timepoints = (6, 6, 6), 60
+    maps = rng.standard_normal(shape + (2,))
+    timeseries = rng.standard_normal((timepoints, 2))
+    data = (maps @ timeseries.T + 0.01 * rng.standard_normal(
+        shape + (timepoints,))).astype(np.float32)
+    func_file = str(tmp_path / 'func.nii.gz')
+    map_file = str(tmp_path / 'maps.nii.gz')
+    mask_file = str(tmp_path / 'mask.nii.gz')
+    nb.Nifti1Image(data, np.eye(4)).to_filename(func_file)
+    nb.Nifti1Image(maps.astype(np.float32), np.eye(4)).to_filename(map_file)
+    nb.Nifti1Image(np.ones(shape, dtype=np.uint8), np.eye(4)).to_filename(
+        mask_file)
+    return maps, timeseries, func_file, map_file, mask_file
+
+
+def test_dual_regression_maps(monkeypatch, tmp_path):
+    '''Test that dual regression recovers planted spatial maps'''
+    from CPAC.sca.utils import dual_regression_maps
+    maps, timeseries, func_file, map_file, mask_file = \
+        _write_dual_regression_inputs(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    ts_file, beta_file, beta_files, z_file, z_files = dual_regression_maps(
+        func_file, map_file, mask_file, normalize=False)
+
+    stage_1 = np.loadtxt(ts_file)
+    assert stage_1.shape == (timeseries.shape[0], 2)
+    for i in range(2):
+        assert abs(np.corrcoef(stage_1[:, i], timeseries[:, i])[0, 1]
+                   ) > 0.99
+        stage_2 = nb.load(beta_files[i]).get_fdata()
+        assert abs(np.corrcoef(stage_2.ravel(), maps[..., i].ravel())[0, 1]
+                   ) > 0.99
+    assert nb.load(z_file).shape == maps.shape
+    assert len(z_files) == 2
+
+
+def test_create_temporal_reg_in_process(tmp_path):
+    '''Test that the in-process temporal regression workflow runs its
+    node end to end'''
+    from CPAC.sca.sca import create_temporal_reg
+    data, seeds, func_file, ts_file = _write_inputs(tmp_path)
+    wflow = create_temporal_reg('temporal_reg', which='RT', in_process=True)
+    wflow.base_dir = str(tmp_path / 'work')
+    wflow.config['execution']['crashdump_dir'] = str(tmp_path)
+    mask_file = str(tmp_path / 'mask.nii.gz')
+    nb.Nifti1Image(np.ones(data.shape[:3], dtype=np.uint8), np.eye(4)
+                   ).to_filename(mask_file)
+    wflow.inputs.inputspec.set(subject_rest=func_file,
+                               subject_timeseries=ts_file,
+                               subject_mask=mask_file, demean=True,
+                               normalize=False)
+    result = next(node for node in wflow.run().nodes() if
+                  node.name == 'temporal_regression').result
+    assert nb.load(result.outputs.temp_reg_map).shape == \
+        data.shape[:3] + (seeds.shape[1],)
+    assert len(result.outputs.temp_reg_map_files) == seeds.shape[1]
+    assert len(result.outputs.temp_reg_map_z_files) == seeds.shape[1]
+
+
+class _StratPool:
+    '''Resources for a node block, from one IdentityInterface'''
+    def __init__(self, *resources):
+        self.node = pe.Node(util.IdentityInterface(fields=[
+            resource.replace('-', '_') for resource in resources]),
+            name='inputs')
+
+    def get_data(self, resource):
+        return self.node, resource.replace('-', '_')
+
+
+def test_dual_regression_in_process(tmp_path):
+    '''Test that the in-process dual regression node built by the node
+    block runs'''
+    from CPAC.sca.sca import dual_regression
+    maps, timeseries, func_file, map_file, mask_file = \
+        _write_dual_regression_inputs(tmp_path)
+    cfg = Configuration({'seed_based_correlation_analysis': {
+        'run': True, 'in_process': True, 'norm_timeseries_for_DR': False}})
+    # set while building the participant workflow
+    cfg.pipeline_setup['input_creds_path'] = None
+    cfg['seed_based_correlation_analysis', 'sca_atlases'] = {
+        'DualReg': [map_file]}
+    _, outputs = dual_regression(
+        pe.Workflow('dual_regression', base_dir=str(tmp_path / 'work')),
+        cfg, _StratPool('space-template_desc-preproc_bold',
+                        'space-template_desc-bold_mask'), 0)
+
+    # the spatial map is resampled by FSL, so run the node on its own
+    node = outputs['desc-DualReg_statmap'][0]
+    node.base_dir = str(tmp_path / 'work')
+    node.inputs.set(subject_rest=func_file, spatial_map=map_file,
+                    subject_mask=mask_file)
+    result = node.run()
+    stage_1 = np.loadtxt(result.outputs.subject_timeseries)
+    for i in range(2):
+        assert abs(np.corrcoef(stage_1[:, i], timeseries[:, i])[0, 1]
+                   ) > 0.99
+    assert nb.load(result.outputs.temp_reg_map_z).shape == maps.shape
+    assert len(result.outputs.temp_reg_map_files) == 2
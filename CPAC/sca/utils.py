@@ -67,6 +67,471 @@ def compute_fisher_z_score(correlation_file, timeseries_one_d):
     return out_file
 
 
+def parse_seed_timeseries(timeseries_one_d):
+    """
+    Reads a seed timeseries file (AFNI 1D, 3dROIstats CSV or plain
+    text) into a timepoints × seeds array and a list of seed labels.
+
+    Parameters
+    ----------
+    timeseries_one_d : string
+        Path to the seed timeseries file. Comment lines (starting with
+        ``#``) are searched for ROI labels, either ``Mean_<label>``
+        columns from 3dROIstats or ``#<label>`` columns from
+        ``gen_roi_timeseries``.
+
+    Returns
+    -------
+    roi_labels : list (strings)
+        one label per seed, ``1`` … ``n`` if the file has no header
+
+    seeds : numpy.ndarray
+        timepoints × seeds array of float64
+
+    Examples
+    --------
+    >>> import os, tempfile
+    >>> ts = os.path.join(tempfile.mkdtemp(), 'ts.csv')
+    >>> with open(ts, 'w') as f:
+    ...     _ = f.write('#Mean_1,Mean_7\\n1.0,2.0\\n3.0,4.0\\n5.0,7.0\\n')
+    >>> labels, seeds = parse_seed_timeseries(ts)
+    >>> labels
+    ['1', '7']
+    >>> seeds.shape
+    (3, 2)
+    """
+    import re
+    import numpy as np
+
+    header = []
+    rows = []
+    with open(timeseries_one_d, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#'):
+                tokens = [token.strip() for token in
+                          re.split(r'[,\t]+', line.lstrip('#')) if
+                          token.strip()]
+                means = [token.replace('Mean_', '') for token in tokens
+                         if token.startswith('Mean_')]
+                if means:
+                    header = means
+                elif not header and tokens and not any(
+                        '/' in token for token in tokens):
+                    header = [token.lstrip('#') for token in tokens]
+                continue
+            rows.append([float(value) for value in
+                         re.split(r'[,\s]+', line) if value])
+
+    seeds = np.array(rows, dtype=np.float64)
+    if seeds.ndim == 1:
+        seeds = seeds[:, np.newaxis]
+    if len(header) != seeds.shape[1]:
+        header = [str(i + 1) for i in range(seeds.shape[1])]
+    return header, seeds
+
+
+def zscore_columns(data, out=None):
+    """
+    Demeans each column of a 2D array and scales it to unit (population)
+    standard deviation. Columns with zero variance are set to 0.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        timepoints × series array
+
+    out : numpy.ndarray or None
+        array to write into; pass ``data`` to normalize in place
+
+    Returns
+    -------
+    numpy.ndarray
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> zscore_columns(np.array([[1., 5.], [3., 5.]]))
+    array([[-1.,  0.],
+           [ 1.,  0.]])
+    """
+    import numpy as np
+
+    if out is None:
+        out = np.array(data, copy=True)
+    elif out is not data:
+        out[...] = data
+    out -= out.mean(axis=0)
+    std = out.std(axis=0)
+    std[std == 0] = np.inf
+    out /= std
+    return out
+
+
+def compute_sca_correlations(functional_file, timeseries_one_d,
+                             mask_file=None, fisher_z=False,
+                             split_rois=False):
+    """
+    Correlates every seed timeseries with every in-mask voxel in a
+    single matrix product.
+
+    The masked BOLD data are z-scored once, so the Pearson correlation
+    of all seeds with all voxels is one (voxels × timepoints) ·
+    (timepoints × seeds) product. The Fisher z transform is applied in
+    place on that buffer, and output volumes are written straight from
+    it.
+
+    Parameters
+    ----------
+    functional_file : string
+        4D functional image
+
+    timeseries_one_d : string
+        seed timeseries file (see ``parse_seed_timeseries``)
+
+    mask_file : string or None
+        3D mask in the space of ``functional_file``. If not given, all
+        voxels with nonzero temporal variance are used.
+
+    fisher_z : boolean
+        write Fisher z-transformed correlations instead of Pearson's r
+
+    split_rois : boolean
+        also write one 3D volume per seed
+
+    Returns
+    -------
+    correlation_stack : string
+        4D image with one volume per seed
+
+    correlation_files : list (nifti files)
+        one 3D image per seed if ``split_rois``, otherwise empty
+    """
+    import os
+    import nibabel as nb
+    import numpy as np
+
+    roi_labels, seeds = parse_seed_timeseries(timeseries_one_d)
+
+    func_img = nb.load(functional_file)
+    func_data = np.asanyarray(func_img.dataobj)
+    timepoints = func_data.shape[3]
+
+    if seeds.shape[0] != timepoints:
+        raise ValueError(f'Seed timeseries {timeseries_one_d} has '
+                         f'{seeds.shape[0]} timepoints but '
+                         f'{functional_file} has {timepoints}.')
+
+    if mask_file:
+        mask = np.asanyarray(nb.load(mask_file).dataobj) != 0
+    else:
+        # nonzero temporal variance
+        mask = (func_data != func_data[..., :1]).any(axis=3)
+
+    # timepoints × voxels, z-scored once
+    voxels = func_data[mask].astype(np.float32).T
+    del func_data
+    zscore_columns(voxels, out=voxels)
+    seeds = zscore_columns(seeds).astype(np.float32)
+
+    # voxels × seeds
+    corr = voxels.T @ seeds
+    corr /= timepoints
+    del voxels
+
+    np.clip(corr, -1, 1, out=corr)
+    if fisher_z:
+        # keep |r| == 1 finite
+        eps = np.finfo(corr.dtype).eps
+        np.clip(corr, -1 + eps, 1 - eps, out=corr)
+        np.arctanh(corr, out=corr)
+
+    prefix = 'z_score' if fisher_z else 'correlation'
+    header = func_img.header.copy()
+    header.set_data_dtype(np.float32)
+
+    stack = np.zeros(mask.shape + (corr.shape[1],), dtype=np.float32)
+    stack[mask] = corr
+    correlation_stack = os.path.join(os.getcwd(), f'{prefix}_stack.nii.gz')
+    nb.Nifti1Image(stack, func_img.affine, header).to_filename(
+        correlation_stack)
+
+    correlation_files = []
+    if split_rois:
+        for i, roi_label in enumerate(roi_labels):
+            roi_file = os.path.join(
+                os.getcwd(), f'{prefix}_ROI_number_{roi_label}.nii.gz')
+            nb.Nifti1Image(stack[..., i], func_img.affine,
+                           header).to_filename(roi_file)
+            correlation_files.append(roi_file)
+
+    return correlation_stack, correlation_files
+
+
+def _glm(data, design, demean=True, normalize=False):
+    """
+    Ordinary least-squares fit of every column of ``data`` on
+    ``design`` in one solve, matching ``fsl_glm --demean [--des_norm]``.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        samples × targets; demeaned in place if ``demean``
+
+    design : numpy.ndarray
+        samples × regressors
+
+    demean : boolean
+        demean data and design columns
+
+    normalize : boolean
+        scale design columns to unit standard deviation
+
+    Returns
+    -------
+    betas : numpy.ndarray
+        regressors × targets parameter estimates
+
+    zstats : numpy.ndarray
+        regressors × targets z-statistics of each parameter
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> design = np.array([[1.], [2.], [3.], [4.]])
+    >>> betas, _ = _glm(np.array([[2.], [4.], [6.], [8.]]), design)
+    >>> round(float(betas[0, 0]), 6)
+    2.0
+    """
+    import numpy as np
+    from scipy import stats
+
+    design = np.array(design, dtype=np.float64)
+    if demean:
+        design -= design.mean(axis=0)
+        data -= data.mean(axis=0)
+    if normalize:
+        std = design.std(axis=0)
+        std[std == 0] = 1
+        design /= std
+
+    samples = design.shape[0]
+    pinv = np.linalg.pinv(design)
+    betas = pinv @ data
+
+    # residual sum of squares without materializing the residuals:
+    # y'y - b'X'y
+    rss = (np.einsum('ij,ij->j', data, data, dtype=np.float64) -
+           np.einsum('ij,ij->j', betas, design.T @ data))
+    dof = max(samples - np.linalg.matrix_rank(design), 1)
+    sigma_sq = np.clip(rss, 0, None) / dof
+    # (X'X)^-1 diagonal
+    var_scale = np.einsum('ij,ij->i', pinv, pinv)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tstats = betas / np.sqrt(np.outer(var_scale, sigma_sq))
+    tstats[~np.isfinite(tstats)] = 0
+    zstats = np.sign(tstats) * stats.norm.isf(
+        stats.t.sf(np.abs(tstats), dof))
+    zstats[~np.isfinite(zstats)] = 0
+    return (betas.astype(data.dtype, copy=False),
+            zstats.astype(data.dtype, copy=False))
+
+
+def _write_maps(maps, mask, affine, header, out_name, split_labels=None):
+    """
+    Writes a maps × voxels array as one 4D image and, optionally, one
+    3D image per map.
+
+    Returns
+    -------
+    out_file : string
+
+    out_files : list (nifti files)
+    """
+    import os
+    import nibabel as nb
+    import numpy as np
+
+    header = header.copy()
+    header.set_data_dtype(np.float32)
+    volume = np.zeros(mask.shape + (maps.shape[0],), dtype=np.float32)
+    volume[mask] = maps.T
+    out_file = os.path.join(os.getcwd(), f'{out_name}.nii.gz')
+    nb.Nifti1Image(volume, affine, header).to_filename(out_file)
+
+    out_files = []
+    for i, label in enumerate(split_labels or []):
+        map_file = os.path.join(os.getcwd(), f'{out_name}_{label}.nii.gz')
+        nb.Nifti1Image(volume[..., i], affine, header).to_filename(
+            map_file)
+        out_files.append(map_file)
+    return out_file, out_files
+
+
+def _load_masked(subject_rest, subject_mask=None):
+    """
+    Loads in-mask BOLD data as a timepoints × voxels float32 array.
+    """
+    import nibabel as nb
+    import numpy as np
+
+    func_img = nb.load(subject_rest)
+    func_data = np.asanyarray(func_img.dataobj)
+    if subject_mask:
+        mask = np.asanyarray(nb.load(subject_mask).dataobj) != 0
+    else:
+        mask = (func_data != func_data[..., :1]).any(axis=3)
+    return func_img, mask, func_data[mask].astype(np.float32).T
+
+
+def temporal_regression(subject_rest, subject_timeseries, subject_mask,
+                        demean=True, normalize=True, which='SR'):
+    """
+    In-process equivalent of ``fsl_glm`` followed by splitting its
+    outputs: all timeseries are regressed on all in-mask voxels in a
+    single least-squares solve, and the parameter estimate and z-stat
+    maps are written as 4D images and per-map volumes from memory.
+
+    Parameters
+    ----------
+    subject_rest : string
+        4D functional image
+
+    subject_timeseries : string
+        timeseries file, timepoints by rows and regressors by columns
+
+    subject_mask : string
+        functional brain mask
+
+    demean : boolean
+        demean data and design
+
+    normalize : boolean
+        normalize each timeseries to unit standard deviation
+
+    which : string
+        'SR' names per-map outputs by index; 'RT' names them by the ROI
+        labels in the header of ``subject_timeseries``
+
+    Returns
+    -------
+    temp_reg_map : string
+
+    temp_reg_map_files : list (nifti files)
+
+    temp_reg_map_z : string
+
+    temp_reg_map_z_files : list (nifti files)
+    """
+    roi_labels, design = parse_seed_timeseries(subject_timeseries)
+    timepoints, rois = design.shape
+    if rois > timepoints:
+        raise ValueError(f'The number of timepoints ({timepoints}) is '
+                         f'smaller than the number of ROIs to run ({rois}) '
+                         '- therefore the GLM is underspecified and can\'t '
+                         'run.')
+
+    func_img, mask, data = _load_masked(subject_rest, subject_mask)
+    if data.shape[0] != timepoints:
+        raise ValueError(f'{subject_timeseries} has {timepoints} '
+                         f'timepoints but {subject_rest} has '
+                         f'{data.shape[0]}.')
+
+    betas, zstats = _glm(data, design, demean, normalize)
+    del data
+
+    if which == 'RT':
+        labels = [f'roi_{label}' for label in roi_labels]
+    else:
+        labels = [f'{i:04d}' for i in range(rois)]
+
+    temp_reg_map, temp_reg_map_files = _write_maps(
+        betas, mask, func_img.affine, func_img.header, 'temp_reg_map',
+        labels)
+    temp_reg_map_z, temp_reg_map_z_files = _write_maps(
+        zstats, mask, func_img.affine, func_img.header, 'temp_reg_map_z',
+        labels)
+
+    return (temp_reg_map, temp_reg_map_files, temp_reg_map_z,
+            temp_reg_map_z_files)
+
+
+def dual_regression_maps(subject_rest, spatial_map, subject_mask,
+                         normalize=True):
+    """
+    Runs both stages of dual regression on one in-memory copy of the
+    masked BOLD data.
+
+    Stage 1 regresses the spatial maps on every timepoint (one solve
+    across all timepoints) to get a timeseries per map; stage 2
+    regresses those timeseries on every voxel (one solve across all
+    voxels), as ``create_temporal_reg`` does.
+
+    Parameters
+    ----------
+    subject_rest : string
+        4D functional image
+
+    spatial_map : string
+        4D spatial maps in the space of ``subject_rest``
+
+    subject_mask : string
+        functional brain mask
+
+    normalize : boolean
+        normalize each stage-1 timeseries to unit standard deviation
+
+    Returns
+    -------
+    subject_timeseries : string
+        stage-1 timeseries, timepoints by rows and maps by columns
+
+    temp_reg_map : string
+
+    temp_reg_map_files : list (nifti files)
+
+    temp_reg_map_z : string
+
+    temp_reg_map_z_files : list (nifti files)
+    """
+    import os
+    import nibabel as nb
+    import numpy as np
+
+    func_img, mask, data = _load_masked(subject_rest, subject_mask)
+    maps = np.asanyarray(nb.load(spatial_map).dataobj)
+    if maps.ndim == 3:
+        maps = maps[..., np.newaxis]
+    if maps.shape[:3] != mask.shape:
+        raise ValueError(f'{spatial_map} and {subject_rest} must have the '
+                         'same voxel dimensions.')
+    maps = maps[mask].astype(np.float64)
+
+    # stage 1: voxels × maps design, voxels × timepoints data
+    timeseries, _ = _glm(data.T.copy(), maps, demean=True)
+    timeseries = timeseries.T
+    subject_timeseries = os.path.join(os.getcwd(),
+                                      'spatial_map_timeseries.txt')
+    np.savetxt(subject_timeseries, timeseries, fmt='%.6f', delimiter='\t')
+
+    # stage 2: timepoints × maps design, timepoints × voxels data
+    betas, zstats = _glm(data, timeseries, demean=True, normalize=normalize)
+    del data
+
+    labels = [f'{i:04d}' for i in range(maps.shape[1])]
+    temp_reg_map, temp_reg_map_files = _write_maps(
+        betas, mask, func_img.affine, func_img.header, 'temp_reg_map',
+        labels)
+    temp_reg_map_z, temp_reg_map_z_files = _write_maps(
+        zstats, mask, func_img.affine, func_img.header, 'temp_reg_map_z',
+        labels)
+
+    return (subject_timeseries, temp_reg_map, temp_reg_map_files,
+            temp_reg_map_z, temp_reg_map_z_files)
+
+
 def check_ts(in_file):
     import os
     import numpy as np
@@ -1,38 +1,45 @@
-from . import extract_data_multiscan
-from . import create_fsl_model
-from . import extract_parameters
-from . import build_data_config
-from .interfaces import function, masktool
-from .extract_data import run
-from .datatypes import ListFromItem
-from .configuration import check_pname, Configuration, set_subject
+from .lazy import lazy_attributes
 
-from .utils import (
-    get_zscore,
-    get_fisher_zscore,
-    compute_fisher_z_score,
-    get_operand_string,
-    get_roi_num_list,
-    safe_shape,
-    extract_one_d,
-    extract_txt,
-    zscore,
-    correlation,
-    check,
-    check_random_state,
-    try_fetch_parameter,
-    get_scan_params,
-    get_tr,
-    check_tr,
-    find_files,
-    extract_output_mean,
-    create_output_mean_csv,
-    pick_wm,
-    check_command_path,
-    check_system_deps,
-    check_config_resources,
-    repickle,
-)
+# imported on first access, so that importing any of CPAC.utils'
+# submodules doesn't import all of them (and nipype)
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    'extract_data_multiscan': '.extract_data_multiscan',
+    'create_fsl_model': '.create_fsl_model',
+    'extract_parameters': '.extract_parameters',
+    'build_data_config': '.build_data_config',
+    'function': '.interfaces:function',
+    'masktool': '.interfaces:masktool',
+    'run': '.extract_data:run',
+    'ListFromItem': '.datatypes:ListFromItem',
+    'check_pname': '.configuration:check_pname',
+    'Configuration': '.configuration:Configuration',
+    'set_subject': '.configuration:set_subject',
+    **{name: f'.utils:{name}' for name in (
+        'get_zscore',
+        'get_fisher_zscore',
+        'compute_fisher_z_score',
+        'get_operand_string',
+        'get_roi_num_list',
+        'safe_shape',
+        'extract_one_d',
+        'extract_txt',
+        'zscore',
+        'correlation',
+        'check',
+        'check_random_state',
+        'try_fetch_parameter',
+        'get_scan_params',
+        'get_tr',
+        'check_tr',
+        'find_files',
+        'extract_output_mean',
+        'create_output_mean_csv',
+        'pick_wm',
+        'check_command_path',
+        'check_system_deps',
+        'check_config_resources',
+        'repickle',
+    )}})
 
 __all__ = ['check_pname', 'Configuration', 'function', 'ListFromItem',
            'set_subject']
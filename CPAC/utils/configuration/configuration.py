@@ -20,11 +20,13 @@ import os
 import re
 from typing import Optional, Tuple
 from warnings import warn
-import pkg_resources as p
 import yaml
+from CPAC.utils.lazy import lazy_module
 from CPAC.utils.utils import load_preconfig
 from .diff import dct_diff
 
+p = lazy_module('pkg_resources')
+
 SPECIAL_REPLACEMENT_STRINGS = {r'${resolution_for_anat}',
                                r'${func_resolution}'}
 
@@ -64,6 +66,12 @@ class Configuration:
     c['attribute', 'key0', 'key1']
     c[keys]
 
+    Nested lookups go through a flattened index of key paths that is
+    rebuilt after any attribute or nested key is set through the
+    Configuration, so replace nested dictionaries with
+    ``c['attribute', 'key0'] = {...}`` rather than
+    ``c.attribute['key0'] = {...}``.
+
     Examples
     --------
     >>> c = Configuration({})
@@ -135,6 +143,12 @@ class Configuration:
 
         self._update_attr()
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name != '_key_index':
+            # a replaced container invalidates its key paths
+            self.__dict__.pop('_key_index', None)
+
     def __str__(self):
         return ('C-PAC Configuration '
                 f"('{self['pipeline_setup', 'pipeline_name']}')")
@@ -153,7 +167,10 @@ class Configuration:
         if isinstance(key, str):
             return getattr(self, key)
         elif isinstance(key, tuple) or isinstance(key, list):
-            return self.get_nested(self, key)
+            try:
+                return self.key_index[tuple(key)][key[-1]]
+            except (KeyError, TypeError):
+                return self.get_nested(self, key)
         else:
             self.key_type_error(key)
 
@@ -203,7 +220,38 @@ class Configuration:
 
     def dict(self):
         '''Show contents of a C-PAC configuration as a dict'''
-        return {k: v for k, v in self.__dict__.items() if not callable(v)}
+        return {k: v for k, v in self.__dict__.items() if not callable(v)
+                and k != '_key_index'}
+
+    @property
+    def key_index(self):
+        '''Flattened index of every nested key path, as a tuple, to the
+        dictionary that holds that path's last key
+
+        Examples
+        --------
+        >>> c = Configuration({})
+        >>> c.key_index[('pipeline_setup', 'system_config', 'fail_fast')
+        ...             ] is c.pipeline_setup['system_config']
+        True
+        >>> c['pipeline_setup', 'system_config'] = {'fail_fast': True}
+        >>> c['pipeline_setup', 'system_config', 'fail_fast']
+        True
+        '''
+        if '_key_index' not in self.__dict__:
+            index = {}
+
+            def _index(path, dct):
+                for key, value in dct.items():
+                    index[(*path, key)] = dct
+                    if isinstance(value, dict):
+                        _index((*path, key), value)
+
+            for key, value in self.dict().items():
+                if isinstance(value, dict):
+                    _index((key,), value)
+            self._key_index = index
+        return self._key_index
 
     def keys(self):
         '''Show toplevel keys of a C-PAC configuration dict'''
@@ -284,7 +332,8 @@ class Configuration:
                          "configuration file")
 
         attributes = [(attr, getattr(self, attr)) for attr in dir(self)
-                      if not callable(attr) and not attr.startswith("__")]
+                      if not callable(attr) and not attr.startswith("__")
+                      and attr not in ('_key_index', 'key_index')]
 
         template_list = ['template_brain_only_for_anat',
                          'template_skull_for_anat',
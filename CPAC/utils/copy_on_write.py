@@ -0,0 +1,128 @@
+# Copyright (C) 2022  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Copy-on-write JSON metadata for the ResourcePool"""
+from copy import deepcopy
+from CPAC.utils.provenance import Provenance
+
+
+def _is_mutable(value):
+    return isinstance(value, (dict, list, set)) and not isinstance(
+        value, Provenance)
+
+
+class CopyOnWriteDict(dict):
+    """A ``dict`` whose nested containers are shared with the mappings it
+    was copied from until they are fetched from it, at which point it
+    takes its own (itself copy-on-write) copy of just that container.
+
+    Copying one, including with ``copy.deepcopy``, only copies its top
+    level, so the ResourcePool's strategy JSONs can be passed to every
+    fork without duplicating their nested metadata.
+
+    Examples
+    --------
+    >>> original = {'CpacVariant': {'bold': ['a']}, 'Description': 'BOLD'}
+    >>> first = CopyOnWriteDict(original)
+    >>> second = deepcopy(first)
+    >>> second['CpacVariant']['bold'].append('b')
+    >>> second['CpacVariant']
+    {'bold': ['a', 'b']}
+    >>> first['CpacVariant'], original['CpacVariant']
+    ({'bold': ['a']}, {'bold': ['a']})
+    >>> import json
+    >>> json.dumps(second, sort_keys=True)
+    '{"CpacVariant": {"bold": ["a", "b"]}, "Description": "BOLD"}'
+    """
+    __slots__ = ('_private',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._private = set()
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if key not in self._private and _is_mutable(value):
+            value = CopyOnWriteDict(value) if isinstance(value, dict) else \
+                deepcopy(value)
+            dict.__setitem__(self, key, value)
+            self._private.add(key)
+        return value
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._private.discard(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._private.discard(key)
+
+    def __copy__(self):
+        return self.__class__(self)
+
+    def __deepcopy__(self, memo):
+        return self.__class__(self)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(dict.items(self)),))
+
+    def _share(self):
+        """Raw items, now shared with whatever receives them"""
+        self._private.clear()
+        return dict.items(self)
+
+    def copy(self):
+        return self.__class__(self)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        key = next(reversed(self))
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for other in (*args, kwargs):
+            if isinstance(other, CopyOnWriteDict):
+                items = other._share()
+            elif hasattr(other, 'keys'):
+                items = ((key, dict.__getitem__(other, key)) if
+                         isinstance(other, dict) else (key, other[key]) for
+                         key in other.keys())
+            else:
+                items = other
+            for key, value in items:
+                dict.__setitem__(self, key, value)
+                self._private.discard(key)
@@ -1,5 +1,9 @@
 """Utilties for documentation."""
 import ast
+from copy import deepcopy
+from functools import lru_cache
+from types import FunctionType, MappingProxyType
+from typing import Any, NamedTuple, Optional
 from urllib import request
 from urllib.error import ContentTooShortError, HTTPError, URLError
 from CPAC import __version__
@@ -48,8 +52,35 @@ def _docs_url_prefix():
     return _url(url_version)
 
 
-def grab_docstring_dct(fn):
-    """Function to grab a NodeBlock dictionary from a docstring.
+_NODE_BLOCK_REGISTRY = {}
+
+
+class NodeBlockDescriptor(NamedTuple):
+    """A NodeBlock function's parsed docstring dictionary.
+
+    Descriptors are shared by every caller, so treat them as read-only
+    and use ``dct`` for a dictionary to modify.
+    """
+    name: str
+    config: Any
+    switch: Any
+    option_key: Any
+    option_val: Any
+    inputs: list
+    outputs: Any
+    options: Optional[list]
+    function: FunctionType
+    docstring_dct: dict
+
+    def dct(self):
+        """A copy of the complete NodeBlock configuration dictionary"""
+        return deepcopy(self.docstring_dct)
+
+
+@lru_cache(maxsize=None)
+def node_block_descriptor(fn):
+    """Function to parse a NodeBlock function's docstring once and
+    register the result.
 
     Parameters
     ----------
@@ -58,8 +89,27 @@ def grab_docstring_dct(fn):
 
     Returns
     -------
-    dct : dict
-        A NodeBlock configuration dictionary.
+    NodeBlockDescriptor
+
+    Examples
+    --------
+    >>> def example_block(wf, cfg, strat_pool, pipe_num, opt=None):
+    ...     '''
+    ...     {"name": "example",
+    ...      "config": ["pipeline_setup"],
+    ...      "switch": ["run"],
+    ...      "option_key": "None",
+    ...      "option_val": "None",
+    ...      "inputs": ["desc-preproc_bold"],
+    ...      "outputs": ["desc-example_bold"]}
+    ...     '''
+    >>> descriptor = node_block_descriptor(example_block)
+    >>> descriptor.name, descriptor.inputs, descriptor.options
+    ('example', ['desc-preproc_bold'], None)
+    >>> node_block_descriptor(example_block) is descriptor
+    True
+    >>> node_block_registry()[f'{__name__}.example_block'] is descriptor
+    True
     """
     fn_docstring = fn.__doc__
     init_dct_schema = ['name', 'config', 'switch', 'option_key',
@@ -75,7 +125,33 @@ def grab_docstring_dct(fn):
                             'is missing.\n\nNode block docstring keys:\n'
                             f'{init_dct_schema}\n\nYou provided:\n'
                             f'{dct.keys()}\n\nDocstring:\n{fn_docstring}\n\n')
-    return dct
+    descriptor = NodeBlockDescriptor(
+        **{key: dct[key] for key in init_dct_schema},
+        options=dct.get('options'), function=fn, docstring_dct=dct)
+    _NODE_BLOCK_REGISTRY[f'{fn.__module__}.{fn.__qualname__}'] = descriptor
+    return descriptor
+
+
+def node_block_registry():
+    """Read-only view of every NodeBlock descriptor parsed so far, keyed
+    by the NodeBlock function's module and qualified name"""
+    return MappingProxyType(_NODE_BLOCK_REGISTRY)
+
+
+def grab_docstring_dct(fn):
+    """Function to grab a NodeBlock dictionary from a docstring.
+
+    Parameters
+    ----------
+    fn : function
+        The NodeBlock function with the docstring to be parsed.
+
+    Returns
+    -------
+    dct : dict
+        A NodeBlock configuration dictionary.
+    """
+    return node_block_descriptor(fn).dct()
 
 
 DOCS_URL_PREFIX = _docs_url_prefix()
@@ -0,0 +1,120 @@
+# Copyright (C) 2022  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Deferred imports, so that CLI subcommands and worker processes only
+import what they use
+
+Importing C-PAC's packages used to import nipype, nilearn, pandas,
+scipy and the configuration schema whether or not the caller needed
+them. ``lazy_attributes`` gives a package's ``__init__`` a module-level
+``__getattr__`` (:pep:`562`) that imports each re-exported name on first
+access, and ``lazy_module`` returns a module that is only executed when
+one of its attributes is first used.
+"""
+import importlib
+import importlib.util
+import sys
+from types import ModuleType
+from typing import Callable, Dict, List, Tuple
+
+
+def lazy_attributes(package: str, attributes: Dict[str, str]
+                    ) -> Tuple[Callable[[str], object],
+                               Callable[[], List[str]]]:
+    """Module-level ``__getattr__`` and ``__dir__`` for a package whose
+    re-exports are imported on first access.
+
+    Parameters
+    ----------
+    package : str
+        ``__name__`` of the package
+
+    attributes : dict
+        each re-exported name to ``'.module'`` (the module itself) or
+        ``'.module:name'``, relative to ``package``. Submodules of the
+        package not named here are also imported on first access, as
+        they would be after an eager ``from . import ...``.
+
+    Returns
+    -------
+    __getattr__, __dir__ : function
+
+    Examples
+    --------
+    >>> __getattr__, __dir__ = lazy_attributes(
+    ...     'CPAC.utils', {'Provenance': '.provenance:Provenance'})
+    >>> __getattr__('Provenance').__name__
+    'Provenance'
+    >>> __getattr__('sparse_graph').__name__
+    'CPAC.utils.sparse_graph'
+    >>> __getattr__('nothing')
+    Traceback (most recent call last):
+    AttributeError: module 'CPAC.utils' has no attribute 'nothing'
+    >>> 'Provenance' in __dir__()
+    True
+    """
+    def __getattr__(name):
+        target = attributes.get(name)
+        if target is None:
+            if name.startswith('__') or importlib.util.find_spec(
+                    f'.{name}', package) is None:
+                raise AttributeError(
+                    f'module {package!r} has no attribute {name!r}')
+            target = f'.{name}'
+        module_name, _, attribute = target.partition(':')
+        value = importlib.import_module(module_name, package)
+        if attribute:
+            value = getattr(value, attribute)
+        setattr(sys.modules[package], name, value)
+        return value
+
+    def __dir__():
+        return sorted({*vars(sys.modules[package]), *attributes})
+
+    return __getattr__, __dir__
+
+
+def lazy_module(name: str) -> ModuleType:
+    """Import a module that is executed when one of its attributes is
+    first used.
+
+    Parameters
+    ----------
+    name : str
+        absolute module name; already-imported modules are returned
+        as they are
+
+    Returns
+    -------
+    module
+
+    Examples
+    --------
+    >>> colorsys = lazy_module('colorsys')
+    >>> colorsys.rgb_to_hsv(1, 0, 0)
+    (0.0, 1.0, 1)
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,268 @@
+# Copyright (C) 2022  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Streaming reader and incrementally updated summary of callback logs
+
+Resource reports and Gantt charts used to load a whole ``callback.log``
+into memory on every call. ``CallbackStore`` instead keeps one row per
+logged node in a SQLite database beside the log and, on each update,
+reads only the lines appended since the last one, so that reports query
+the summary in time that doesn't grow with how long the run has been
+going.
+"""
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional, Tuple
+
+BATCH_SIZE = 10000
+"""rows inserted per transaction while reading a callback log"""
+STORE_VERSION = 1
+RESOURCES = {'estimated_threads': ('num_threads', 1),
+             'estimated_memory_gb': ('estimated_memory_gb', 1.0),
+             'runtime_threads': ('runtime_threads', 0),
+             'runtime_memory_gb': ('runtime_memory_gb', 0.0)}
+"""each resource's column and the amount assumed when it isn't logged"""
+_COLUMNS = ('source', 'id', 'hash', 'start', 'finish', 'runtime_threads',
+            'runtime_memory_gb', 'estimated_memory_gb', 'num_threads',
+            'error')
+
+
+def read_callback_log(callback_log: str, offset: int = 0
+                      ) -> Iterator[Tuple[dict, int]]:
+    """Stream the logged nodes of a callback log from a byte offset.
+
+    Lines that aren't JSON objects with an ``id`` are skipped, and a
+    last line that is still being written is left for the next read.
+
+    Yields
+    ------
+    node : dict
+
+    offset : int
+        byte offset after the node's line
+    """
+    with open(callback_log, 'rb') as log_file:
+        log_file.seek(offset)
+        for line in log_file:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            try:
+                node = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(node, dict) and 'id' in node:
+                yield node, offset
+
+
+def _number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(
+        value, bool) else None
+
+
+def _seconds(value):
+    """Seconds since the epoch of an ISO timestamp, naive taken as UTC
+
+    Examples
+    --------
+    >>> _seconds('1970-01-01T00:01:00.5')
+    60.5
+    >>> _seconds('N/A') is None
+    True
+    """
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def _datetime(seconds):
+    """Naive datetime of seconds since the epoch, in UTC
+
+    Examples
+    --------
+    >>> _datetime(60.5).isoformat()
+    '1970-01-01T00:01:00.500000'
+    """
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+
+class CallbackStore:
+    """SQLite summary of one or more callback logs
+
+    Parameters
+    ----------
+    path : str
+        database file, created if it doesn't exist
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=60)
+        self._connection.row_factory = sqlite3.Row
+        with self._connection:
+            if self._connection.execute('PRAGMA user_version').fetchone()[
+                    0] != STORE_VERSION:
+                self._connection.executescript(f'''
+                    DROP TABLE IF EXISTS sources;
+                    DROP TABLE IF EXISTS nodes;
+                    CREATE TABLE sources (path TEXT PRIMARY KEY,
+                                          bytes_read INTEGER NOT NULL);
+                    CREATE TABLE nodes (source TEXT, id TEXT, hash TEXT,
+                                        start REAL, finish REAL,
+                                        runtime_threads REAL,
+                                        runtime_memory_gb REAL,
+                                        estimated_memory_gb REAL,
+                                        num_threads REAL, error INTEGER);
+                    CREATE INDEX nodes_start ON nodes (start);
+                    PRAGMA user_version = {STORE_VERSION};''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the database connection"""
+        self._connection.close()
+
+    def update(self, callback_log: str) -> int:
+        """Add the nodes logged since the last update
+
+        Returns
+        -------
+        int
+            number of nodes added
+        """
+        source = os.path.abspath(callback_log)
+        row = self._connection.execute(
+            'SELECT bytes_read FROM sources WHERE path = ?', (source,)
+        ).fetchone()
+        offset = row['bytes_read'] if row else 0
+        if offset > os.path.getsize(callback_log):
+            # log was replaced
+            offset = 0
+            with self._connection:
+                self._connection.execute(
+                    'DELETE FROM nodes WHERE source = ?', (source,))
+        added = 0
+        batch = []
+        for node, offset in read_callback_log(callback_log, offset):
+            batch.append((
+                source, str(node['id']), node.get('hash'),
+                _seconds(node.get('start')), _seconds(node.get('finish')),
+                _number(node.get('runtime_threads')),
+                _number(node.get('runtime_memory_gb')),
+                _number(node.get('estimated_memory_gb')),
+                _number(node.get('num_threads')), bool(node.get('error'))))
+            if len(batch) >= BATCH_SIZE:
+                added += self._insert(batch, source, offset)
+                batch = []
+        if batch or row is None or row['bytes_read'] != offset:
+            added += self._insert(batch, source, offset)
+        return added
+
+    def _insert(self, rows, source, offset):
+        with self._connection:
+            self._connection.executemany(
+                f'INSERT INTO nodes ({", ".join(_COLUMNS)}) VALUES '
+                f'({", ".join("?" * len(_COLUMNS))})', rows)
+            self._connection.execute(
+                'INSERT OR REPLACE INTO sources (path, bytes_read) VALUES '
+                '(?, ?)', (source, offset))
+        return len(rows)
+
+    def span(self) -> Optional[Tuple[datetime, datetime, int]]:
+        """Earliest start, latest finish and number of nodes with timing
+        information, or None if no node has any"""
+        row = self._connection.execute(
+            'SELECT MIN(start), MAX(finish), COUNT(*) FROM nodes WHERE '
+            'start IS NOT NULL AND finish IS NOT NULL').fetchone()
+        if not row[2]:
+            return None
+        return _datetime(row[0]), _datetime(row[1]), row[2]
+
+    def timed_nodes(self) -> Iterator[dict]:
+        """Nodes with timing information, in order of start
+
+        Yields
+        ------
+        dict
+            ``id``, ``start`` and ``finish`` datetimes, ``duration`` in
+            seconds and, if the node failed, ``error``
+        """
+        for row in self._connection.execute(
+                'SELECT id, start, finish, error FROM nodes WHERE start IS '
+                'NOT NULL AND finish IS NOT NULL ORDER BY start, rowid'):
+            node = {'id': row['id'], 'start': _datetime(row['start']),
+                    'finish': _datetime(row['finish']),
+                    'duration': row['finish'] - row['start']}
+            if row['error']:
+                node['error'] = True
+            yield node
+
+    def overused(self) -> Iterator[sqlite3.Row]:
+        """Nodes whose runtime memory exceeded their estimate, in order
+        logged"""
+        yield from self._connection.execute(
+            'SELECT id, runtime_memory_gb, estimated_memory_gb, '
+            'runtime_threads, num_threads FROM nodes WHERE '
+            'runtime_memory_gb > COALESCE(estimated_memory_gb, 1) '
+            'ORDER BY rowid')
+
+    def resource_timeseries(self, resource: str
+                            ) -> List[Tuple[datetime, float]]:
+        """Total of a resource over the nodes running at each time it
+        changes
+
+        Parameters
+        ----------
+        resource : str
+            key of ``RESOURCES``
+
+        Returns
+        -------
+        list of tuple
+            ``(time, amount)``
+        """
+        column, default = RESOURCES[resource]
+        series = []
+        for row in self._connection.execute(f'''
+                WITH events (time, amount) AS (
+                    SELECT start, COALESCE({column}, ?) FROM nodes
+                    WHERE start IS NOT NULL AND finish IS NOT NULL
+                    UNION ALL
+                    SELECT finish, -COALESCE({column}, ?) FROM nodes
+                    WHERE start IS NOT NULL AND finish IS NOT NULL)
+                SELECT time, SUM(SUM(amount)) OVER (ORDER BY time)
+                FROM events GROUP BY time ORDER BY time''',
+                                            (default, default)):
+            if not series or series[-1][1] != row[1]:
+                series.append((_datetime(row[0]), row[1]))
+        return series
+
+
+def summarize_callback_log(callback_log: str) -> CallbackStore:
+    """Open the summary store beside a callback log, updated with the
+    nodes logged since it was last updated"""
+    store = CallbackStore(f'{callback_log}.sqlite')
+    store.update(callback_log)
+    return store
@@ -236,15 +236,20 @@ def set_up_logger(name, filename=None, level=None, log_dir=None, mock=False,
 
     Examples
     --------
-    >>> lg = set_up_logger('test')
-    >>> lg.handlers[0].baseFilename.split('/')[-1]
+    >>> from tempfile import TemporaryDirectory
+    >>> with TemporaryDirectory() as log_dir:
+    ...     lg = set_up_logger('test', log_dir=log_dir)
+    ...     lg.handlers[0].baseFilename.split('/')[-1]
+    ...     lg.level
+    ...     lg.handlers[0].close()
+    ...     lg2 = set_up_logger('second_test', 'specific_filename.custom',
+    ...                         'debug', log_dir)
+    ...     lg2.handlers[0].baseFilename.split('/')[-1]
+    ...     lg2.level
+    ...     lg2.handlers[0].close()
     'test.log'
-    >>> lg.level
     0
-    >>> lg = set_up_logger('second_test', 'specific_filename.custom', 'debug')
-    >>> lg.handlers[0].baseFilename.split('/')[-1]
     'specific_filename.custom'
-    >>> lg.level
     10
     >>> lg = set_up_logger('third_test', mock=True)
     >>> getLogger('third_test') == lg
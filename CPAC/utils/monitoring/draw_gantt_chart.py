@@ -5,6 +5,8 @@
 # CHANGES:
 #     * Resolves bugs preventing the original from generating the chart
 #     * Handles when chart-drawing is called but no nodes were run (all cached)
+#     * Reads callback logs through an incrementally updated summary
+#       (CPAC.utils.monitoring.callback_store) instead of loading them whole
 
 # ORIGINAL WORK'S ATTRIBUTION NOTICE:
 #     Copyright (c) 2015-2019, Nipype developers
@@ -50,8 +52,9 @@ from collections import OrderedDict
 from datetime import datetime
 from warnings import warn
 
-from nipype.utils.draw_gantt_chart import draw_lines, draw_resource_bar, \
-                                          log_to_dict
+from nipype.utils.draw_gantt_chart import draw_lines, draw_resource_bar
+
+from CPAC.utils.monitoring.callback_store import summarize_callback_log
 
 
 def create_event_dict(start_time, nodes_list):
@@ -394,112 +397,59 @@ def generate_gantt_chart(
     </div>
     """  # noqa: E501
 
-    # Read in json-log to get list of node dicts
-    nodes_list = log_to_dict(logfile)
-
-    # Only include nodes with timing information, and covert timestamps
-    # from strings to datetimes
-    try:
-        nodes_list = _timing(nodes_list)
-    except ProcessLookupError:
-        warn(str(ProcessLookupError))
-        nodes_list = []
-
-    if not nodes_list:
-        return
+    # Summarize the json-log, reading only the nodes logged since it was
+    # last summarized
+    with summarize_callback_log(logfile) as store:
+        span = store.span()
+        if span is None:
+            return
+        start, finish, num_nodes = span
+        duration = (finish - start).total_seconds()
+
+        # Summary strings of workflow at top
+        html_string += (
+            "<p>Start: " + start.strftime("%Y-%m-%d %H:%M:%S") + "</p>"
+        )
+        html_string += (
+            "<p>Finish: " + finish.strftime("%Y-%m-%d %H:%M:%S") + "</p>"
+        )
+        html_string += "<p>Duration: " + "{0:.2f}".format(duration / 60) \
+                       + " minutes</p>"
+        html_string += "<p>Nodes: " + str(num_nodes) + "</p>"
+        html_string += "<p>Cores: " + str(cores) + "</p>"
+        html_string += close_header
+        # Draw nipype nodes Gantt chart and runtimes
+        html_string += draw_lines(
+            start, duration, minute_scale, space_between_minutes
+        )
+        html_string += draw_nodes(
+            start,
+            store.timed_nodes(),
+            cores,
+            minute_scale,
+            space_between_minutes,
+            colors,
+        )
 
-    for node in nodes_list:
-        if "duration" not in node:
-            node["duration"] = (node["finish"] - node["start"]).total_seconds()
-
-    # Create the header of the report with useful information
-    start_node = nodes_list[0]
-    last_node = nodes_list[-1]
-    duration = (last_node["finish"] - start_node["start"]).total_seconds()
-
-    # Get events based dictionary of node run stats
-    events = create_event_dict(start_node["start"], nodes_list)
-
-    # Summary strings of workflow at top
-    html_string += (
-        "<p>Start: " + start_node["start"].strftime("%Y-%m-%d %H:%M:%S")
-        + "</p>"
-    )
-    html_string += (
-        "<p>Finish: " + last_node["finish"].strftime("%Y-%m-%d %H:%M:%S")
-        + "</p>"
-    )
-    html_string += "<p>Duration: " + "{0:.2f}".format(duration / 60) \
-                   + " minutes</p>"
-    html_string += "<p>Nodes: " + str(len(nodes_list)) + "</p>"
-    html_string += "<p>Cores: " + str(cores) + "</p>"
-    html_string += close_header
-    # Draw nipype nodes Gantt chart and runtimes
-    html_string += draw_lines(
-        start_node["start"], duration, minute_scale, space_between_minutes
-    )
-    html_string += draw_nodes(
-        start_node["start"],
-        nodes_list,
-        cores,
-        minute_scale,
-        space_between_minutes,
-        colors,
-    )
-
-    # Get memory timeseries
-    estimated_mem_ts = calculate_resource_timeseries(
-        events, "estimated_memory_gb")
-    runtime_mem_ts = calculate_resource_timeseries(events, "runtime_memory_gb")
-    # Plot gantt chart
-    resource_offset = 120 + 30 * cores
-    html_string += draw_resource_bar(
-        start_node["start"],
-        last_node["finish"],
-        estimated_mem_ts,
-        space_between_minutes,
-        minute_scale,
-        "#90BBD7",
-        resource_offset * 2 + 120,
-        "Memory",
-    )
-    html_string += draw_resource_bar(
-        start_node["start"],
-        last_node["finish"],
-        runtime_mem_ts,
-        space_between_minutes,
-        minute_scale,
-        "#03969D",
-        resource_offset * 2 + 120,
-        "Memory",
-    )
-
-    # Get threads timeseries
-    estimated_threads_ts = calculate_resource_timeseries(
-        events, "estimated_threads")
-    runtime_threads_ts = calculate_resource_timeseries(
-        events, "runtime_threads")
-    # Plot gantt chart
-    html_string += draw_resource_bar(
-        start_node["start"],
-        last_node["finish"],
-        estimated_threads_ts,
-        space_between_minutes,
-        minute_scale,
-        "#90BBD7",
-        resource_offset,
-        "Threads",
-    )
-    html_string += draw_resource_bar(
-        start_node["start"],
-        last_node["finish"],
-        runtime_threads_ts,
-        space_between_minutes,
-        minute_scale,
-        "#03969D",
-        resource_offset,
-        "Threads",
-    )
+        # Plot memory and threads timeseries, estimated then actual
+        resource_offset = 120 + 30 * cores
+        for resource, left, label in [
+            ("memory_gb", resource_offset * 2 + 120, "Memory"),
+            ("threads", resource_offset, "Threads")
+        ]:
+            for kind, color in [("estimated", "#90BBD7"),
+                                ("runtime", "#03969D")]:
+                html_string += draw_resource_bar(
+                    start,
+                    finish,
+                    _time_series(
+                        store.resource_timeseries(f"{kind}_{resource}")),
+                    space_between_minutes,
+                    minute_scale,
+                    color,
+                    left,
+                    label,
+                )
 
     # finish html
     html_string += """
@@ -526,20 +476,15 @@ def resource_overusage_report(cblog):
 
     excessive: dict
     '''
-    cb_dict_list = log_to_dict(cblog)
-    excessive = {node['id']: [
-        node['runtime_memory_gb']if node.get('runtime_memory_gb', 0)
-        > node.get('estimated_memory_gb', 1) else None,
-        node['estimated_memory_gb'] if node.get('runtime_memory_gb', 0)
-        > node.get('estimated_memory_gb', 1) else None,
-        node['runtime_threads'] - 1 if node.get('runtime_threads', 0) - 1
-        > node.get('num_threads', 1) else None,
-        node['num_threads'] if node.get('runtime_threads', 0) - 1
-        > node.get('num_threads', 1) else None
-    ] for node in [node for node in cb_dict_list if (
-        node.get('runtime_memory_gb', 0) > node.get('estimated_memory_gb', 1)
-        # or node.get('runtime_threads', 0) - 1 > node.get('num_threads', 1)
-    )]}
+    with summarize_callback_log(cblog) as store:
+        excessive = {node['id']: [
+            node['runtime_memory_gb'],
+            node['estimated_memory_gb'],
+            node['runtime_threads'] - 1 if (node['runtime_threads'] or 0) - 1
+            > (node['num_threads'] or 1) else None,
+            node['num_threads'] if (node['runtime_threads'] or 0) - 1
+            > (node['num_threads'] or 1) else None
+        ] for node in store.overused()}
     text_report = ''
     if excessive:
         text_report += 'The following nodes used excessive resources:\n'
@@ -598,6 +543,16 @@ def resource_report(callback_log, num_cores, logger=None):
             warn(e_msg, category=ResourceWarning)
 
 
+def _time_series(series):
+    """pandas Series of a resource's ``(time, amount)`` timeseries, for
+    ``draw_resource_bar``"""
+    # Import packages
+    import pandas as pd
+
+    return pd.Series(data=[amount for _, amount in series],
+                     index=[time for time, _ in series], dtype=float)
+
+
 def _timing(nodes_list):
     """Covert timestamps from strings to datetimes
 
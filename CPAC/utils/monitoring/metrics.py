@@ -0,0 +1,331 @@
+# Copyright (C) 2022  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Live metrics of running pipelines
+
+Two sources in a pipeline's log directory feed the metrics, so that a
+monitoring server in another process (or on another machine with the
+log directory mounted) can report on every scheduler of a run:
+
+* each scheduler plugin's resource accounting, which the plugin writes
+  to ``scheduler_metrics.json`` beside its callback log at most every
+  ``pipeline_setup: system_config: scheduler_metrics: interval`` seconds
+* the nodes ``log_nodes_cb`` writes to each ``callback.log``, read
+  incrementally from where the last read stopped
+
+``PipelineMetrics`` combines them into per-scheduler queue depth and
+memory and processors in use vs. reserved, per-participant progress and
+ETA, and per-node-type runtimes, as JSON or Prometheus text.
+"""
+import glob
+import json
+import os
+import threading
+import time
+from typing import Optional
+from CPAC.pipeline.plan import _group_key, _node_key
+from .callback_store import read_callback_log, _seconds
+
+METRICS_FILENAME = 'scheduler_metrics.json'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def write_scheduler_metrics(path: str, metrics: dict) -> None:
+    """Replace a scheduler metrics file, so readers never see it
+    partly written"""
+    partial = f'{path}.{os.getpid()}.tmp'
+    with open(partial, 'w', encoding='utf-8') as metrics_file:
+        json.dump(metrics, metrics_file)
+    os.replace(partial, path)
+
+
+def participant_eta(done: int, total: int, started: Optional[float],
+                    now: float) -> Optional[float]:
+    """Seconds until a participant's remaining nodes finish, at the
+    rate its finished nodes have so far
+
+    Examples
+    --------
+    >>> participant_eta(25, 100, started=0, now=600)
+    1800.0
+    >>> participant_eta(100, 100, started=0, now=600)
+    0.0
+    >>> participant_eta(0, 100, started=0, now=600) is None
+    True
+    """
+    if done >= total:
+        return 0.0
+    if not done or started is None:
+        return None
+    return (now - started) * (total - done) / done
+
+
+class _NodeRuntimes:
+    """Runtimes of one node type's finished nodes"""
+    def __init__(self):
+        self.count = 0
+        self.failed = 0
+        self.seconds_sum = 0.0
+        self.seconds_max = 0.0
+        self.memory_gb_max = 0.0
+
+    def add(self, node) -> bool:
+        """Add a logged node and return whether it finished"""
+        start, finish = _seconds(node.get('start')), _seconds(
+            node.get('finish'))
+        if start is None or finish is None or node.get('error'):
+            self.failed += 1
+            return False
+        self.count += 1
+        self.seconds_sum += finish - start
+        self.seconds_max = max(self.seconds_max, finish - start)
+        memory_gb = node.get('runtime_memory_gb')
+        if isinstance(memory_gb, (int, float)):
+            self.memory_gb_max = max(self.memory_gb_max, memory_gb)
+        return True
+
+    def merge(self, other):
+        self.count += other.count
+        self.failed += other.failed
+        self.seconds_sum += other.seconds_sum
+        self.seconds_max = max(self.seconds_max, other.seconds_max)
+        self.memory_gb_max = max(self.memory_gb_max, other.memory_gb_max)
+
+
+class _CallbackLogSummary:
+    """Finished nodes of one callback log, by node type and participant"""
+    def __init__(self):
+        self.offset = 0
+        self.node_types = {}
+        self.finished = {}
+        self.failed = {}
+
+    def update(self, callback_log):
+        for node, self.offset in read_callback_log(callback_log,
+                                                   self.offset):
+            if 'start' not in node and not node.get('error'):
+                # logged by log_nodes_initial, before the node ran
+                continue
+            participant = str(node['id']).split('.', 1)[0]
+            counts = self.finished if self.node_types.setdefault(
+                _group_key(_node_key(str(node['id']))), _NodeRuntimes()
+            ).add(node) else self.failed
+            counts[participant] = counts.get(participant, 0) + 1
+
+
+class PipelineMetrics:
+    """Metrics of the schedulers and callback logs in a pipeline's log
+    directory, updated from what was written since the last update
+
+    Parameters
+    ----------
+    pipeline_dir : str
+        the pipeline's log directory, holding the log directory of each
+        participant run on its own or the callback log of participants
+        run together
+    """
+    def __init__(self, pipeline_dir: str):
+        self.pipeline_dir = pipeline_dir
+        self._callback_logs = {}
+        self._lock = threading.Lock()
+
+    def _files(self, filename):
+        return sorted(glob.glob(os.path.join(self.pipeline_dir, filename)) +
+                      glob.glob(os.path.join(self.pipeline_dir, '*',
+                                             filename)))
+
+    def _update_callback_logs(self):
+        for callback_log in self._files('callback.log'):
+            summary = self._callback_logs.get(callback_log)
+            if summary is None or summary.offset > os.path.getsize(
+                    callback_log):
+                # new or replaced log
+                summary = self._callback_logs[callback_log] = \
+                    _CallbackLogSummary()
+            summary.update(callback_log)
+
+    def _schedulers(self):
+        schedulers = {}
+        for metrics_file in self._files(METRICS_FILENAME):
+            try:
+                with open(metrics_file, 'r', encoding='utf-8') as state:
+                    scheduler = json.load(state)
+            except (OSError, ValueError):
+                continue
+            schedulers[os.path.relpath(os.path.dirname(metrics_file),
+                                       self.pipeline_dir)] = scheduler
+        return schedulers
+
+    def snapshot(self, now: Optional[float] = None) -> dict:
+        """Read what was written since the last snapshot and return the
+        current metrics
+
+        Parameters
+        ----------
+        now : float, optional
+            seconds since the epoch to estimate ETAs at, default now
+
+        Returns
+        -------
+        dict
+            ``schedulers`` (keyed by log directory relative to the
+            pipeline's), ``participants`` and ``nodes`` (keyed by node
+            type)
+        """
+        if now is None:
+            now = time.time()
+        node_types = {}
+        logged = {}
+        with self._lock:
+            self._update_callback_logs()
+            for summary in self._callback_logs.values():
+                for node_type, runtimes in summary.node_types.items():
+                    node_types.setdefault(node_type, _NodeRuntimes()).merge(
+                        runtimes)
+                for counts, key in ((summary.finished, 'nodes_finished'),
+                                    (summary.failed, 'nodes_failed')):
+                    for participant, count in counts.items():
+                        logged.setdefault(participant, {
+                            'nodes_finished': 0, 'nodes_failed': 0
+                        })[key] += count
+        schedulers = self._schedulers()
+        participants = {}
+        for name, scheduler in schedulers.items():
+            for participant, progress in scheduler.pop(
+                    'participants', {}).items():
+                elapsed = now - progress['started'] if progress.get(
+                    'started') is not None else None
+                participants[participant] = {
+                    'scheduler': name, 'nodes_total': progress['total'],
+                    'nodes_done': progress['done'],
+                    'nodes_running': progress['running'],
+                    'progress': progress['done'] / progress['total'] if
+                    progress['total'] else 1.0,
+                    'nodes_per_minute': 60 * progress['done'] / elapsed if
+                    elapsed else None,
+                    'eta_seconds': participant_eta(
+                        progress['done'], progress['total'],
+                        progress.get('started'), now)}
+        for participant in set(participants) | set(logged):
+            participants.setdefault(participant, {}).update(logged.get(
+                participant, {'nodes_finished': 0, 'nodes_failed': 0}))
+        return {'time': now, 'schedulers': schedulers,
+                'participants': participants,
+                'nodes': {node_type: {
+                    'count': runtimes.count, 'failed': runtimes.failed,
+                    'seconds_sum': runtimes.seconds_sum,
+                    'seconds_max': runtimes.seconds_max,
+                    'memory_gb_max': runtimes.memory_gb_max
+                } for node_type, runtimes in sorted(node_types.items())}}
+
+    def prometheus(self, now: Optional[float] = None) -> str:
+        """The current metrics in Prometheus text exposition format"""
+        return prometheus_text(self.snapshot(now))
+
+
+_SCHEDULER_METRICS = (
+    ('updated', 'cpac_scheduler_last_update_timestamp_seconds',
+     'When the scheduler last wrote its metrics'),
+    ('running', 'cpac_scheduler_running_tasks', 'Nodes running'),
+    ('ready', 'cpac_scheduler_ready_jobs',
+     'Nodes whose dependencies have finished, waiting to run'),
+    ('memory_gb', 'cpac_scheduler_memory_budget_gb', 'Memory budget'),
+    ('reserved_memory_gb', 'cpac_scheduler_memory_reserved_gb',
+     'Memory estimated for running nodes'),
+    ('used_memory_gb', 'cpac_scheduler_memory_used_gb',
+     'Resident memory of the scheduler and its running nodes'),
+    ('free_memory_gb', 'cpac_scheduler_memory_free_gb',
+     'Memory available to start nodes'),
+    ('processors', 'cpac_scheduler_processors', 'Processor budget'),
+    ('reserved_processors', 'cpac_scheduler_processors_reserved',
+     'Threads of running nodes'),
+    ('free_processors', 'cpac_scheduler_processors_free',
+     'Processors available to start nodes'))
+_PARTICIPANT_METRICS = (
+    ('nodes_total', 'cpac_participant_nodes', 'gauge',
+     'Nodes in the participant\'s workflow'),
+    ('nodes_done', 'cpac_participant_nodes_done', 'gauge',
+     'Nodes the scheduler has finished'),
+    ('nodes_running', 'cpac_participant_nodes_running', 'gauge',
+     'Nodes running'),
+    ('progress', 'cpac_participant_progress_ratio', 'gauge',
+     'Fraction of nodes finished'),
+    ('eta_seconds', 'cpac_participant_eta_seconds', 'gauge',
+     'Estimated seconds until the participant finishes'),
+    ('nodes_finished', 'cpac_participant_nodes_finished_total', 'counter',
+     'Nodes logged as finished'),
+    ('nodes_failed', 'cpac_participant_nodes_failed_total', 'counter',
+     'Nodes logged as failed'))
+_NODE_METRICS = (
+    ('count', 'cpac_node_runtime_seconds_count', 'Finished nodes'),
+    ('seconds_sum', 'cpac_node_runtime_seconds_sum',
+     'Summed runtime of finished nodes'),
+    ('seconds_max', 'cpac_node_runtime_seconds_max',
+     'Longest runtime of a finished node'),
+    ('memory_gb_max', 'cpac_node_memory_gb_max',
+     'Most memory a finished node used'),
+    ('failed', 'cpac_node_failed_total', 'Failed nodes'))
+
+
+def _label(value):
+    """Prometheus label value
+
+    Examples
+    --------
+    >>> print(_label('say "hi"'))
+    "say \\"hi\\""
+    """
+    return '"{}"'.format(str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n'))
+
+
+def _family(lines, name, metric_type, description, samples):
+    samples = [(label, value) for label, value in samples if
+               isinstance(value, (int, float)) and
+               not isinstance(value, bool)]
+    if not samples:
+        return
+    lines.append(f'# HELP {name} {description}')
+    lines.append(f'# TYPE {name} {metric_type}')
+    lines += [f'{name}{{{label}}} {value}' for label, value in samples]
+
+
+def prometheus_text(snapshot: dict) -> str:
+    """Format a ``PipelineMetrics.snapshot`` as Prometheus text
+
+    Examples
+    --------
+    >>> print(prometheus_text({'schedulers': {'sub-1': {'running': 2}},
+    ...     'participants': {}, 'nodes': {}}), end='')
+    # HELP cpac_scheduler_running_tasks Nodes running
+    # TYPE cpac_scheduler_running_tasks gauge
+    cpac_scheduler_running_tasks{scheduler="sub-1"} 2
+    """
+    lines = []
+    for key, name, description in _SCHEDULER_METRICS:
+        _family(lines, name, 'gauge', description, [
+            (f'scheduler={_label(scheduler)}', metrics.get(key)) for
+            scheduler, metrics in snapshot['schedulers'].items()])
+    for key, name, metric_type, description in _PARTICIPANT_METRICS:
+        _family(lines, name, metric_type, description, [
+            (f'participant={_label(participant)}', metrics.get(key)) for
+            participant, metrics in snapshot['participants'].items()])
+    for key, name, description in _NODE_METRICS:
+        _family(lines, name, 'counter' if key in (
+            'count', 'seconds_sum', 'failed') else 'gauge', description, [
+                (f'node={_label(node_type)}', metrics[key]) for
+                node_type, metrics in snapshot['nodes'].items()])
+    return '\n'.join(lines) + '\n' if lines else ''
@@ -5,11 +5,14 @@ import math
 import networkx as nx
 import socketserver
 import threading
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse
 
 from traits.trait_base import Undefined
 
 from CPAC.pipeline import nipype_pipeline_engine as pe
 from .custom_logging import getLogger
+from .metrics import PipelineMetrics, PROMETHEUS_CONTENT_TYPE
 
 
 # Log initial information from all the nodes
@@ -91,10 +94,35 @@ def log_nodes_cb(node, status):
     logger.debug(json.dumps(status_dict))
 
 
-class LoggingRequestHandler(socketserver.BaseRequestHandler):
-
-    def handle(self):
+class LoggingRequestHandler(BaseHTTPRequestHandler):
+    """Serves live metrics at ``/metrics`` (Prometheus text) and
+    ``/metrics.json``, and each participant's logged nodes at any other
+    path"""
 
+    def do_GET(self):  # pylint: disable=invalid-name
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            body = self.server.metrics.prometheus()
+            content_type = PROMETHEUS_CONTENT_TYPE
+        elif path == '/metrics.json':
+            body = json.dumps(self.server.metrics.snapshot()) + "\n"
+            content_type = 'application/json'
+        else:
+            body = json.dumps(self.log_tree()) + "\n"
+            content_type = 'application/json'
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        getLogger('nipype.workflow').debug(format, *args)
+
+    def log_tree(self):
+        """Each participant's logged nodes"""
         tree = {}
 
         logs = glob.glob(
@@ -151,8 +179,7 @@ class LoggingRequestHandler(socketserver.BaseRequestHandler):
 
                 tree = {s: t for s, t in tree.items() if t}
 
-        headers = 'HTTP/1.1 200 OK\nConnection: close\n\n'
-        self.request.sendall(headers + json.dumps(tree) + "\n")
+        return tree
 
 
 class LoggingHTTPServer(socketserver.ThreadingTCPServer, object):
@@ -166,6 +193,8 @@ class LoggingHTTPServer(socketserver.ThreadingTCPServer, object):
 
         self.logging_dir = logging_dir
         self.pipeline_name = pipeline_name
+        self.metrics = PipelineMetrics(
+            os.path.join(logging_dir, "pipeline_" + pipeline_name))
 
 
 def monitor_server(pipeline_name, logging_dir, host='0.0.0.0', port=8080):
@@ -173,7 +202,7 @@ def monitor_server(pipeline_name, logging_dir, host='0.0.0.0', port=8080):
                               LoggingRequestHandler)
 
     server_thread = threading.Thread(target=httpd.serve_forever)
-    server_thread.isDaemon = True
+    server_thread.daemon = True
     server_thread.start()
 
     return server_thread
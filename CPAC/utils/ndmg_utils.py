@@ -127,46 +127,27 @@ class graph(object):
         """
         import time
         import numpy as np
-        import networkx as nx
-        from itertools import product
-
-        self.g = nx.Graph(name="Generated by NeuroData's MRI Graphs (ndmg)",
-                          version='0.1.1',
-                          date=time.asctime(time.localtime()),
-                          source="http://m2g.io",
-                          region="brain",
-                          sensor=self.modal,
-                          ecount=0,
-                          vcount=len(self.n_ids)
-                          )
-        print(self.g.graph)
-        [str(self.g.add_node(ids)) for ids in self.n_ids]
+        from CPAC.utils.sparse_graph import SparseGraph
 
         nlines = np.shape(streamlines)[0]
         print("# of Streamlines: " + str(nlines))
-        print_id = np.max((int(nlines*0.05), 1))  # in case nlines*.05=0
-        for idx, streamline in enumerate(streamlines):
-            if (idx % print_id) == 0:
-                print(idx)
-
-            points = np.round(streamline).astype(int)
-            p = set()
-            for point in points:
-                try:
-                    loc = self.rois[point[0], point[1], point[2]]
-                except IndexError:
-                    pass
-                else:
-                    pass
-
-                if loc:
-                    p.add(loc)
-            edges = set([tuple(sorted(x)) for x in product(p, p)])
-            for edge in edges:
-                lst = tuple(sorted([str(node) for node in edge]))
-                self.edge_dict[lst] += 1
-        edge_list = [(int(k[0]), int(k[1]), v) for k, v in self.edge_dict.items()]
-        self.g.add_weighted_edges_from(edge_list)
+        # one sparse streamline × region product instead of a loop over
+        # every pair of regions each streamline passes through
+        self.sparse_graph = SparseGraph.from_streamlines(streamlines,
+                                                         self.rois)
+        self.g = self.sparse_graph.to_networkx(
+            name="Generated by NeuroData's MRI Graphs (ndmg)",
+            version='0.1.1',
+            date=time.asctime(time.localtime()),
+            source="http://m2g.io",
+            region="brain",
+            sensor=self.modal,
+            ecount=0,
+            vcount=len(self.n_ids))
+        print(self.g.graph)
+        for node_a, node_b, weight in self.g.edges(data='weight'):
+            self.edge_dict[tuple(sorted([str(node_a), str(node_b)]))] = \
+                weight
 
     def cor_graph(self, timeseries, attr=None):
         """
@@ -181,7 +162,7 @@ class graph(object):
         rois = timeseries[1]
         print("Estimating correlation matrix for {} ROIs...".format(self.N))
         self.g = np.abs(np.corrcoef(timeseries))  # calculate pearson correlation
-        self.g = np.nan_to_num(self.g).astype(object)
+        self.g = np.nan_to_num(self.g)
         self.n_ids = rois
         # roilist = self.g.nodes()
 
@@ -242,8 +223,15 @@ class graph(object):
 
 
 def ndmg_create_graphs(ts, labels):
+    """Save the ROI correlation graph as a CSV matrix, and alongside it
+    (``measure-correlation.npz``) as a ``SparseGraph``."""
+    from CPAC.utils.sparse_graph import SparseGraph
     out_file = os.path.join(os.getcwd(), 'measure-correlation.csv')
     connectome = graph(ts.shape[0], labels, sens="func")
+    roi_ids = connectome.n_ids
     conn = connectome.cor_graph(ts)
     connectome.save_graph(out_file)
+    SparseGraph(conn, node_ids=roi_ids if len(roi_ids) == len(conn) else
+                None, metadata={'measure': 'correlation', 'absolute': True}
+                ).save(out_file.replace('.csv', '.npz'))
     return out_file
@@ -0,0 +1,148 @@
+# Copyright (C) 2022  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Interned, immutable CpacProvenance
+
+A resource's ``CpacProvenance`` is a nested list whose string entries
+are ``{resource}:{node}`` and whose list entries are the provenances of
+its inputs. The same sub-provenances recur throughout a pipeline's
+ResourcePool, and their string forms are the ResourcePool's strategy
+keys, so ``Provenance`` stores each distinct provenance once, with its
+string form, hash, last entry and sources computed at most once.
+
+``Provenance`` is a ``list`` subclass so that existing ``isinstance``
+checks, indexing, iteration and JSON serialization are unchanged.
+"""
+from weakref import WeakValueDictionary
+
+
+def _immutable(self, *args, **kwargs):
+    raise TypeError(f"'{self.__class__.__name__}' object is immutable")
+
+
+class Provenance(list):
+    """An interned, immutable CpacProvenance.
+
+    Examples
+    --------
+    >>> ingress = Provenance(['T1w:anat_ingress'])
+    >>> prov = Provenance([['T1w:anat_ingress'], 'desc-brain_T1w:masking'])
+    >>> prov[0] is ingress
+    True
+    >>> prov is Provenance([['T1w:anat_ingress'], 'desc-brain_T1w:masking'])
+    True
+    >>> str(prov) == str([['T1w:anat_ingress'], 'desc-brain_T1w:masking'])
+    True
+    >>> prov.resource, prov.last_entry
+    ('desc-brain_T1w', 'desc-brain_T1w:masking')
+    >>> prov == [['T1w:anat_ingress'], 'desc-brain_T1w:masking']
+    True
+    >>> import json
+    >>> json.dumps(prov)
+    '[["T1w:anat_ingress"], "desc-brain_T1w:masking"]'
+    >>> prov.append('bold:func_ingress')
+    Traceback (most recent call last):
+    TypeError: 'Provenance' object is immutable
+    """
+    __slots__ = ('_hash', '_str', '_last_entry', '_sources', '__weakref__')
+    _interned = WeakValueDictionary()
+
+    def __new__(cls, entries=()):
+        if type(entries) is cls:
+            return entries
+        key = tuple(entry if isinstance(entry, str) else cls(entry) for
+                    entry in entries)
+        try:
+            return cls._interned[key]
+        except KeyError:
+            pass
+        self = super().__new__(cls)
+        list.extend(self, key)
+        self._hash = hash(key)
+        self._str = None
+        self._last_entry = None
+        self._sources = None
+        cls._interned[key] = self
+        return self
+
+    def __init__(self, entries=()):
+        # populated once, in __new__
+        pass
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, Provenance):
+            return self is other
+        return list.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        if self._str is None:
+            self._str = list.__repr__(self)
+        return self._str
+
+    __str__ = __repr__
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (self.__class__, (list(self),))
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = \
+        insert = pop = remove = clear = sort = reverse = _immutable
+
+    @property
+    def last_entry(self):
+        """The ``{resource}:{node}`` string that produced this
+        provenance's resource"""
+        if self._last_entry is None:
+            prov = self
+            while not isinstance(prov[-1], str):
+                prov = prov[-1]
+            self._last_entry = prov[-1]
+        return self._last_entry
+
+    @property
+    def resource(self):
+        """The resource this is the provenance of"""
+        return self.last_entry.split(':')[0]
+
+    @property
+    def sources(self):
+        """frozenset of every ``{resource}:{node}`` string in this
+        provenance"""
+        if self._sources is None:
+            sources = set()
+            for entry in self:
+                if isinstance(entry, str):
+                    sources.add(entry)
+                else:
+                    sources.update(entry.sources)
+            self._sources = frozenset(sources)
+        return self._sources
+
+    def to_list(self):
+        """This provenance as nested plain lists"""
+        return [entry if isinstance(entry, str) else entry.to_list() for
+                entry in self]
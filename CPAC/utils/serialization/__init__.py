@@ -1,3 +1,4 @@
 from .core import VERSION_WORKFLOW
+from .workflow_cache import cached_workflow, workflow_cache_key
 from .workflow_json import save_workflow_json, WorkflowJSONMeta
-from .workflow_pickle import save_workflow_pickle
+from .workflow_pickle import load_workflow_pickle, save_workflow_pickle
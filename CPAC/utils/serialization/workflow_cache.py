@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+from typing import Any, Callable
+
+from nipype import logging
+
+from .core import VERSION_WORKFLOW, version_cpac, version_nipype
+from .workflow_pickle import load_workflow_pickle, save_workflow_pickle
+
+logger = logging.getLogger('nipype.workflow')
+
+
+def workflow_cache_key(cfg: Any, sub_dict: dict) -> str:
+    """
+    Hash everything a participant's built workflow depends on.
+
+    Parameters
+    ----------
+    cfg : Validated pipeline Configuration.
+    sub_dict : The participant's data configuration entry.
+
+    Returns
+    -------
+    str
+        SHA-256 hex digest of the configuration, the participant entry and
+        the C-PAC, nipype and workflow file versions.
+    """
+
+    config = cfg.dict() if hasattr(cfg, 'dict') else dict(cfg)
+    # set from ``sub_dict`` while building, so not an input of the build
+    config['pipeline_setup'] = {key: value for key, value in
+                                config['pipeline_setup'].items() if
+                                key != 'input_creds_path'}
+    inputs = {
+        'version': {'workflow': VERSION_WORKFLOW, 'cpac': version_cpac,
+                    'nipype': version_nipype},
+        'config': config,
+        'participant': sub_dict,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str
+                                     ).encode('utf-8')).hexdigest()
+
+
+def cached_workflow(cache_dir: str, cfg: Any, sub_dict: dict,
+                    build: Callable[[], Any]) -> Any:
+    """
+    Load a participant's workflow from the build cache, or build it with
+    ``build`` and store it there.
+
+    Parameters
+    ----------
+    cache_dir : Directory for cached workflows.
+    cfg : Validated pipeline Configuration.
+    sub_dict : The participant's data configuration entry.
+    build : Callable taking no arguments that returns the built workflow.
+
+    Returns
+    -------
+    Workflow
+    """
+
+    key = workflow_cache_key(cfg, sub_dict)
+    filename = os.path.join(cache_dir, f'{key}.pkl')
+    if os.path.exists(filename):
+        try:
+            workflow = load_workflow_pickle(filename)['workflow']
+            logger.info('Loaded workflow from build cache %s', filename)
+            return workflow
+        except Exception as exception:  # pylint: disable=broad-except
+            logger.warning('Rebuilding workflow; could not load build '
+                           'cache %s: %s', filename, exception)
+    workflow = build()
+    partial = f'{filename}.{os.getpid()}.partial'
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        save_workflow_pickle(partial, workflow,
+                             meta={'participant': sub_dict.get(
+                                 'subject_id')})
+        # atomic so concurrent runs never read a partial file
+        os.replace(partial, filename)
+    except Exception as exception:  # pylint: disable=broad-except
+        logger.warning('Could not write build cache %s: %s', filename,
+                       exception)
+        if os.path.exists(partial):
+            os.remove(partial)
+    return workflow
@@ -1,10 +1,11 @@
 import pickle
 from typing import Any
 
-from .core import workflow_container
+from .core import VERSION_WORKFLOW, workflow_container
 
 
-def save_workflow_pickle(filename: str, workflow: Any) -> None:
+def save_workflow_pickle(filename: str, workflow: Any, meta: Any = None
+                         ) -> None:
     """
     Serialize and save workflow object to a file.
 
@@ -12,8 +13,37 @@ def save_workflow_pickle(filename: str, workflow: Any) -> None:
     ----------
     filename : Filename to save to.
     workflow : Workflow object. (Can be any pickle-able python object.)
+    meta : Meta information.
     """
 
-    obj = workflow_container(workflow)
+    obj = workflow_container(workflow, meta)
     with open(filename, 'wb') as handle:
-        pickle.dump(workflow_container(obj), file=handle, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(obj, file=handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_workflow_pickle(filename: str) -> dict:
+    """
+    Load a workflow container saved by ``save_workflow_pickle``.
+
+    Parameters
+    ----------
+    filename : Filename to load from.
+
+    Returns
+    -------
+    dict
+        Container dictionary with 'version', 'meta' and 'workflow' keys.
+
+    Raises
+    ------
+    ValueError
+        If the file was not saved with the current workflow file version.
+    """
+
+    with open(filename, 'rb') as handle:
+        obj = pickle.load(handle)
+    if not isinstance(obj, dict) or obj.get('version', {}).get(
+            'workflow') != VERSION_WORKFLOW:
+        raise ValueError(f'{filename} is not a version {VERSION_WORKFLOW} '
+                         'workflow file')
+    return obj
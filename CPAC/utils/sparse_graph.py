@@ -0,0 +1,405 @@
+# Copyright (C) 2022  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Sparse thresholded connectivity graphs
+
+A ``SparseGraph`` is an undirected weighted graph stored as a symmetric
+CSR adjacency matrix, persisted as ``.npz``. It is built with vectorized
+code from timeseries (streaming correlation tiles under a memory budget,
+with correlation or sparsity thresholds) or from streamlines, and is
+shared by the ndmg graph outputs and in-process network centrality.
+"""
+import json
+import numpy as np
+from scipy import sparse
+
+# bytes per correlation-tile element: the float32 tile itself plus
+# boolean and float temporaries while thresholding
+TILE_BYTES_PER_ELEMENT = 12
+# bytes per stored edge: int32 row, int32 column and float32 weight
+EDGE_BYTES = 12
+
+
+def normalize_timeseries(timeseries):
+    """Demean and scale each column to unit norm, in place, so that the
+    dot product of two columns is their Pearson correlation. Constant
+    columns become all zeros.
+
+    Parameters
+    ----------
+    timeseries : numpy.ndarray
+        timepoints × nodes float array
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    timeseries -= timeseries.mean(axis=0)
+    norms = np.linalg.norm(timeseries, axis=0)
+    norms[norms == 0] = np.inf
+    timeseries /= norms
+    return timeseries
+
+
+def tile_rows(n_voxels, memory_gb, reserved_bytes=0):
+    """Number of correlation-matrix rows per tile that fit in
+    ``memory_gb`` after ``reserved_bytes``.
+
+    Examples
+    --------
+    >>> tile_rows(1000, 1.0)
+    1000
+    >>> tile_rows(200000, 1.0)
+    447
+    """
+    available = memory_gb * 1024 ** 3 - reserved_bytes
+    rows = int(available // (n_voxels * TILE_BYTES_PER_ELEMENT))
+    return min(max(rows, 1), n_voxels)
+
+
+def correlation_tiles(timeseries, rows):
+    """Yield ``(start, stop, tile)`` row blocks of the correlation
+    matrix of normalized timeseries. Self-correlations are set to -2 so
+    no threshold in [-1, 1] includes them.
+    """
+    n_voxels = timeseries.shape[1]
+    for start in range(0, n_voxels, rows):
+        stop = min(start + rows, n_voxels)
+        tile = timeseries[:, start:stop].T @ timeseries
+        tile[np.arange(stop - start), np.arange(start, stop)] = -2
+        yield start, stop, tile
+
+
+class SparsityEdges:
+    """Running top-k selection of upper-triangle edges, for sparsity
+    thresholds.
+    """
+    def __init__(self, k):
+        self.k = k
+        self.cut = -np.inf
+        self.rows, self.cols, self.values = [], [], []
+        self.size = 0
+
+    def add(self, start, tile):
+        """Add the candidate edges from a correlation tile"""
+        cut = self.cut
+        if tile.size > 2 * self.k:
+            # each edge appears at most twice in a tile, so nothing below
+            # the tile's 2k-th largest value can be in the global top k
+            cut = max(cut, np.partition(tile.ravel(), -2 * self.k
+                                        )[-2 * self.k])
+        rows, cols = np.nonzero(tile >= cut)
+        rows += start
+        upper = cols > rows
+        rows, cols = rows[upper], cols[upper]
+        values = tile[rows - start, cols]
+        self.rows.append(rows.astype(np.int32))
+        self.cols.append(cols.astype(np.int32))
+        self.values.append(values)
+        self.size += values.size
+        if self.size > 2 * self.k:
+            self._prune()
+
+    def _prune(self):
+        rows, cols, values = (np.concatenate(part) for part in (
+            self.rows, self.cols, self.values))
+        if values.size > self.k:
+            keep = np.argpartition(values, -self.k)[-self.k:]
+            rows, cols, values = rows[keep], cols[keep], values[keep]
+            self.cut = values.min()
+        self.rows, self.cols, self.values = [rows], [cols], [values]
+        self.size = values.size
+
+    def matrix(self, n_voxels):
+        """Symmetric CSR adjacency of the ``k`` strongest edges"""
+        self._prune()
+        upper = sparse.coo_matrix(
+            (self.values[0], (self.rows[0], self.cols[0])),
+            shape=(n_voxels, n_voxels))
+        return (upper + upper.T).tocsr()
+
+
+class ThresholdedEdges:
+    """Edges above a correlation threshold, stored while they fit in
+    ``max_edges``.
+    """
+    def __init__(self, threshold, max_edges):
+        self.threshold = threshold
+        self.max_edges = max_edges
+        self.indptr = [np.zeros(1, dtype=np.int64)]
+        self.indices, self.values = [], []
+        self.size = 0
+        self.overflow = False
+
+    def add(self, tile, above):
+        """Add the edges of a correlation tile flagged in ``above``"""
+        if self.overflow:
+            return
+        counts = above.sum(axis=1)
+        self.size += int(counts.sum())
+        if self.size > self.max_edges:
+            self.overflow = True
+            self.indices, self.values = [], []
+            return
+        self.indptr.append(self.indptr[-1][-1] + np.cumsum(counts))
+        rows, cols = np.nonzero(above)
+        self.indices.append(cols.astype(np.int32))
+        self.values.append(tile[rows, cols])
+
+    def matrix(self, n_voxels):
+        """CSR adjacency, or None if the edges did not fit"""
+        if self.overflow:
+            return None
+        return sparse.csr_matrix((np.concatenate(self.values),
+                                  np.concatenate(self.indices),
+                                  np.concatenate(self.indptr)),
+                                 shape=(n_voxels, n_voxels))
+
+
+def power_iteration(matvec, n_voxels, max_iter=1000, tolerance=1e-6):
+    """Leading eigenvector of a symmetric nonnegative operator.
+
+    The identity is added to the operator so the iteration converges
+    for bipartite graphs, without changing the eigenvector.
+
+    Examples
+    --------
+    >>> vector = power_iteration(np.array([[0., 1.], [1., 0.]]).dot, 2)
+    >>> np.round(vector, 4).tolist()
+    [0.7071, 0.7071]
+    """
+    vector = np.full(n_voxels, 1 / np.sqrt(n_voxels))
+    for _ in range(max_iter):
+        updated = matvec(vector) + vector
+        norm = np.linalg.norm(updated)
+        if norm == 0:
+            return updated
+        updated /= norm
+        if np.linalg.norm(updated - vector) < tolerance:
+            return updated
+        vector = updated
+    return vector
+
+
+class SparseGraph:
+    """Undirected weighted graph with a symmetric CSR adjacency.
+
+    Examples
+    --------
+    >>> ts = np.array([[1., 2., 3., 4.], [2., 4., 6., 8.],
+    ...                [4., 3., 2., 1.]])
+    >>> g = SparseGraph.from_timeseries(ts, threshold=0.5)
+    >>> g.n_nodes, g.n_edges
+    (3, 1)
+    >>> g.degree().tolist()
+    [1.0, 1.0, 0.0]
+    >>> SparseGraph.from_timeseries(ts, absolute=True).n_edges
+    3
+    """
+    def __init__(self, adjacency, node_ids=None, metadata=None):
+        """
+        Parameters
+        ----------
+        adjacency : scipy.sparse matrix
+            symmetric nodes × nodes weights
+
+        node_ids : iterable or None
+            label of each node; ``range(n_nodes)`` if None
+
+        metadata : dict or None
+            JSON-serializable graph attributes
+        """
+        self.adjacency = sparse.csr_matrix(adjacency)
+        self.adjacency.eliminate_zeros()
+        self.node_ids = np.arange(self.n_nodes) if node_ids is None else \
+            np.asarray(node_ids)
+        self.metadata = dict(metadata or {})
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(n_nodes={self.n_nodes}, '
+                f'n_edges={self.n_edges})')
+
+    @property
+    def n_nodes(self):
+        """Number of nodes"""
+        return self.adjacency.shape[0]
+
+    @property
+    def n_edges(self):
+        """Number of undirected edges, excluding self-loops"""
+        return int((self.adjacency.nnz - self.adjacency.diagonal().astype(
+            bool).sum()) // 2)
+
+    @classmethod
+    def from_timeseries(cls, timeseries, threshold=None, sparsity=None,
+                        absolute=False, node_ids=None, memory_gb=1.0,
+                        metadata=None):
+        """Correlation graph of node timeseries, built from streamed
+        correlation tiles.
+
+        Parameters
+        ----------
+        timeseries : numpy.ndarray
+            nodes × timepoints array (the ndmg convention)
+
+        threshold : float or None
+            keep edges with correlation above this value
+
+        sparsity : float or None
+            keep this fraction of the strongest possible edges; ignored
+            if ``threshold`` is given
+
+        absolute : bool
+            weight edges by absolute correlation
+
+        node_ids : iterable or None
+
+        memory_gb : float
+            memory budget for correlation tiles
+
+        metadata : dict or None
+
+        Returns
+        -------
+        SparseGraph
+        """
+        normalized = normalize_timeseries(
+            np.array(timeseries, dtype=np.float32).T)
+        n_nodes = normalized.shape[1]
+        rows = tile_rows(n_nodes, memory_gb, normalized.nbytes)
+        if threshold is None and sparsity is not None:
+            edges = SparsityEdges(max(int(np.ceil(
+                sparsity * n_nodes * (n_nodes - 1) / 2)), 1))
+        else:
+            edges = ThresholdedEdges(-1 if threshold is None else threshold,
+                                     np.inf)
+        for start, _, tile in correlation_tiles(normalized, rows):
+            if absolute:
+                diagonal = tile == -2
+                np.abs(tile, out=tile)
+                tile[diagonal] = -2
+            if isinstance(edges, SparsityEdges):
+                edges.add(start, tile)
+            else:
+                above = tile > edges.threshold if threshold is not None \
+                    else tile != -2
+                edges.add(tile, above)
+        metadata = dict(metadata or {})
+        metadata.update({'threshold': threshold, 'sparsity': sparsity,
+                         'absolute': absolute})
+        return cls(edges.matrix(n_nodes), node_ids, metadata)
+
+    @classmethod
+    def from_streamlines(cls, streamlines, rois, metadata=None):
+        """Structural graph whose edge weights count the streamlines
+        passing through both regions (and, on the diagonal, through each
+        region), as ndmg's ``graph.make_graph``.
+
+        Parameters
+        ----------
+        streamlines : iterable of numpy.ndarray
+            each an n_points × 3 array of voxel coordinates
+
+        rois : numpy.ndarray
+            3D label image
+
+        metadata : dict or None
+
+        Returns
+        -------
+        SparseGraph
+        """
+        node_ids = np.unique(rois)
+        node_ids = node_ids[node_ids > 0]
+        lookup = np.where(rois > 0, np.searchsorted(node_ids, rois), -1)
+
+        lengths = np.array([len(streamline) for streamline in streamlines])
+        points = np.round(np.concatenate(
+            [np.asarray(streamline).reshape(-1, 3) for streamline in
+             streamlines]) if len(lengths) else np.empty((0, 3))
+        ).astype(int)
+        owners = np.repeat(np.arange(len(lengths)), lengths)
+        inside = np.all((points >= 0) & (points < rois.shape), axis=1)
+        points, owners = points[inside], owners[inside]
+        labels = lookup[tuple(points.T)]
+        owners, labels = owners[labels >= 0], labels[labels >= 0]
+
+        # streamline × region incidence; repeated visits count once
+        incidence = sparse.csr_matrix(
+            (np.ones(labels.size, dtype=np.int32), (owners, labels)),
+            shape=(len(lengths), node_ids.size))
+        incidence.data[:] = 1
+        return cls(incidence.T @ incidence, node_ids, metadata)
+
+    @classmethod
+    def load(cls, path):
+        """Load a graph saved with ``save``"""
+        with np.load(path, allow_pickle=False) as npz:
+            adjacency = sparse.csr_matrix(
+                (npz['data'], npz['indices'], npz['indptr']),
+                shape=tuple(npz['shape']))
+            return cls(adjacency, npz['node_ids'],
+                       json.loads(str(npz['metadata'])))
+
+    def save(self, path):
+        """Save the graph as ``.npz``
+
+        Returns
+        -------
+        str
+            ``path``
+        """
+        np.savez_compressed(path, data=self.adjacency.data,
+                            indices=self.adjacency.indices,
+                            indptr=self.adjacency.indptr,
+                            shape=np.array(self.adjacency.shape),
+                            node_ids=self.node_ids,
+                            metadata=json.dumps(self.metadata))
+        return path
+
+    def degree(self, weighted=False):
+        """Binarized or weighted degree of each node, excluding
+        self-loops"""
+        adjacency = self.adjacency.copy()
+        adjacency.setdiag(0)
+        adjacency.eliminate_zeros()
+        if weighted:
+            return np.asarray(adjacency.sum(axis=1), dtype=np.float32
+                              ).ravel()
+        return np.diff(adjacency.indptr).astype(np.float32)
+
+    def eigenvector_centrality(self, weighted=True):
+        """Leading eigenvector of the (binarized) adjacency by power
+        iteration"""
+        adjacency = self.adjacency.copy()
+        if not weighted:
+            adjacency.data[:] = 1
+        return power_iteration(adjacency.dot, self.n_nodes)
+
+    def to_dense(self):
+        """Dense nodes × nodes weights"""
+        return self.adjacency.toarray()
+
+    def to_networkx(self, **graph_attributes):
+        """networkx.Graph with node labels from ``node_ids``"""
+        import networkx as nx
+        upper = sparse.triu(self.adjacency).tocoo()
+        g = nx.Graph(**graph_attributes)
+        g.add_nodes_from(self.node_ids.tolist())
+        g.add_weighted_edges_from(zip(self.node_ids[upper.row].tolist(),
+                                      self.node_ids[upper.col].tolist(),
+                                      upper.data.tolist()))
+        return g
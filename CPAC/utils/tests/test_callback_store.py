@@ -0,0 +1,60 @@
+"""Tests for the incrementally updated callback-log summary"""
+import json
+import os
+from datetime import datetime, timedelta
+from nipype.utils.draw_gantt_chart import log_to_dict
+from CPAC.utils.monitoring.callback_store import RESOURCES, \
+                                                 summarize_callback_log
+from CPAC.utils.monitoring.draw_gantt_chart import \
+    calculate_resource_timeseries, create_event_dict, resource_report
+
+
+def _log_nodes(callback_log, first, last, partial=False):
+    start = datetime(2022, 1, 1)
+    with open(callback_log, 'a', encoding='utf-8') as log_file:
+        for index in range(first, last):
+            print(json.dumps({
+                'id': f'cpac_sub-1.node_{index}', 'hash': str(index),
+                'start': (start + timedelta(minutes=7 * index)).isoformat(
+                    timespec='microseconds'),
+                # no events at the same time, which the pandas-based
+                # event dict can't tell apart
+                'finish': (start + timedelta(minutes=9 * index + 3.5)
+                           ).isoformat(timespec='microseconds'),
+                'runtime_threads': index % 3,
+                'runtime_memory_gb': 0.5 * index,
+                'estimated_memory_gb': 2, 'num_threads': 1}), file=log_file)
+        print(json.dumps({'id': f'cpac_sub-1.node_{last}', 'hash': 'x'}),
+              file=log_file)
+        if partial:
+            log_file.write('{"id": "cpac_sub-1.still_being_wr')
+
+
+def test_callback_store(tmp_path):
+    '''Test that the summary only reads newly logged nodes and that its
+    timeseries match those computed from the whole log'''
+    callback_log = str(tmp_path / 'callback.log')
+    _log_nodes(callback_log, 0, 5, partial=True)
+    with summarize_callback_log(callback_log) as store:
+        assert store.span()[2] == 5
+        assert store.update(callback_log) == 0
+    with open(callback_log, 'a', encoding='utf-8') as log_file:
+        log_file.write('iting"}\n')
+    _log_nodes(callback_log, 5, 8)
+    with summarize_callback_log(callback_log) as store:
+        assert store.span()[2] == 8
+        assert [node['id'] for node in store.overused()] == [
+            'cpac_sub-1.node_5', 'cpac_sub-1.node_6', 'cpac_sub-1.node_7']
+        nodes = [node for node in log_to_dict(callback_log) if
+                 'start' in node]
+        for resource in RESOURCES:
+            expected = calculate_resource_timeseries(
+                create_event_dict(nodes[0]['start'], nodes), resource)
+            assert store.resource_timeseries(resource) == list(
+                zip(expected.index, expected.values))
+
+    resource_report(callback_log, 2)
+    assert os.path.exists(f'{callback_log}.html')
+    with open(f'{callback_log}.resource_overusage.txt', 'r',
+              encoding='utf-8') as report:
+        assert '3.5 > 2' in report.read()
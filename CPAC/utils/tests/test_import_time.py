@@ -0,0 +1,53 @@
+"""Import-time budgets for the modules CLI subcommands and worker
+processes start with"""
+import os
+import re
+import subprocess
+import sys
+import pytest
+import CPAC
+
+HEAVY_MODULES = ('matplotlib', 'nilearn', 'nipype', 'pandas', 'scipy')
+IMPORT_BUDGETS = {  # seconds, cumulative, in a fresh interpreter
+    'CPAC.__main__': 1,
+    'CPAC.utils': 0.5,
+    'CPAC.utils.build_data_config': 1,
+    'CPAC.utils.configuration': 2,
+    'CPAC.pipeline.schema': 2}
+LIGHT_MODULES = ('CPAC.__main__', 'CPAC.utils', 'CPAC.utils.build_data_config',
+                 'CPAC.utils.configuration')
+
+
+def _import(module):
+    """Import a module in a fresh interpreter
+
+    Returns
+    -------
+    seconds : float
+        cumulative import time of ``module``
+
+    imported : set of str
+        top-level names of every module imported
+    """
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         f'import sys, {module}; print(*sys.modules)'],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.dirname(CPAC.__file__)))
+    seconds = max(int(match.group(1)) for match in re.finditer(
+        rf'^import time:\s+\d+ \|\s+(\d+) \|\s+{re.escape(module)}$',
+        process.stderr, re.MULTILINE)) / 1e6
+    # lazily-imported modules are in sys.modules but not executed
+    executed = set(re.findall(r'^import time:\s+\d+ \|\s+\d+ \|\s+(\S+)$',
+                              process.stderr, re.MULTILINE))
+    return seconds, {name.split('.')[0] for name in
+                     process.stdout.split() if name in executed}
+
+
+@pytest.mark.parametrize('module', IMPORT_BUDGETS)
+def test_import_time(module):
+    '''Test that importing a module stays within its budget'''
+    seconds, imported = _import(module)
+    assert seconds < IMPORT_BUDGETS[module]
+    if module in LIGHT_MODULES:
+        assert not imported.intersection(HEAVY_MODULES)
@@ -0,0 +1,86 @@
+"""Tests for the monitoring server's live metrics"""
+import json
+import threading
+from urllib.request import urlopen
+from nipype.interfaces.utility import Function
+from CPAC.pipeline.nipype_pipeline_engine import Node, Workflow
+from CPAC.pipeline.nipype_pipeline_engine.plugins import MultiProcPlugin
+from CPAC.utils.monitoring import LoggingHTTPServer
+from CPAC.utils.monitoring.metrics import METRICS_FILENAME
+
+
+def increment(number):
+    return number + 1
+
+
+def _log_nodes(callback_log, nodes):
+    with open(callback_log, 'a', encoding='utf-8') as log_file:
+        for name, minutes in nodes:
+            node = {'id': f'cpac_sub-1.{name}', 'hash': 'x'}
+            if minutes is None:
+                node['error'] = True
+            else:
+                node.update({'start': '2022-01-01T00:00:00',
+                             'finish': f'2022-01-01T00:{minutes:02d}:00',
+                             'runtime_memory_gb': minutes / 10})
+            print(json.dumps(node), file=log_file)
+
+
+def _get(server, path):
+    with urlopen(f'http://127.0.0.1:{server.server_address[1]}{path}'
+                 ) as response:
+        return response.headers['Content-Type'], response.read().decode()
+
+
+def test_metrics_endpoint(tmp_path):
+    '''Test that the monitoring server serves the plugin's resource
+    accounting and the callback log's node runtimes, reading nodes
+    logged since the last request'''
+    log_dir = tmp_path / 'pipeline_metrics' / 'sub-1'
+    log_dir.mkdir(parents=True)
+    wf = Workflow('cpac_sub-1', base_dir=str(tmp_path / 'work'))
+    first, second = [Node(Function(['number'], ['number'], increment),
+                          name=f'increment_{index}', mem_gb=0.1) for
+                     index in range(2)]
+    first.inputs.number = 0
+    wf.connect(first, 'number', second, 'number')
+    wf.run(plugin=MultiProcPlugin({
+        'n_procs': 2, 'memory_gb': 4, 'scheduler_metrics': {
+            'path': str(log_dir / METRICS_FILENAME), 'interval': 0}}))
+    callback_log = str(log_dir / 'callback.log')
+    _log_nodes(callback_log, [('func_preproc_0.increment_0', 3),
+                              ('func_preproc_1.increment_1', 5)])
+
+    server = LoggingHTTPServer('metrics', str(tmp_path), '127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        content_type, body = _get(server, '/metrics.json')
+        assert content_type == 'application/json'
+        metrics = json.loads(body)
+        scheduler = metrics['schedulers']['sub-1']
+        assert (scheduler['running'], scheduler['memory_gb'],
+                scheduler['processors']) == (0, 4, 2)
+        participant = metrics['participants']['cpac_sub-1']
+        assert (participant['nodes_total'], participant['nodes_done'],
+                participant['progress'], participant['eta_seconds']) == (
+                    2, 2, 1.0, 0.0)
+        assert metrics['nodes']['func_preproc.increment'] == {
+            'count': 2, 'failed': 0, 'seconds_sum': 480.0,
+            'seconds_max': 300.0, 'memory_gb_max': 0.5}
+
+        _log_nodes(callback_log, [('func_preproc_2.increment_2', None)])
+        content_type, body = _get(server, '/metrics')
+        assert content_type.startswith('text/plain; version=0.0.4')
+        assert ('cpac_participant_nodes_failed_total{participant='
+                '"cpac_sub-1"} 1') in body.splitlines()
+        assert ('cpac_node_runtime_seconds_count{node='
+                '"func_preproc.increment"} 2') in body.splitlines()
+        assert ('cpac_scheduler_processors{scheduler="sub-1"} 2'
+                ) in body.splitlines()
+
+        # the log tree is still served at other paths
+        assert 'cpac_sub-1.func_preproc_0.increment_0' in json.loads(
+            _get(server, '/')[1])['sub-1']
+    finally:
+        server.shutdown()
+        server.server_close()
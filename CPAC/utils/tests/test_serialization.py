@@ -0,0 +1,54 @@
+"""Tests for workflow serialization and the workflow build cache"""
+from CPAC.pipeline import nipype_pipeline_engine as pe
+from CPAC.utils.configuration import Preconfiguration
+from CPAC.utils.interfaces.function import Function
+from CPAC.utils.serialization import cached_workflow, load_workflow_pickle, \
+    save_workflow_pickle, workflow_cache_key
+
+
+def _identity(value):
+    return value
+
+
+def _build(name):
+    workflow = pe.Workflow(name=name)
+    workflow.add_nodes([pe.Node(Function(input_names=['value'],
+                                         output_names=['value'],
+                                         function=_identity),
+                                name='identity')])
+    return workflow
+
+
+def test_pickle_round_trip(tmp_path):
+    '''Test that saved workflows load with their version container'''
+    filename = str(tmp_path / 'workflow.pkl')
+    save_workflow_pickle(filename, _build('cpac_sub-1'), meta={'stage': 'pre'})
+    container = load_workflow_pickle(filename)
+    assert container['meta'] == {'stage': 'pre'}
+    assert container['workflow'].list_node_names() == ['identity']
+
+
+def test_cached_workflow(tmp_path):
+    '''Test that the build cache rebuilds only when an input changes'''
+    cfg = Preconfiguration('default')
+    sub_dict = {'subject_id': '1', 'anat': '/data/sub-1_T1w.nii.gz'}
+    builds = []
+
+    def build():
+        builds.append(1)
+        return _build('cpac_sub-1')
+
+    workflow = cached_workflow(str(tmp_path), cfg, sub_dict, build)
+    cached = cached_workflow(str(tmp_path), cfg, sub_dict, build)
+    assert len(builds) == 1
+    assert cached.name == workflow.name
+    assert cached.list_node_names() == workflow.list_node_names()
+
+    key = workflow_cache_key(cfg, sub_dict)
+    cfg.pipeline_setup['input_creds_path'] = '/creds.csv'
+    assert workflow_cache_key(cfg, sub_dict) == key
+    cfg.pipeline_setup['pipeline_name'] = 'changed'
+    assert workflow_cache_key(cfg, sub_dict) != key
+    cached_workflow(str(tmp_path), cfg, sub_dict, build)
+    assert len(builds) == 2
+    assert len(list(tmp_path.glob('*.pkl'))) == 2
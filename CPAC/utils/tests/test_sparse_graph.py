@@ -0,0 +1,60 @@
+"""Tests for sparse connectivity graphs"""
+from itertools import product
+import numpy as np
+import pytest
+from CPAC.utils.sparse_graph import SparseGraph
+
+
+@pytest.mark.parametrize('threshold,sparsity', [(0.1, None), (None, 0.2)])
+def test_from_timeseries(threshold, sparsity):
+    '''Test that streamed tiles reproduce the dense thresholded graph'''
+    rng = np.random.default_rng(29)
+    timeseries = rng.standard_normal((50, 30))
+    # tiny budget to force many tiles
+    graph = SparseGraph.from_timeseries(timeseries, threshold=threshold,
+                                        sparsity=sparsity, memory_gb=1e-5)
+    correlations = np.corrcoef(timeseries)
+    np.fill_diagonal(correlations, -2)
+    if sparsity is not None:
+        upper = correlations[np.triu_indices(50, 1)]
+        threshold = np.sort(upper)[-int(np.ceil(sparsity * upper.size))]
+        expected = np.where(correlations >= threshold, correlations, 0)
+    else:
+        expected = np.where(correlations > threshold, correlations, 0)
+    np.testing.assert_allclose(graph.to_dense(), expected, atol=1e-5)
+    np.testing.assert_allclose(graph.degree(weighted=True),
+                               expected.sum(axis=1), atol=1e-4)
+
+
+def test_save_load(tmp_path):
+    '''Test the .npz round trip'''
+    rng = np.random.default_rng(29)
+    graph = SparseGraph.from_timeseries(rng.standard_normal((10, 20)),
+                                        threshold=0, node_ids=range(3, 13),
+                                        metadata={'atlas': 'test'})
+    path = graph.save(str(tmp_path / 'graph.npz'))
+    loaded = SparseGraph.load(path)
+    np.testing.assert_array_equal(loaded.to_dense(), graph.to_dense())
+    assert loaded.node_ids.tolist() == list(range(3, 13))
+    assert loaded.metadata['atlas'] == 'test'
+    assert loaded.metadata['threshold'] == 0
+
+
+def test_from_streamlines():
+    '''Test that the sparse product matches ndmg's pairwise loop'''
+    rng = np.random.default_rng(29)
+    rois = rng.integers(0, 5, (8, 8, 8)) * 10
+    streamlines = [rng.uniform(0, 7, (rng.integers(1, 6), 3))
+                   for _ in range(40)]
+
+    expected = {}
+    for streamline in streamlines:
+        labels = {rois[tuple(point)] for point in
+                  np.round(streamline).astype(int)} - {0}
+        for edge in {tuple(sorted(pair)) for pair in product(labels, labels)}:
+            expected[edge] = expected.get(edge, 0) + 1
+
+    graph = SparseGraph.from_streamlines(streamlines, rois)
+    assert graph.node_ids.tolist() == [10, 20, 30, 40]
+    assert {tuple(sorted(edge)): weight for *edge, weight in
+            graph.to_networkx().edges(data='weight')} == expected
@@ -4,7 +4,8 @@ from unittest import mock
 import pytest
 from CPAC.func_preproc.func_preproc import get_motion_ref
 from CPAC.utils.configuration import Configuration
-from CPAC.utils.docs import grab_docstring_dct
+from CPAC.utils.docs import grab_docstring_dct, node_block_descriptor, \
+    node_block_registry
 from CPAC.utils.utils import check_config_resources, check_system_deps, \
                              try_fetch_parameter
 
@@ -54,6 +55,19 @@ def test_NodeBlock_option_SSOT():  # pylint: disable=invalid-name
     assert error_message.endswith('Tool input: \'chaos\'')
 
 
+def test_node_block_descriptor():
+    '''Test that NodeBlock docstrings are parsed once and that
+    dictionaries handed out are independent copies'''
+    descriptor = node_block_descriptor(get_motion_ref)
+    assert node_block_descriptor(get_motion_ref) is descriptor
+    assert node_block_registry()[
+        'CPAC.func_preproc.func_preproc.get_motion_ref'] is descriptor
+    dct = grab_docstring_dct(get_motion_ref)
+    assert dct == descriptor.docstring_dct
+    dct['inputs'].append('desc-example_bold')
+    assert 'desc-example_bold' not in descriptor.inputs
+
+
 def test_system_deps():
     """Test system dependencies.
     Raises an exception if dependencies are not met.
@@ -27,30 +27,46 @@ import yaml
 
 from click import BadParameter
 from copy import deepcopy
+from functools import lru_cache
 from itertools import repeat
 from voluptuous.error import Invalid
 from CPAC.pipeline import ALL_PIPELINE_CONFIGS, AVAILABLE_PIPELINE_CONFIGS
+from CPAC.utils.provenance import Provenance
 
 CONFIGS_DIR = os.path.abspath(os.path.join(
     __file__, *repeat(os.path.pardir, 2), 'resources/configs/'))
-with open(os.path.join(CONFIGS_DIR, '1.7-1.8-nesting-mappings.yml'), 'r',
-          encoding='utf-8') as _f:
-    NESTED_CONFIG_MAPPING = yaml.safe_load(_f)
-with open(os.path.join(CONFIGS_DIR, '1.7-1.8-deprecations.yml'), 'r',
-          encoding='utf-8') as _f:
-    NESTED_CONFIG_DEPRECATIONS = yaml.safe_load(_f)
+_CONFIG_YAMLS = {'NESTED_CONFIG_MAPPING': '1.7-1.8-nesting-mappings.yml',
+                 'NESTED_CONFIG_DEPRECATIONS': '1.7-1.8-deprecations.yml'}
 YAML_BOOLS = {True: ('on', 't', 'true', 'y', 'yes'),
               False: ('f', 'false', 'n', 'no', 'off')}
 
 
+@lru_cache(maxsize=None)
+def _config_yaml(filename):
+    """Load a YAML file from CONFIGS_DIR once, on first use"""
+    with open(os.path.join(CONFIGS_DIR, filename), 'r',
+              encoding='utf-8') as _f:
+        return yaml.safe_load(_f)
+
+
+def __getattr__(name):
+    # the 1.7→1.8 mappings are only read when updating an old config
+    if name in _CONFIG_YAMLS:
+        return _config_yaml(_CONFIG_YAMLS[name])
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 def get_last_prov_entry(prov):
+    if isinstance(prov, Provenance):
+        return prov.last_entry
     while not isinstance(prov[-1], str):
         prov = prov[-1]
     return prov[-1]
 
 
 def check_prov_for_regtool(prov):
-    last_entry = get_last_prov_entry(prov)
+    prov = Provenance(prov)
+    last_entry = prov.last_entry
     last_node = last_entry.split(':')[1]
     if 'ants' in last_node.lower():
         return 'ants'
@@ -101,7 +117,8 @@ def check_prov_for_regtool(prov):
 
 
 def check_prov_for_motion_tool(prov):
-    last_entry = get_last_prov_entry(prov)
+    prov = Provenance(prov)
+    last_entry = prov.last_entry
     last_node = last_entry.split(':')[1]
     if '3dvolreg' in last_node.lower():
         return '3dvolreg'
@@ -2151,6 +2168,11 @@ def update_config_dict(old_dict):
             return value_if_true
         return None
 
+    NESTED_CONFIG_MAPPING = _config_yaml(
+        _CONFIG_YAMLS['NESTED_CONFIG_MAPPING'])
+    NESTED_CONFIG_DEPRECATIONS = _config_yaml(
+        _CONFIG_YAMLS['NESTED_CONFIG_DEPRECATIONS'])
+
     def _get_old_values(old_dict, new_dict, key):
         '''Helper function to get old and current values of a special key
         being updated.